@@ -1,9 +1,13 @@
+import argparse
 import asyncio
 import httpx
 import time
 import json
+import math
+import os
 import random
 import string
+import uuid
 import pandas as pd
 import numpy as np
 from colorama import Fore, Style, init
@@ -17,13 +21,32 @@ init(autoreset=True)
 AGENT_URL = "http://localhost:8088/api/chat"
 JUDGE_URL = "http://localhost:8000/v1/chat/completions"
 JUDGE_MODEL = "qwen3-vl"
+# --target llm 时直接压 OpenAI 兼容接口 (vLLM 或 mock_llm_server.py)
+LLM_URL = "http://localhost:8000/v1/chat/completions"
+LLM_MODEL = "qwen3-vl"
+LLM_MAX_TOKENS = 512
 
 # 2. 压力参数
 TEST_DURATION_SEC = 120   # ⏱️ 测试持续时间 (秒)，建议设为 300 (5分钟)
-CONCURRENCY = 30          # 🚀 并发数 (RTX 6000 建议 30-50，太高会增加延迟)
+CONCURRENCY = 30          # 🚀 闭环模式并发数 (RTX 6000 建议 30-50，太高会增加延迟)
 SAMPLE_RATE = 0.1         # 🔍 评分抽样率 (10% 的回答会被 AI Doctor 检查)
 
-# 3. 题库 (基础题 + 随机噪声 = 无限题库)
+# 3. 开环模式 (open-loop)：请求按泊松过程到达，不等上一个请求返回
+#    闭环模式下服务变慢会自动压低发压速率，排队崩溃被掩盖；开环模式能看到真实的拐点
+OPEN_LOOP_RATES = [1, 2, 4, 8]   # 📈 依次压测的目标到达率 (req/s)
+MAX_INFLIGHT = 2000              # 🛑 客户端在途请求上限，超过的到达记为 dropped (防止压测机自身耗尽)
+PERCENTILES = [50, 75, 90, 95, 99, 99.9]
+
+# 4. 工作流负载测试 (--target workflow)：上传合成数据 → /api/chat 提交 workflow_data → 轮询状态直到完成
+#    本地跑 Redis + api-server + worker，VLLM_URL 指向 mock_llm_server.py (AI 解读走模拟推理服务)
+WORKFLOW_CELLS = "2k"            # 合成数据集规模，逗号分隔时按顺序轮流使用 (如 "2k,10k")
+WORKFLOW_DATA_DIR = "bench_data" # 合成数据缓存目录 (与 benchmark_pipeline.py 共用)
+POLL_INTERVAL = 2.0              # 状态轮询间隔 (秒)，与前端一致
+WORKFLOW_TIMEOUT = 3600          # 单个 run 最长等待 (秒)，超过记为 client_timeout
+WORKFLOW_RATES = [0.05, 0.1, 0.2]  # 📈 工作流到达率 (runs/s)
+REDIS_URL = "redis://localhost:6379/0"
+
+# 5. 题库 (基础题 + 随机噪声 = 无限题库)
 BASE_QUESTIONS = [
     "解释单细胞测序中 Batch Effect 的原理及去除方法。",
     "如何使用 Scanpy 进行细胞聚类？请给出代码示例。",
@@ -43,14 +66,22 @@ class StressStats:
         self.total_requests = 0
         self.success_count = 0
         self.error_count = 0
+        self.rejected_count = 0  # 429 (准入控制 / 推理服务限流)
+        self.dropped_count = 0   # 开环模式下超过 MAX_INFLIGHT 未发出的到达
         self.latencies = []     # 总耗时
         self.ttfts = []         # 首字延迟
+        self.itls = []          # 逐 token 间隔 (所有请求的相邻 chunk 间隔)
+        self.tpots = []         # 每请求平均输出间隔 (总耗时 - 首字) / (token 数 - 1)
+        self.send_lags = []     # 开环模式：实际发出时间 - 计划到达时间
+        self.queue_waits = []   # API 准入排队时间 (X-Queue-Wait-Ms 响应头)
+        self.tokens = []        # 每请求输出 token 数
         self.scores = []        # 质量评分
+        self.inflight = 0
+        self.max_inflight = 0
         self.start_time = 0
+        self.end_time = 0
         self.is_running = True
 
-stats = StressStats()
-
 def generate_random_question():
     """生成带随机噪声的问题，防止缓存作弊"""
     base_q = random.choice(BASE_QUESTIONS)
@@ -58,144 +89,692 @@ def generate_random_question():
     salt = ''.join(random.choices(string.ascii_letters + string.digits, k=8))
     return f"{base_q} (Ref: {salt})"
 
-async def ai_doctor_grade(client, question, answer):
+async def ai_doctor_grade(client, question, answer, judge_url=JUDGE_URL):
     """AI 医生抽检评分"""
     prompt = f"""
     你是一位生信专家。请对以下回答打分（0-10分）。
     问题: {question}
     回答: {answer}
-    
+
     只返回一个 JSON: {{"score": 8.5, "reason": "..."}}
     """
     try:
-        resp = await client.post(JUDGE_URL, json={
+        resp = await client.post(judge_url, json={
             "model": JUDGE_MODEL,
             "messages": [{"role": "user", "content": prompt}],
             "max_tokens": 256
         }, timeout=30)
         res_json = json.loads(resp.json()['choices'][0]['message']['content'].replace("```json", "").replace("```", ""))
         return res_json.get('score', 0)
-    except:
+    except Exception:
         return 0
 
-async def worker(client, sem):
-    """模拟一个不断提问的用户"""
+def _request_body(target, question):
+    if target == "llm":
+        return {
+            "model": LLM_MODEL,
+            "messages": [{"role": "user", "content": question}],
+            "max_tokens": LLM_MAX_TOKENS,
+            "stream": True,
+            "stream_options": {"include_usage": True},
+        }
+    return {"message": question, "history": []}
+
+async def _iter_tokens(response, target, usage):
+    """
+    逐 token 产出文本
+    - agent: text/plain 流，每个 chunk 近似 1 个 token (Agent 逐 token 转发 LLM 输出)
+    - llm:   OpenAI SSE，每个 delta 为 1 个 token；末尾 usage 给出精确的 completion_tokens
+    """
+    if target != "llm":
+        async for chunk in response.aiter_text():
+            if chunk:
+                yield chunk
+        return
+    async for line in response.aiter_lines():
+        if not line.startswith("data:"):
+            continue
+        data = line[5:].strip()
+        if data == "[DONE]":
+            break
+        payload = json.loads(data)
+        if payload.get("usage"):
+            usage.update(payload["usage"])
+        for choice in payload.get("choices", []):
+            content = (choice.get("delta") or {}).get("content")
+            if content:
+                yield content
+
+async def send_request(client, stats, args, scheduled=None):
+    """
+    发送一个流式请求并记录指标
+    scheduled: 开环模式下的计划到达时间 (perf_counter)；延迟从计划时间起算，避免协调遗漏 (coordinated omission)
+    """
+    question = generate_random_question()
+    start = time.perf_counter()
+    origin = scheduled if scheduled is not None else start
+    ttft = 0
+    last = None
+    n_tokens = 0
+    itls = []
+    usage = {}
+    full_response = ""
+    stats.total_requests += 1
+    stats.inflight += 1
+    stats.max_inflight = max(stats.max_inflight, stats.inflight)
+
+    try:
+        # 发起流式请求
+        async with client.stream("POST", args.url, json=_request_body(args.target, question), timeout=args.timeout) as response:
+            if response.status_code == 429:
+                stats.rejected_count += 1
+                print(f"{Fore.YELLOW}r", end="", flush=True)
+                return
+            if response.status_code != 200:
+                stats.error_count += 1
+                print(f"{Fore.RED}x", end="", flush=True)
+                return
+            if "x-queue-wait-ms" in response.headers:
+                stats.queue_waits.append(float(response.headers["x-queue-wait-ms"]))
+
+            async for chunk in _iter_tokens(response, args.target, usage):
+                now = time.perf_counter()
+                if last is None:
+                    ttft = (now - origin) * 1000
+                else:
+                    itls.append((now - last) * 1000)
+                last = now
+                n_tokens += 1
+                full_response += chunk
+
+        # 请求完成
+        total_time = (time.perf_counter() - origin) * 1000
+        n_tokens = usage.get("completion_tokens", n_tokens)
+        stats.success_count += 1
+        stats.latencies.append(total_time)
+        stats.ttfts.append(ttft)
+        stats.itls.extend(itls)
+        stats.tokens.append(n_tokens)
+        if n_tokens > 1:
+            stats.tpots.append((total_time - ttft) / (n_tokens - 1))
+        if scheduled is not None:
+            stats.send_lags.append((start - scheduled) * 1000)
+
+        # 🎲 随机抽检评分
+        if args.sample_rate > 0 and random.random() < args.sample_rate:
+            score = await ai_doctor_grade(client, question, full_response, args.judge_url)
+            if score > 0:
+                stats.scores.append(score)
+                print(f"{Fore.MAGENTA}★", end="", flush=True) # 评分标记
+            else:
+                print(f"{Fore.GREEN}.", end="", flush=True)
+        else:
+            print(f"{Fore.GREEN}.", end="", flush=True) # 成功标记
+
+    except Exception as e:
+        stats.error_count += 1
+        print(f"{Fore.RED}!", end="", flush=True)
+    finally:
+        stats.inflight -= 1
+
+async def worker(client, sem, stats, args):
+    """闭环：模拟一个不断提问的用户 (上一个请求返回后才发下一个)"""
     while stats.is_running:
         async with sem:
-            question = generate_random_question()
-            start = time.perf_counter()
-            ttft = 0
-            first_chunk = False
-            full_response = ""
-            
-            try:
-                # 发起流式请求
-                async with client.stream("POST", AGENT_URL, json={"message": question, "history": []}, timeout=60) as response:
-                    if response.status_code != 200:
-                        stats.error_count += 1
-                        print(f"{Fore.RED}x", end="", flush=True)
-                        continue
-
-                    async for chunk in response.aiter_text():
-                        if not first_chunk:
-                            ttft = (time.perf_counter() - start) * 1000
-                            first_chunk = True
-                        if chunk:
-                            full_response += chunk
-                
-                # 请求完成
-                total_time = (time.perf_counter() - start) * 1000
-                stats.success_count += 1
-                stats.latencies.append(total_time)
-                stats.ttfts.append(ttft)
-                
-                # 🎲 随机抽检评分
-                if random.random() < SAMPLE_RATE:
-                    score = await ai_doctor_grade(client, question, full_response)
-                    if score > 0:
-                        stats.scores.append(score)
-                        print(f"{Fore.MAGENTA}★", end="", flush=True) # 评分标记
-                    else:
-                        print(f"{Fore.GREEN}.", end="", flush=True)
-                else:
-                    print(f"{Fore.GREEN}.", end="", flush=True) # 成功标记
+            await send_request(client, stats, args)
 
-            except Exception as e:
-                stats.error_count += 1
-                print(f"{Fore.RED}!", end="", flush=True)
+async def arrivals(stats, args, rate, duration, launch):
+    """
+    开环：按泊松过程 (指数分布间隔) 发出请求，与响应快慢无关
+    launch(scheduled) 返回一个请求协程；scheduled 为计划到达时间 (perf_counter)
+    """
+    rng = random.Random(args.seed)
+    tasks = set()
+    t0 = time.perf_counter()
+    next_at = t0 + rng.expovariate(rate)
+    while next_at - t0 < duration:
+        delay = next_at - time.perf_counter()
+        if delay > 0:
+            await asyncio.sleep(delay)
+        if stats.inflight >= args.max_inflight:
+            stats.dropped_count += 1
+            print(f"{Fore.YELLOW}-", end="", flush=True)
+        else:
+            task = asyncio.create_task(launch(next_at))
+            tasks.add(task)
+            task.add_done_callback(tasks.discard)
+        next_at += rng.expovariate(rate)
+    return tasks
 
-async def monitor(duration):
+async def monitor(stats, duration):
     """监控倒计时"""
     start = time.time()
-    while time.time() - start < duration:
+    while time.time() - start < duration and stats.is_running:
         await asyncio.sleep(1)
         elapsed = time.time() - start
         rps = stats.success_count / elapsed if elapsed > 0 else 0
-        print(f"\r[{elapsed:.0f}s/{duration}s] RPS: {rps:.2f} | Err: {stats.error_count} | Avg Latency: {np.mean(stats.latencies) if stats.latencies else 0:.0f}ms", end="")
-    
+        tps = sum(stats.tokens) / elapsed if elapsed > 0 else 0
+        print(f"\r[{elapsed:.0f}s/{duration}s] RPS: {rps:.2f} | tok/s: {tps:.0f} | In-flight: {stats.inflight} | "
+              f"Err: {stats.error_count} | Avg Latency: {np.mean(stats.latencies) if stats.latencies else 0:.0f}ms", end="")
+
     stats.is_running = False
 
-async def run_stress_test():
+def _client(args, max_connections):
+    # 连接池要足够大：池子本身排队会把开环压测重新变成闭环
+    limits = httpx.Limits(max_keepalive_connections=max_connections, max_connections=max_connections)
+    return httpx.AsyncClient(limits=limits, timeout=args.timeout)
+
+async def run_stress_test(args):
+    """闭环模式 (原有压测方式)"""
+    stats = StressStats()
     print(f"{Fore.CYAN}🚀 GIBH-AGENT 持续压力测试 (Sustained Pressure Test)")
-    print(f"硬件环境: RTX 6000 | 并发数: {CONCURRENCY} | 持续时间: {TEST_DURATION_SEC}s")
-    print(f"策略: 随机噪声绕过缓存 + AI Doctor 抽检 ({int(SAMPLE_RATE*100)}%)")
+    print(f"目标: {args.url} | 模式: 闭环 | 并发数: {args.concurrency} | 持续时间: {args.duration}s")
+    print(f"策略: 随机噪声绕过缓存 + AI Doctor 抽检 ({int(args.sample_rate*100)}%)")
     print("-" * 60)
-    print("图例: .成功  x失败  !异常  ★抽检评分")
+    print("图例: .成功  x失败  !异常  r限流(429)  ★抽检评分")
     print("-" * 60)
 
     stats.start_time = time.perf_counter()
-    
-    # 限制连接池
-    limits = httpx.Limits(max_keepalive_connections=CONCURRENCY, max_connections=CONCURRENCY)
-    async with httpx.AsyncClient(limits=limits, timeout=120.0) as client:
-        sem = asyncio.Semaphore(CONCURRENCY)
-        
+
+    async with _client(args, args.concurrency) as client:
+        sem = asyncio.Semaphore(args.concurrency)
+
         # 启动监控协程
-        monitor_task = asyncio.create_task(monitor(TEST_DURATION_SEC))
-        
+        monitor_task = asyncio.create_task(monitor(stats, args.duration))
+
         # 启动并发 Worker
-        workers = [asyncio.create_task(worker(client, sem)) for _ in range(CONCURRENCY)]
-        
+        workers = [asyncio.create_task(worker(client, sem, stats, args)) for _ in range(args.concurrency)]
+
         # 等待时间结束
         await monitor_task
-        
+
         # 等待所有 Worker 收尾
         print(f"\n{Fore.YELLOW}⏳ 时间到，正在等待剩余请求完成...")
         await asyncio.gather(*workers, return_exceptions=True)
 
-    print_report()
+    stats.end_time = time.perf_counter()
+    summary = summarize(stats, args.duration, mode="closed", concurrency=args.concurrency)
+    print_report(summary)
+    return [summary]
+
+async def run_open_loop(args):
+    """开环模式：依次以每个目标到达率压测 duration 秒"""
+    print(f"{Fore.CYAN}🚀 GIBH-AGENT 开环压力测试 (Open-loop, Poisson arrivals)")
+    print(f"目标: {args.url} | 到达率: {', '.join(str(r) for r in args.rates)} req/s | 每档 {args.duration}s")
+    print(f"策略: 随机噪声绕过缓存 + AI Doctor 抽检 ({int(args.sample_rate*100)}%) | 在途上限 {args.max_inflight}")
+    print("-" * 60)
+    print("图例: .成功  x失败  !异常  r限流(429)  -客户端丢弃  ★抽检评分")
+    print("-" * 60)
+
+    summaries = []
+    async with _client(args, args.max_inflight) as client:
+        for rate in args.rates:
+            stats = StressStats()
+            print(f"\n{Fore.CYAN}▶ 目标到达率 {rate} req/s")
+            stats.start_time = time.perf_counter()
+            monitor_task = asyncio.create_task(monitor(stats, args.duration))
+            tasks = await arrivals(stats, args, rate, args.duration,
+                                   lambda t: send_request(client, stats, args, scheduled=t))
+            await monitor_task
+            if tasks:
+                print(f"\n{Fore.YELLOW}⏳ 到达结束，等待 {len(tasks)} 个在途请求完成...")
+                await asyncio.gather(*tasks, return_exceptions=True)
+            stats.end_time = time.perf_counter()
+            summary = summarize(stats, args.duration, mode="open", rate=rate)
+            print_report(summary)
+            summaries.append(summary)
+
+    if len(summaries) > 1:
+        print_sweep(summaries)
+    return summaries
+
+def percentile_ladder(values):
+    if not values:
+        return None
+    arr = np.asarray(values, dtype=float)
+    ladder = {"count": int(arr.size), "mean": float(arr.mean()), "min": float(arr.min())}
+    for p, v in zip(PERCENTILES, np.percentile(arr, PERCENTILES)):
+        ladder[f"p{p:g}"] = float(v)
+    ladder["max"] = float(arr.max())
+    return ladder
+
+def histogram(values, bins=12):
+    """对数分桶直方图 (延迟通常跨多个数量级)，返回 [(下界, 上界, 计数)]"""
+    arr = np.asarray(values, dtype=float)
+    arr = arr[arr > 0]
+    if arr.size == 0:
+        return []
+    lo, hi = arr.min(), arr.max()
+    if hi <= lo:
+        return [(float(lo), float(hi), int(arr.size))]
+    edges = np.logspace(math.log10(lo), math.log10(hi), bins + 1)
+    counts, _ = np.histogram(arr, bins=edges)
+    return [(float(edges[i]), float(edges[i + 1]), int(c)) for i, c in enumerate(counts)]
+
+def summarize(stats, duration, mode, rate=None, concurrency=None):
+    wall = max(stats.end_time - stats.start_time, 1e-9)
+    total_tokens = int(sum(stats.tokens))
+    return {
+        "mode": mode,
+        "target_rate": rate,
+        "concurrency": concurrency,
+        "duration_s": duration,
+        "wall_s": wall,
+        "requests": stats.total_requests,
+        "success": stats.success_count,
+        "errors": stats.error_count,
+        "rejected": stats.rejected_count,
+        "dropped": stats.dropped_count,
+        "max_inflight": stats.max_inflight,
+        "throughput_rps": stats.success_count / wall,
+        "offered_rps": (stats.total_requests + stats.dropped_count) / duration,
+        "output_tokens": total_tokens,
+        "tokens_per_s": total_tokens / wall,
+        "latency_ms": percentile_ladder(stats.latencies),
+        "ttft_ms": percentile_ladder(stats.ttfts),
+        "itl_ms": percentile_ladder(stats.itls),
+        "tpot_ms": percentile_ladder(stats.tpots),
+        "send_lag_ms": percentile_ladder(stats.send_lags),
+        "queue_wait_ms": percentile_ladder(stats.queue_waits),
+        "tokens_per_request": percentile_ladder(stats.tokens),
+        "latency_histogram": histogram(stats.latencies),
+        "ttft_histogram": histogram(stats.ttfts),
+        "itl_histogram": histogram(stats.itls),
+        "scores": stats.scores,
+    }
+
+def print_ladder(title, ladder, unit="ms"):
+    if not ladder:
+        return
+    steps = "  ".join(f"{k.upper()}: {ladder[k]:.1f}" for k in ["mean"] + [f"p{p:g}" for p in PERCENTILES] + ["max"])
+    print(f"{title} (n={ladder['count']}, {unit})")
+    print(f"   {steps}")
+
+def print_histogram(title, buckets, width=40):
+    if not buckets:
+        return
+    peak = max(c for _, _, c in buckets) or 1
+    print(f"{title}")
+    for lo, hi, c in buckets:
+        bar = "█" * int(round(width * c / peak))
+        print(f"   {lo:9.1f} - {hi:9.1f} ms | {bar} {c}")
 
-def print_report():
-    total_time = time.perf_counter() - stats.start_time
-    
+def print_report(summary):
     print("\n\n" + "=" * 60)
     print(f"{Fore.CYAN}📊 压力测试最终报告 (Pressure Report)")
     print("=" * 60)
-    print(f"⏱️  实测时长:      {total_time:.2f} s")
-    print(f"📦 总请求数:      {stats.success_count + stats.error_count}")
-    print(f"✅ 成功请求:      {Fore.GREEN}{stats.success_count}")
-    print(f"❌ 失败请求:      {Fore.RED}{stats.error_count}")
-    print(f"🚀 平均 RPS:      {Fore.YELLOW}{stats.success_count / total_time:.2f} req/s")
-    
-    if stats.latencies:
+    if summary["mode"] == "open":
+        print(f"📈 目标到达率:    {summary['target_rate']} req/s (实际发压 {summary['offered_rps']:.2f} req/s)")
+    print(f"⏱️  实测时长:      {summary['wall_s']:.2f} s")
+    print(f"📦 总请求数:      {summary['requests']}")
+    print(f"✅ 成功请求:      {Fore.GREEN}{summary['success']}")
+    print(f"❌ 失败请求:      {Fore.RED}{summary['errors']}")
+    if summary["rejected"] or summary["dropped"]:
+        print(f"🚦 限流 / 丢弃:   {Fore.YELLOW}{summary['rejected']} / {summary['dropped']}")
+    print(f"🔁 最大在途请求:  {summary['max_inflight']}")
+    print(f"🚀 平均 RPS:      {Fore.YELLOW}{summary['throughput_rps']:.2f} req/s")
+    print(f"🔤 输出吞吐:      {Fore.YELLOW}{summary['tokens_per_s']:.1f} tokens/s "
+          f"({summary['output_tokens']} tokens)")
+
+    if summary["latency_ms"]:
+        print("-" * 60)
+        print_ladder("⚡ 首字延迟 (TTFT)", summary["ttft_ms"])
+        print_ladder("🐢 完整响应耗时", summary["latency_ms"])
+        print_ladder("⏲️  逐 token 间隔 (ITL)", summary["itl_ms"])
+        print_ladder("🧮 每请求平均输出间隔 (TPOT)", summary["tpot_ms"])
+        print_ladder("🎫 API 准入排队", summary["queue_wait_ms"])
+        print_ladder("📤 客户端发送滞后", summary["send_lag_ms"])
         print("-" * 60)
-        print(f"⚡ 首字延迟 (TTFT):")
-        print(f"   Avg: {np.mean(stats.ttfts):.2f} ms")
-        print(f"   P99: {np.percentile(stats.ttfts, 99):.2f} ms (99%的用户在此时间内看到第一个字)")
-        
-        print(f"🐢 完整响应耗时:")
-        print(f"   Avg: {np.mean(stats.latencies):.2f} ms")
-        print(f"   P99: {np.percentile(stats.latencies, 99):.2f} ms")
-    
-    if stats.scores:
+        print_histogram("📊 完整响应耗时分布", summary["latency_histogram"])
+        print_histogram("📊 首字延迟分布", summary["ttft_histogram"])
+
+    if summary["scores"]:
         print("-" * 60)
-        print(f"👨‍⚕️ AI Doctor 质量抽检 ({len(stats.scores)} samples):")
-        avg_score = np.mean(stats.scores)
+        print(f"👨‍⚕️ AI Doctor 质量抽检 ({len(summary['scores'])} samples):")
+        avg_score = np.mean(summary["scores"])
         score_color = Fore.GREEN if avg_score > 8 else Fore.YELLOW
         print(f"   平均分: {score_color}{avg_score:.2f} / 10")
-        print(f"   最低分: {min(stats.scores)}")
-    
+        print(f"   最低分: {min(summary['scores'])}")
+
     print("=" * 60)
 
+def print_sweep(summaries):
+    """各到达率的汇总表：吞吐不再随到达率增长、P99 陡增的那一档就是容量拐点"""
+    rows = []
+    for s in summaries:
+        rows.append({
+            "rate": s["target_rate"],
+            "rps": round(s["throughput_rps"], 2),
+            "tok/s": round(s["tokens_per_s"], 1),
+            "err": s["errors"] + s["rejected"] + s["dropped"],
+            "ttft_p50": round(s["ttft_ms"]["p50"], 1) if s["ttft_ms"] else None,
+            "ttft_p99": round(s["ttft_ms"]["p99"], 1) if s["ttft_ms"] else None,
+            "e2e_p99": round(s["latency_ms"]["p99"], 1) if s["latency_ms"] else None,
+            "itl_p99": round(s["itl_ms"]["p99"], 1) if s["itl_ms"] else None,
+            "inflight": s["max_inflight"],
+        })
+    print(f"\n{Fore.CYAN}📈 到达率扫描汇总 (ms)")
+    print(pd.DataFrame(rows).to_string(index=False))
+
+class WorkflowStats(StressStats):
+    def __init__(self):
+        super().__init__()
+        self.runs = []              # 每个 run 的记录 (状态、排队、执行、端到端)
+        self.upload_latencies = []
+        self.submit_latencies = []
+        self.status_requests = 0
+        self.status_not_modified = 0
+        self.status_latencies = []
+        self.redis_samples = []     # 每秒采样：队列深度、Redis 命令数
+
+def _api_base(url):
+    return url.split("/api/", 1)[0]
+
+def prepare_workflow_datasets(args):
+    """生成 (或复用) 合成数据集，并按线上规则 (标准模板 + 规划器) 生成每个数据集的流程步骤"""
+    from benchmark_pipeline import parse_scale, ensure_dataset, build_steps
+
+    datasets = []
+    for scale in args.cells.split(","):
+        n_cells = parse_scale(scale)
+        path, gen_seconds = ensure_dataset(args.data_dir, n_cells, args.seed or 0)
+        steps, _ = build_steps(path, render_png=False, use_planner=True)
+        if gen_seconds:
+            print(f"🧪 生成合成数据 {n_cells:,} 细胞 ({gen_seconds:.1f}s)")
+        datasets.append({"n_cells": n_cells, "path": path, "name": os.path.basename(path), "steps": steps})
+    return datasets
+
+async def upload_dataset(client, stats, base, path, name):
+    start = time.perf_counter()
+    with open(path, "rb") as f:
+        resp = await client.post(f"{base}/api/upload", files={"file": (name, f, "application/octet-stream")})
+    resp.raise_for_status()
+    if resp.json().get("status") != "success":
+        raise RuntimeError(resp.json().get("message"))
+    stats.upload_latencies.append((time.perf_counter() - start) * 1000)
+
+async def poll_status(client, stats, base, run_id, args):
+    """按前端的节奏轮询，携带 If-None-Match (与浏览器缓存行为一致)，返回最终状态"""
+    etag, status = None, {}
+    deadline = time.perf_counter() + args.workflow_timeout
+    while time.perf_counter() < deadline:
+        await asyncio.sleep(args.poll_interval)
+        start = time.perf_counter()
+        resp = await client.get(f"{base}/api/workflow/status/{run_id}",
+                                headers={"If-None-Match": etag} if etag else None)
+        stats.status_requests += 1
+        stats.status_latencies.append((time.perf_counter() - start) * 1000)
+        if resp.status_code == 304:
+            stats.status_not_modified += 1
+            continue
+        resp.raise_for_status()
+        etag = resp.headers.get("etag")
+        status = resp.json()
+        if status.get("completed"):
+            return status
+    return {**status, "status": "client_timeout"}
+
+async def run_workflow(client, stats, args, base, dataset, scheduled):
+    """一个 run 的完整生命周期：(上传) → 提交 → 轮询，记录排队 / 执行 / 端到端耗时"""
+    stats.total_requests += 1
+    stats.inflight += 1
+    stats.max_inflight = max(stats.max_inflight, stats.inflight)
+    record = {"n_cells": dataset["n_cells"], "status": "error", "polls": 0}
+    try:
+        name = dataset["name"]
+        if args.upload_each:
+            name = f"bench_{uuid.uuid4().hex[:12]}.h5ad"
+            await upload_dataset(client, stats, base, dataset["path"], name)
+
+        submitted_at = time.time()
+        start = time.perf_counter()
+        resp = await client.post(f"{base}/api/chat", json={
+            "message": "运行工作流",
+            "history": [],
+            "uploaded_files": [{"id": name, "name": name}],
+            "workflow_data": {"workflow_name": "Standard Scanpy Pipeline", "steps": dataset["steps"]},
+        })
+        stats.submit_latencies.append((time.perf_counter() - start) * 1000)
+        resp.raise_for_status()
+        record["run_id"] = resp.json()["run_id"]
+
+        polls_before = stats.status_requests
+        status = await poll_status(client, stats, base, record["run_id"], args)
+        record["polls"] = stats.status_requests - polls_before
+        record["status"] = status.get("status")
+        record["e2e_s"] = time.perf_counter() - scheduled
+        started_at, finished_at = status.get("started_at"), status.get("finished_at")
+        if started_at:
+            # 客户端与 Worker 在同一台机器上 (或时钟已同步)，两端的 wall clock 可以直接相减
+            record["queue_wait_s"] = max(started_at - submitted_at, 0.0)
+            if finished_at:
+                record["exec_s"] = finished_at - started_at
+
+        if record["status"] == "success":
+            stats.success_count += 1
+            print(f"{Fore.GREEN}.", end="", flush=True)
+        else:
+            stats.error_count += 1
+            print(f"{Fore.RED}x", end="", flush=True)
+    except Exception as e:
+        record["error"] = str(e)
+        stats.error_count += 1
+        print(f"{Fore.RED}!", end="", flush=True)
+    finally:
+        stats.inflight -= 1
+        stats.runs.append(record)
+
+async def sample_redis(stats, args, stop):
+    """每秒采样 Celery 队列深度与 Redis 命令计数 (未安装 redis 包或连不上时跳过)"""
+    try:
+        import redis.asyncio as aioredis
+        client = aioredis.from_url(args.redis_url)
+        await client.ping()
+    except Exception as e:
+        print(f"{Fore.YELLOW}⚠️ Redis 采样不可用: {e}")
+        return
+    try:
+        while not stop.is_set():
+            info = await client.info()
+            stats.redis_samples.append({
+                "t": time.perf_counter() - stats.start_time,
+                "queue_depth": await client.llen("celery"),
+                "commands": info.get("total_commands_processed", 0),
+                "ops_per_sec": info.get("instantaneous_ops_per_sec", 0),
+                "clients": info.get("connected_clients", 0),
+            })
+            try:
+                await asyncio.wait_for(stop.wait(), timeout=1)
+            except asyncio.TimeoutError:
+                pass
+    finally:
+        await client.aclose()
+
+async def workflow_monitor(stats, duration):
+    """到达阶段结束后继续显示进度，直到所有 run 完成"""
+    start = time.time()
+    while stats.is_running:
+        await asyncio.sleep(1)
+        elapsed = time.time() - start
+        depth = stats.redis_samples[-1]["queue_depth"] if stats.redis_samples else "-"
+        phase = f"{elapsed:.0f}s/{duration}s" if elapsed < duration else f"{elapsed:.0f}s drain"
+        print(f"\r[{phase}] Submitted: {stats.total_requests} | Done: {stats.success_count} | Err: {stats.error_count} | "
+              f"In-flight: {stats.inflight} | Queue: {depth} | Status req: {stats.status_requests}", end="")
+
+async def run_workflow_load(args):
+    """工作流负载测试：每个到达率一档，到达阶段 duration 秒，之后等待全部 run 结束"""
+    base = _api_base(args.url)
+    print(f"{Fore.CYAN}🚀 GIBH-AGENT 工作流负载测试 (upload → execute → status)")
+    print(f"目标: {base} | 到达率: {', '.join(str(r) for r in args.rates)} runs/s | 每档 {args.duration}s | "
+          f"数据: {args.cells} 细胞 | 轮询间隔 {args.poll_interval}s")
+    print("-" * 60)
+    print("图例: .成功  x失败/取消/超时  !异常  -客户端丢弃")
+    print("-" * 60)
+
+    datasets = prepare_workflow_datasets(args)
+    summaries = []
+    async with _client(args, args.max_inflight) as client:
+        if not args.upload_each:
+            upload_stats = WorkflowStats()
+            for d in datasets:
+                await upload_dataset(client, upload_stats, base, d["path"], d["name"])
+            print(f"📤 已上传 {len(datasets)} 个数据集 ({sum(upload_stats.upload_latencies) / 1000:.1f}s)")
+
+        for rate in args.rates:
+            stats = WorkflowStats()
+            print(f"\n{Fore.CYAN}▶ 目标到达率 {rate} runs/s")
+            stats.start_time = time.perf_counter()
+            stop = asyncio.Event()
+            sampler = asyncio.create_task(sample_redis(stats, args, stop))
+            monitor_task = asyncio.create_task(workflow_monitor(stats, args.duration))
+            counter = iter(range(10 ** 9))
+            tasks = await arrivals(stats, args, rate, args.duration,
+                                   lambda t: run_workflow(client, stats, args, base,
+                                                          datasets[next(counter) % len(datasets)], t))
+            if tasks:
+                await asyncio.gather(*tasks, return_exceptions=True)
+            stats.is_running = False
+            stop.set()
+            await asyncio.gather(sampler, monitor_task, return_exceptions=True)
+            stats.end_time = time.perf_counter()
+            summary = summarize_workflow(stats, args.duration, rate)
+            print_workflow_report(summary)
+            summaries.append(summary)
+
+    if len(summaries) > 1:
+        print_workflow_sweep(summaries)
+    return summaries
+
+def summarize_workflow(stats, duration, rate):
+    wall = max(stats.end_time - stats.start_time, 1e-9)
+    runs = stats.runs
+    statuses = {}
+    for r in runs:
+        statuses[r["status"]] = statuses.get(r["status"], 0) + 1
+    redis = None
+    if len(stats.redis_samples) > 1:
+        first, last = stats.redis_samples[0], stats.redis_samples[-1]
+        commands = last["commands"] - first["commands"]
+        redis = {
+            "commands": commands,
+            "commands_per_s": commands / max(last["t"] - first["t"], 1e-9),
+            "peak_ops_per_sec": max(s["ops_per_sec"] for s in stats.redis_samples),
+            "max_queue_depth": max(s["queue_depth"] for s in stats.redis_samples),
+            "max_clients": max(s["clients"] for s in stats.redis_samples),
+        }
+    return {
+        "mode": "workflow",
+        "target_rate": rate,
+        "duration_s": duration,
+        "wall_s": wall,
+        "runs": len(runs),
+        "success": stats.success_count,
+        "errors": stats.error_count,
+        "dropped": stats.dropped_count,
+        "statuses": statuses,
+        "max_inflight": stats.max_inflight,
+        "throughput_runs_per_min": stats.success_count / wall * 60,
+        "offered_rps": (stats.total_requests + stats.dropped_count) / duration,
+        "queue_wait_s": percentile_ladder([r["queue_wait_s"] for r in runs if "queue_wait_s" in r]),
+        "exec_s": percentile_ladder([r["exec_s"] for r in runs if "exec_s" in r]),
+        "e2e_s": percentile_ladder([r["e2e_s"] for r in runs if "e2e_s" in r]),
+        "upload_ms": percentile_ladder(stats.upload_latencies),
+        "submit_ms": percentile_ladder(stats.submit_latencies),
+        "status_ms": percentile_ladder(stats.status_latencies),
+        "status_requests": stats.status_requests,
+        "status_not_modified": stats.status_not_modified,
+        "status_requests_per_run": stats.status_requests / len(runs) if runs else 0,
+        "redis": redis,
+        "queue_wait_histogram": histogram([r["queue_wait_s"] * 1000 for r in runs if r.get("queue_wait_s")]),
+        "e2e_histogram": histogram([r["e2e_s"] * 1000 for r in runs if "e2e_s" in r]),
+        "run_records": runs,
+    }
+
+def print_workflow_report(summary):
+    print("\n\n" + "=" * 60)
+    print(f"{Fore.CYAN}📊 工作流负载测试报告 (Workflow Load Report)")
+    print("=" * 60)
+    print(f"📈 目标到达率:    {summary['target_rate']} runs/s (实际发压 {summary['offered_rps']:.3f} runs/s)")
+    print(f"⏱️  实测时长:      {summary['wall_s']:.2f} s (含排空)")
+    print(f"📦 提交 run 数:   {summary['runs']}  最终状态: {summary['statuses']}")
+    print(f"✅ 成功 / ❌ 失败: {Fore.GREEN}{summary['success']}{Style.RESET_ALL} / {Fore.RED}{summary['errors']}")
+    print(f"🚀 完成吞吐:      {Fore.YELLOW}{summary['throughput_runs_per_min']:.2f} runs/min")
+    print(f"🔁 最大在途 run:  {summary['max_inflight']}")
+    print("-" * 60)
+    print_ladder("⏳ 排队等待 (提交 → Worker 开始)", summary["queue_wait_s"], unit="s")
+    print_ladder("⚙️  执行耗时 (Worker 开始 → 结束)", summary["exec_s"], unit="s")
+    print_ladder("🏁 端到端 (计划到达 → 轮询到完成)", summary["e2e_s"], unit="s")
+    print_ladder("📤 上传", summary["upload_ms"])
+    print_ladder("📨 提交 (/api/chat)", summary["submit_ms"])
+    print_ladder("🔍 状态查询", summary["status_ms"])
+    print(f"🔍 状态请求:      {summary['status_requests']} 次 (304: {summary['status_not_modified']}，"
+          f"平均每 run {summary['status_requests_per_run']:.1f} 次)")
+    if summary["redis"]:
+        r = summary["redis"]
+        print(f"🧱 Redis:         {r['commands']} 条命令 ({r['commands_per_s']:.1f}/s，峰值 {r['peak_ops_per_sec']} ops/s) | "
+              f"最大队列深度 {r['max_queue_depth']} | 最大连接数 {r['max_clients']}")
+    print("-" * 60)
+    print_histogram("📊 排队等待分布", summary["queue_wait_histogram"])
+    print_histogram("📊 端到端分布", summary["e2e_histogram"])
+    print("=" * 60)
+
+def print_workflow_sweep(summaries):
+    rows = []
+    for s in summaries:
+        rows.append({
+            "rate": s["target_rate"],
+            "runs/min": round(s["throughput_runs_per_min"], 2),
+            "err": s["errors"] + s["dropped"],
+            "wait_p50": round(s["queue_wait_s"]["p50"], 1) if s["queue_wait_s"] else None,
+            "wait_p99": round(s["queue_wait_s"]["p99"], 1) if s["queue_wait_s"] else None,
+            "exec_p50": round(s["exec_s"]["p50"], 1) if s["exec_s"] else None,
+            "e2e_p99": round(s["e2e_s"]["p99"], 1) if s["e2e_s"] else None,
+            "status_req": s["status_requests"],
+            "max_queue": s["redis"]["max_queue_depth"] if s["redis"] else None,
+        })
+    print(f"\n{Fore.CYAN}📈 到达率扫描汇总 (s)")
+    print(pd.DataFrame(rows).to_string(index=False))
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="GIBH-AGENT 压力测试 (闭环并发 / 开环泊松到达)")
+    parser.add_argument("--mode", choices=["closed", "open"], default="closed",
+                        help="closed: 固定并发循环提问；open: 按目标到达率泊松发压")
+    parser.add_argument("--target", choices=["agent", "llm", "workflow"], default="agent",
+                        help="agent: 压 /api/chat；llm: 直接压 OpenAI 兼容推理接口；"
+                             "workflow: 上传 → 提交工作流 → 轮询状态 (总是按到达率发压)")
+    parser.add_argument("--url", help="覆盖目标地址 (默认 AGENT_URL / LLM_URL)")
+    parser.add_argument("--duration", type=int, default=TEST_DURATION_SEC, help="每档持续时间 (秒)")
+    parser.add_argument("--concurrency", type=int, default=CONCURRENCY, help="闭环并发数")
+    parser.add_argument("--rates", help="开环到达率列表 (req/s)，逗号分隔 (默认 OPEN_LOOP_RATES / WORKFLOW_RATES)")
+    parser.add_argument("--max-inflight", type=int, default=MAX_INFLIGHT, help="开环在途请求上限")
+    parser.add_argument("--sample-rate", type=float, default=SAMPLE_RATE, help="AI Doctor 抽检率，0 关闭评分")
+    parser.add_argument("--judge-url", default=JUDGE_URL, help="评分模型地址 (可指向 mock_llm_server.py)")
+    parser.add_argument("--timeout", type=float, default=120.0, help="单请求超时 (秒)")
+    parser.add_argument("--seed", type=int, help="到达过程随机种子")
+    parser.add_argument("--out", help="把汇总 (含百分位与直方图) 写入 JSON")
+    parser.add_argument("--cells", default=WORKFLOW_CELLS, help="[workflow] 合成数据集规模，逗号分隔")
+    parser.add_argument("--data-dir", default=WORKFLOW_DATA_DIR, help="[workflow] 合成数据缓存目录")
+    parser.add_argument("--upload-each", action="store_true", help="[workflow] 每个 run 单独上传一份数据 (默认只上传一次)")
+    parser.add_argument("--poll-interval", type=float, default=POLL_INTERVAL, help="[workflow] 状态轮询间隔 (秒)")
+    parser.add_argument("--workflow-timeout", type=float, default=WORKFLOW_TIMEOUT, help="[workflow] 单个 run 最长等待 (秒)")
+    parser.add_argument("--redis-url", default=REDIS_URL, help="[workflow] 采样队列深度 / 命令数的 Redis 地址")
+    args = parser.parse_args()
+    args.url = args.url or (LLM_URL if args.target == "llm" else AGENT_URL)
+    if args.rates:
+        args.rates = [float(r) for r in args.rates.split(",") if r.strip()]
+    else:
+        args.rates = WORKFLOW_RATES if args.target == "workflow" else OPEN_LOOP_RATES
+    return args
+
 if __name__ == "__main__":
-    asyncio.run(run_stress_test())
+    args = parse_args()
+    if args.target == "workflow":
+        runner = run_workflow_load
+    else:
+        runner = run_open_loop if args.mode == "open" else run_stress_test
+    summaries = asyncio.run(runner(args))
+    if args.out:
+        with open(args.out, "w", encoding="utf-8") as f:
+            json.dump({"time": datetime.now().isoformat(timespec="seconds"), "args": vars(args),
+                       "runs": summaries}, f, ensure_ascii=False, indent=2)
+        print(f"📄 结果已写入 {args.out}")
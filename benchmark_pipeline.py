@@ -0,0 +1,280 @@
+import os
+import sys
+import json
+import time
+import argparse
+import platform
+import subprocess
+import multiprocessing
+from datetime import datetime
+
+import numpy as np
+import scipy.sparse as sp
+from colorama import Fore, Style, init
+
+# Scanpy 流程规模基准：合成稀疏计数矩阵 -> LocalSingleCellPipeline.run_pipeline 逐步计时
+# 完全离线运行 (不访问 vLLM / Redis / Celery)
+#
+#   python benchmark_pipeline.py --scales 10k,100k --out bench.json
+#   python benchmark_pipeline.py --scales 10k,100k --baseline bench_baseline.json   # 与基线对比，回归时退出码为 1
+
+init(autoreset=True)
+
+ROOT = os.path.dirname(os.path.abspath(__file__))
+API_DIR = os.path.join(ROOT, "services", "api")
+
+# ================= ⚙️ 基准配置区域 =================
+DEFAULT_SCALES = "10k,100k,500k,1m"
+N_GENES = 20000             # 基因数 (前 13 个为线粒体基因，让 QC 有东西可过滤)
+GENES_PER_CELL = 1000       # 每个细胞平均检测到的基因数 (非零元素数)
+N_CLUSTERS = 12             # 合成数据里的细胞类型数
+CHUNK_CELLS = 50000         # 分块生成，控制峰值内存
+
+# 回归判定：相对变化超过阈值且绝对变化超过下限才算回归 (避免小步骤的计时噪声)
+TIME_TOLERANCE = 0.20
+TIME_MIN_DELTA = 1.0        # 秒
+MEM_TOLERANCE = 0.20
+MEM_MIN_DELTA = 200         # MB
+# ===============================================
+
+
+def parse_scale(text: str) -> int:
+    text = text.strip().lower()
+    factor = {"k": 1_000, "m": 1_000_000}.get(text[-1:], 1)
+    return int(float(text[:-1] if factor > 1 else text) * factor)
+
+
+def make_synthetic(n_cells: int, n_genes: int = N_GENES, genes_per_cell: int = GENES_PER_CELL,
+                   n_clusters: int = N_CLUSTERS, seed: int = 0):
+    """
+    合成 scRNA-seq 计数矩阵 (CSR, float32)
+    每个细胞类型有自己的基因表达谱 (Dirichlet)，细胞按所属类型的谱抽取基因，计数服从几何分布
+    """
+    import anndata as ad
+    import pandas as pd
+
+    rng = np.random.default_rng(seed)
+    profiles = rng.dirichlet(np.full(n_genes, 0.05), size=n_clusters)
+    # 共享的背景表达 (管家基因) + 类型特异表达
+    background = rng.dirichlet(np.full(n_genes, 0.5))
+    profiles = 0.6 * background + 0.4 * profiles
+    labels = rng.integers(0, n_clusters, size=n_cells)
+
+    blocks = []
+    for start in range(0, n_cells, CHUNK_CELLS):
+        stop = min(start + CHUNK_CELLS, n_cells)
+        m = stop - start
+        depth = np.maximum(rng.poisson(genes_per_cell, size=m), 50)
+        rows = np.repeat(np.arange(m), depth)
+        cols = np.empty(rows.size, dtype=np.int64)
+        row_labels = labels[start:stop][rows]
+        for c in range(n_clusters):
+            mask = row_labels == c
+            cols[mask] = rng.choice(n_genes, size=int(mask.sum()), p=profiles[c])
+        data = rng.geometric(0.5, size=rows.size).astype(np.float32)
+        # 重复抽到的基因在转换为 CSR 时自动累加
+        blocks.append(sp.csr_matrix((data, (rows, cols)), shape=(m, n_genes), dtype=np.float32))
+
+    X = sp.vstack(blocks, format="csr")
+    gene_names = [f"MT-G{i}" for i in range(13)] + [f"G{i}" for i in range(13, n_genes)]
+    obs = pd.DataFrame({"true_type": pd.Categorical(labels.astype(str))},
+                       index=[f"cell{i}" for i in range(n_cells)])
+    return ad.AnnData(X=X, obs=obs, var=pd.DataFrame(index=gene_names))
+
+
+def dataset_path(data_dir: str, n_cells: int, seed: int) -> str:
+    return os.path.join(data_dir, f"synthetic_{n_cells}_{N_GENES}_{GENES_PER_CELL}_{seed}.h5ad")
+
+
+def ensure_dataset(data_dir: str, n_cells: int, seed: int):
+    """生成 (或复用已缓存的) 合成数据集，返回 (路径, 生成耗时)"""
+    path = dataset_path(data_dir, n_cells, seed)
+    if os.path.exists(path):
+        return path, 0.0
+    os.makedirs(data_dir, exist_ok=True)
+    t0 = time.perf_counter()
+    adata = make_synthetic(n_cells, seed=seed)
+    tmp = f"{path[:-5]}.tmp.h5ad"
+    adata.write_h5ad(tmp)
+    os.replace(tmp, path)
+    return path, round(time.perf_counter() - t0, 3)
+
+
+def build_steps(data_path: str, render_png: bool, use_planner: bool):
+    """与线上一致：标准模板 + 规划器按规模选择的算法变体"""
+    sys.path.insert(0, API_DIR)
+    from src.skills.scanpy_local import META
+    from src.planner import WorkflowPlanner
+    from src.datasets import read_metadata
+
+    steps = json.loads(json.dumps(META["template"]["steps"]))
+    params = WorkflowPlanner.choose(read_metadata(data_path)) if use_planner else {}
+    if not render_png:
+        params["render_png"] = "false"
+    for step in steps:
+        for key in step["params"]:
+            if key in params:
+                step["params"][key] = params[key]
+    return steps, params
+
+
+def _run_scale(data_path: str, render_png: bool, use_planner: bool, fused: bool, queue):
+    """子进程入口：每个规模单独一个进程，峰值 RSS 互不影响"""
+    import tempfile
+    sys.path.insert(0, API_DIR)
+    from src.scrna_analysis import LocalSingleCellPipeline
+
+    steps, params = build_steps(data_path, render_png, use_planner)
+    with tempfile.TemporaryDirectory(prefix="gibh_bench_") as tmp:
+        pipeline = LocalSingleCellPipeline(output_dir=os.path.join(tmp, "results"), run_dir=os.path.join(tmp, "run"),
+                                           run_url="/bench", fused=fused)
+        t0 = time.perf_counter()
+        report = pipeline.run_pipeline(data_path, steps)
+        total = time.perf_counter() - t0
+    queue.put({
+        "status": report["status"],
+        "error": report.get("error"),
+        "params": params,
+        "total_seconds": round(total, 3),
+        "timings": report.get("timings", {}),
+        "qc_metrics": report.get("qc_metrics", {}),
+        "steps": [{k: step.get(k) for k in ("name", "status", "variant", "fused", "elapsed", "peak_mb", "shape")}
+                  for step in report["steps_details"]],
+    })
+
+
+def run_scale(data_path: str, render_png: bool, use_planner: bool, fused: bool = True) -> dict:
+    ctx = multiprocessing.get_context("spawn")
+    queue = ctx.Queue()
+    proc = ctx.Process(target=_run_scale, args=(data_path, render_png, use_planner, fused, queue))
+    proc.start()
+    result = None
+    while proc.is_alive() or not queue.empty():
+        try:
+            result = queue.get(timeout=1)
+            break
+        except Exception:
+            continue
+    proc.join()
+    if result is None:
+        # 多半是被 OOM killer 杀掉
+        result = {"status": "crashed", "error": f"exit code {proc.exitcode}", "steps": []}
+    result["peak_mb"] = max((s.get("peak_mb") or 0 for s in result["steps"]), default=0)
+    return result
+
+
+def environment() -> dict:
+    try:
+        commit = subprocess.check_output(["git", "rev-parse", "--short", "HEAD"], cwd=ROOT,
+                                         stderr=subprocess.DEVNULL, text=True).strip()
+    except Exception:
+        commit = None
+    versions = {}
+    for module in ("scanpy", "anndata", "numpy", "scipy"):
+        try:
+            from importlib.metadata import version
+            versions[module] = version(module)
+        except Exception:
+            versions[module] = None
+    return {
+        "timestamp": datetime.now().isoformat(timespec="seconds"),
+        "host": platform.node(),
+        "python": platform.python_version(),
+        "cpu_count": os.cpu_count(),
+        "git_commit": commit,
+        "versions": versions,
+        "config": {"n_genes": N_GENES, "genes_per_cell": GENES_PER_CELL, "n_clusters": N_CLUSTERS},
+    }
+
+
+def compare(current: dict, baseline: dict) -> list:
+    """逐规模、逐步骤与基线对比，返回回归列表"""
+    regressions = []
+    base_by_scale = {r["n_cells"]: r for r in baseline.get("results", [])}
+    for result in current["results"]:
+        base = base_by_scale.get(result["n_cells"])
+        if base is None:
+            continue
+        if result["status"] != "success" and base.get("status") == "success":
+            regressions.append({"n_cells": result["n_cells"], "step": "*", "metric": "status",
+                                "baseline": base["status"], "current": result["status"]})
+            continue
+        base_steps = {s["name"]: s for s in base.get("steps", [])}
+        pairs = [("total", {"elapsed": base.get("total_seconds"), "peak_mb": base.get("peak_mb")},
+                  {"elapsed": result.get("total_seconds"), "peak_mb": result.get("peak_mb")})]
+        pairs += [(s["name"], base_steps[s["name"]], s) for s in result["steps"] if s["name"] in base_steps]
+        for name, old, new in pairs:
+            for metric, tol, min_delta in (("elapsed", TIME_TOLERANCE, TIME_MIN_DELTA),
+                                           ("peak_mb", MEM_TOLERANCE, MEM_MIN_DELTA)):
+                a, b = old.get(metric), new.get(metric)
+                if not a or b is None:
+                    continue
+                if b > a * (1 + tol) and b - a > min_delta:
+                    regressions.append({"n_cells": result["n_cells"], "step": name, "metric": metric,
+                                        "baseline": a, "current": b, "ratio": round(b / a, 3)})
+    return regressions
+
+
+def print_result(result: dict):
+    color = Fore.GREEN if result["status"] == "success" else Fore.RED
+    print(f"{color}{Style.BRIGHT}▶ {result['n_cells']:,} cells  {result['status']}  "
+          f"total {result.get('total_seconds', 0):.1f}s  peak {result.get('peak_mb', 0):.0f}MB")
+    if result.get("error"):
+        print(f"{Fore.RED}  {result['error']}")
+    print(f"  {'step':<18}{'variant':<12}{'seconds':>10}{'peak MB':>10}   shape")
+    for step in result["steps"]:
+        shape = "x".join(map(str, step.get("shape") or []))
+        variant = step.get('variant') or ("fused" if step.get("fused") else "")
+        print(f"  {step['name']:<18}{variant:<12}{step.get('elapsed') or 0:>10.2f}"
+              f"{step.get('peak_mb') or 0:>10.0f}   {shape}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Scanpy pipeline scaling benchmark (offline)")
+    parser.add_argument("--scales", default=DEFAULT_SCALES, help="逗号分隔的细胞数，如 10k,100k,1m")
+    parser.add_argument("--data-dir", default=os.path.join(ROOT, "data", "benchmark"), help="合成数据缓存目录")
+    parser.add_argument("--out", default=None, help="结果 JSON 路径 (默认 bench_<时间戳>.json)")
+    parser.add_argument("--baseline", default=None, help="与该基线 JSON 对比，有回归时退出码为 1")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--render-png", action="store_true", help="同时计入 UMAP / t-SNE 出图耗时")
+    parser.add_argument("--no-planner", action="store_true", help="不使用规划器选择的算法变体，直接跑模板默认参数")
+    parser.add_argument("--no-fused", action="store_true", help="关闭融合预处理，QC / LogNormalize / HVG 逐步调用 scanpy")
+    args = parser.parse_args()
+
+    scales = [parse_scale(s) for s in args.scales.split(",") if s.strip()]
+    output = {"meta": {**environment(), "fused": not args.no_fused}, "results": []}
+    out_path = args.out or f"bench_{datetime.now().strftime('%Y%m%d_%H%M%S')}.json"
+
+    for n_cells in scales:
+        print(f"{Fore.CYAN}⏳ 准备 {n_cells:,} 细胞的合成数据...")
+        data_path, gen_seconds = ensure_dataset(args.data_dir, n_cells, args.seed)
+        result = run_scale(data_path, args.render_png, not args.no_planner, fused=not args.no_fused)
+        result.update({"n_cells": n_cells, "dataset": os.path.basename(data_path), "generate_seconds": gen_seconds})
+        output["results"].append(result)
+        print_result(result)
+        # 每个规模跑完就落盘，大规模中途崩溃也不丢前面的结果
+        with open(out_path, "w", encoding="utf-8") as f:
+            json.dump(output, f, ensure_ascii=False, indent=2)
+
+    print(f"\n📄 结果已写入 {out_path}")
+
+    if args.baseline:
+        with open(args.baseline, encoding="utf-8") as f:
+            baseline = json.load(f)
+        regressions = compare(output, baseline)
+        output["comparison"] = {"baseline": args.baseline, "regressions": regressions}
+        with open(out_path, "w", encoding="utf-8") as f:
+            json.dump(output, f, ensure_ascii=False, indent=2)
+        if not regressions:
+            print(f"{Fore.GREEN}✅ 与基线相比无回归")
+            return 0
+        print(f"{Fore.RED}{Style.BRIGHT}❌ 发现 {len(regressions)} 项回归:")
+        for r in regressions:
+            print(f"{Fore.RED}  {r['n_cells']:>9,}  {r['step']:<18}{r['metric']:<9}"
+                  f"{r['baseline']} -> {r['current']}" + (f"  (x{r['ratio']})" if "ratio" in r else ""))
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
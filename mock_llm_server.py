@@ -0,0 +1,246 @@
+import argparse
+import asyncio
+import json
+import os
+import random
+import time
+import uuid
+
+from fastapi import FastAPI, Request
+from fastapi.responses import JSONResponse, StreamingResponse
+
+# ================= 🧪 离线 OpenAI 兼容模拟推理服务 =================
+# 不需要 GPU：按配置的首字延迟 / 逐 token 延迟流式吐出随机文本，用来单独测 API 层 (FastAPI / 准入 / 会话) 的容量。
+#
+#   python mock_llm_server.py --port 8000 --itl-ms 20 --max-concurrency 32
+#   VLLM_URL=http://localhost:8000/v1 启动 api 服务后，再用 benchmark.py 压测
+#
+# 延迟模型 (近似 vLLM 连续批处理)：
+#   - 同时解码的请求数不超过 max_concurrency，其余在服务端排队，排队时间计入首字延迟
+#   - 首字延迟 = ttft_ms + prefill_ms_per_1k × prompt_tokens / 1000
+#   - 逐 token 延迟 = itl_ms + itl_per_seq_ms × 当前解码中的请求数，再乘以 ±itl_jitter 的随机扰动
+# 评分请求 (prompt 里要求返回 score JSON) 返回随机分数，benchmark.py 的 AI Doctor 抽检可以离线跑通。
+# ===============================================================
+
+# 随机回复用的词表 (每个词算 1 个 token)
+VOCAB = [
+    "单细胞", "测序", "数据", "中", "的", "基因", "表达", "矩阵", "细胞", "聚类", "分析", "，", "。",
+    "Scanpy", " UMAP", " PCA", " Leiden", " HVG", " QC", "标准化", "批次", "效应", "标记", "基因",
+    "线粒体", "比例", "过滤", "降维", "邻居", "图", "可视化", "结果", "表明", "通常", "需要", "首先",
+    " the", " cell", " gene", " cluster", " marker", " expression", "\n",
+]
+
+
+def _option(args, name: str, default, cast=float):
+    # 命令行参数优先，其次环境变量 MOCK_<NAME>，最后默认值
+    value = getattr(args, name, None)
+    if value is None:
+        value = os.getenv(f"MOCK_{name.upper()}", default)
+    return cast(value) if value is not None else None
+
+
+class MockConfig:
+    def __init__(self, args=None):
+        self.model = _option(args, "model", "qwen3-vl", str)
+        self.ttft_ms = _option(args, "ttft_ms", 80)
+        self.prefill_ms_per_1k = _option(args, "prefill_ms_per_1k", 20)
+        self.itl_ms = _option(args, "itl_ms", 20)
+        self.itl_per_seq_ms = _option(args, "itl_per_seq_ms", 0.3)
+        self.itl_jitter = _option(args, "itl_jitter", 0.2)
+        self.output_tokens = _option(args, "output_tokens", 256, int)
+        self.max_concurrency = _option(args, "max_concurrency", 32, int)
+        # 服务端排队上限 (0 = 不限)；超过时直接返回 429，模拟网关限流
+        self.max_queue = _option(args, "max_queue", 0, int)
+        self.seed = _option(args, "seed", None, int)
+
+
+class MockEngine:
+    def __init__(self, config: MockConfig):
+        self.config = config
+        self.rng = random.Random(config.seed)
+        self.slots = asyncio.Semaphore(config.max_concurrency)
+        self.active = 0
+        self.waiting = 0
+        self.served = 0
+        self.rejected = 0
+        self.tokens_out = 0
+        self.started = time.time()
+
+    # ---------- 请求解析 ----------
+    @staticmethod
+    def _prompt_text(body: dict) -> str:
+        parts = []
+        for msg in body.get("messages", []):
+            content = msg.get("content", "")
+            if isinstance(content, list):
+                content = " ".join(c.get("text", "") for c in content if isinstance(c, dict))
+            parts.append(str(content))
+        return "\n".join(parts)
+
+    @staticmethod
+    def prompt_tokens(text: str) -> int:
+        # 粗略估算：中文约 1 字 / token，英文约 4 字符 / token
+        ascii_chars = sum(1 for ch in text if ord(ch) < 128)
+        return max(1, (len(text) - ascii_chars) + ascii_chars // 4)
+
+    def _output_len(self, body: dict) -> int:
+        n = max(1, int(self.rng.uniform(0.5, 1.5) * self.config.output_tokens))
+        limit = body.get("max_tokens") or body.get("max_completion_tokens")
+        return min(n, int(limit)) if limit else n
+
+    def _judge_reply(self, text: str):
+        # benchmark.py 的 AI Doctor 评分请求
+        if '"score"' not in text:
+            return None
+        return json.dumps({"score": round(self.rng.uniform(6, 10), 1), "reason": "mock judge"}, ensure_ascii=False)
+
+    # ---------- 延迟 ----------
+    def _itl(self) -> float:
+        c = self.config
+        base = c.itl_ms + c.itl_per_seq_ms * self.active
+        return max(0.0, base * (1 + self.rng.uniform(-c.itl_jitter, c.itl_jitter))) / 1000
+
+    async def _acquire(self):
+        self.waiting += 1
+        try:
+            await self.slots.acquire()
+        finally:
+            self.waiting -= 1
+        self.active += 1
+
+    def _release(self):
+        self.active -= 1
+        self.slots.release()
+
+    def overloaded(self) -> bool:
+        return bool(self.config.max_queue) and self.waiting >= self.config.max_queue
+
+    async def generate(self, body: dict):
+        """逐 token 产出 (token 文本)；调用方负责按 OpenAI 格式封装"""
+        text = self._prompt_text(body)
+        n_prompt = self.prompt_tokens(text)
+        judge = self._judge_reply(text)
+        tokens = [judge] if judge else [self.rng.choice(VOCAB) for _ in range(self._output_len(body))]
+
+        await self._acquire()
+        try:
+            await asyncio.sleep((self.config.ttft_ms + self.config.prefill_ms_per_1k * n_prompt / 1000) / 1000)
+            for i, token in enumerate(tokens):
+                if i:
+                    await asyncio.sleep(self._itl())
+                self.tokens_out += 1
+                yield token
+            self.served += 1
+        finally:
+            self._release()
+
+    def stats(self) -> dict:
+        uptime = time.time() - self.started
+        return {
+            "active": self.active,
+            "waiting": self.waiting,
+            "served": self.served,
+            "rejected": self.rejected,
+            "tokens_out": self.tokens_out,
+            "uptime_s": round(uptime, 1),
+            "tokens_per_s": round(self.tokens_out / uptime, 1) if uptime > 0 else 0,
+            "config": vars(self.config),
+        }
+
+
+def create_app(config: MockConfig) -> FastAPI:
+    app = FastAPI(title="Mock OpenAI-compatible LLM")
+    engine = MockEngine(config)
+    app.state.engine = engine
+
+    @app.get("/v1/models")
+    async def list_models():
+        return {"object": "list", "data": [{"id": config.model, "object": "model", "owned_by": "mock"}]}
+
+    @app.get("/stats")
+    async def server_stats():
+        return engine.stats()
+
+    @app.post("/v1/chat/completions")
+    async def chat_completions(request: Request):
+        body = await request.json()
+        if engine.overloaded():
+            engine.rejected += 1
+            return JSONResponse(status_code=429, content={"error": {"message": "mock server queue full", "type": "rate_limit"}})
+
+        completion_id = f"chatcmpl-{uuid.uuid4().hex[:24]}"
+        created = int(time.time())
+        model = body.get("model") or config.model
+        n_prompt = engine.prompt_tokens(engine._prompt_text(body))
+
+        if not body.get("stream"):
+            tokens = [t async for t in engine.generate(body)]
+            content = "".join(tokens)
+            return {
+                "id": completion_id,
+                "object": "chat.completion",
+                "created": created,
+                "model": model,
+                "choices": [{"index": 0, "message": {"role": "assistant", "content": content}, "finish_reason": "stop"}],
+                "usage": {"prompt_tokens": n_prompt, "completion_tokens": len(tokens),
+                          "total_tokens": n_prompt + len(tokens)},
+            }
+
+        include_usage = bool((body.get("stream_options") or {}).get("include_usage"))
+
+        def _chunk(delta: dict, finish_reason=None, usage=None) -> str:
+            payload = {
+                "id": completion_id,
+                "object": "chat.completion.chunk",
+                "created": created,
+                "model": model,
+                "choices": [{"index": 0, "delta": delta, "finish_reason": finish_reason}] if usage is None else [],
+            }
+            if usage is not None:
+                payload["usage"] = usage
+            return f"data: {json.dumps(payload, ensure_ascii=False)}\n\n"
+
+        async def event_stream():
+            n_out = 0
+            first = True
+            async for token in engine.generate(body):
+                delta = {"role": "assistant", "content": token} if first else {"content": token}
+                first = False
+                n_out += 1
+                yield _chunk(delta)
+            yield _chunk({}, finish_reason="stop")
+            if include_usage:
+                yield _chunk({}, usage={"prompt_tokens": n_prompt, "completion_tokens": n_out,
+                                        "total_tokens": n_prompt + n_out})
+            yield "data: [DONE]\n\n"
+
+        return StreamingResponse(event_stream(), media_type="text/event-stream")
+
+    return app
+
+
+def main():
+    parser = argparse.ArgumentParser(description="离线 OpenAI 兼容模拟推理服务 (压测 API 层用)")
+    parser.add_argument("--host", default="0.0.0.0")
+    parser.add_argument("--port", type=int, default=8000)
+    parser.add_argument("--model", help="模型名 (默认 qwen3-vl)")
+    parser.add_argument("--ttft-ms", type=float, help="基础首字延迟 (默认 80)")
+    parser.add_argument("--prefill-ms-per-1k", type=float, help="每 1k prompt token 额外的预填充耗时 (默认 20)")
+    parser.add_argument("--itl-ms", type=float, help="基础逐 token 延迟 (默认 20)")
+    parser.add_argument("--itl-per-seq-ms", type=float, help="每个并发解码请求增加的逐 token 延迟 (默认 0.3)")
+    parser.add_argument("--itl-jitter", type=float, help="逐 token 延迟的相对随机扰动 (默认 0.2)")
+    parser.add_argument("--output-tokens", type=int, help="平均输出 token 数 (默认 256，实际在 0.5x~1.5x 间均匀分布)")
+    parser.add_argument("--max-concurrency", type=int, help="同时解码的最大请求数 (默认 32)")
+    parser.add_argument("--max-queue", type=int, help="服务端排队上限，超过返回 429 (默认 0 = 不限)")
+    parser.add_argument("--seed", type=int)
+    args = parser.parse_args()
+
+    import uvicorn
+    config = MockConfig(args)
+    print(f"🧪 Mock LLM: http://{args.host}:{args.port}/v1  model={config.model} "
+          f"ttft={config.ttft_ms}ms itl={config.itl_ms}ms max_concurrency={config.max_concurrency}")
+    uvicorn.run(create_app(config), host=args.host, port=args.port, log_level="warning")
+
+
+if __name__ == "__main__":
+    main()
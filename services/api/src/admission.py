@@ -0,0 +1,222 @@
+import math
+import time
+import asyncio
+from collections import deque
+from typing import Dict, Optional
+
+
+class AdmissionRejected(Exception):
+    """准入被拒绝 (映射为 HTTP 429 + Retry-After)"""
+
+    def __init__(self, reason: str, retry_after: float):
+        super().__init__(reason)
+        self.reason = reason
+        self.retry_after = max(1, int(math.ceil(retry_after)))
+
+
+class TokenBucket:
+    """经典令牌桶：rate 个/秒 补充，最多积攒 capacity 个"""
+
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+
+    def try_acquire(self, now: Optional[float] = None) -> float:
+        """拿到令牌返回 0，否则返回需要等待的秒数"""
+        now = now if now is not None else time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return 0.0
+        return (1 - self.tokens) / self.rate if self.rate > 0 else 60.0
+
+
+class AdmissionTicket:
+    """一次已准入的对话，流结束时必须 release"""
+
+    def __init__(self, controller: "AdmissionController", client_id: str, wait_seconds: float):
+        self.controller = controller
+        self.client_id = client_id
+        self.wait_seconds = wait_seconds
+        self.started = time.monotonic()
+        self._released = False
+
+    def release(self):
+        if self._released:
+            return
+        self._released = True
+        self.controller._release(self.client_id, time.monotonic() - self.started)
+
+    def __del__(self):
+        # 兜底：客户端在响应体开始发送前断开时，包装生成器从未启动、其 finally 不会执行，
+        # 持有 ticket 的对象被回收时归还槽位
+        if not self._released:
+            self.release()
+
+
+class AdmissionController:
+    """
+    /api/chat 的准入控制层 (LLM 饱和时的背压)
+    - 全局并发上限 max_active，超出的请求进入有界等待队列 (max_queue)
+    - 每个客户端同时最多 per_client 个对话 (含排队中)
+    - 每个客户端一个令牌桶限速
+    - 预估排队时间超过 max_wait 时直接 429，宁可快速拒绝也不让所有人一起变慢
+    """
+
+    def __init__(self, max_active: int, max_queue: int, per_client: int,
+                 rate_per_sec: float, burst: int, max_wait: float, max_clients: int = 10000):
+        self.max_active = max_active
+        self.max_queue = max_queue
+        self.per_client = per_client
+        self.rate_per_sec = rate_per_sec
+        self.burst = burst
+        self.max_wait = max_wait
+        self.max_clients = max_clients
+
+        self._slots = asyncio.Semaphore(max_active)
+        self._active = 0
+        self._waiting = 0
+        self._per_client: Dict[str, int] = {}
+        self._buckets: Dict[str, TokenBucket] = {}
+
+        # 服务时长的指数滑动平均 (秒)，用于预估排队时间；初值取一个保守的流式对话时长
+        self._ewma_service = 20.0
+        self._recent_waits = deque(maxlen=512)
+        self._counters = {"admitted": 0, "completed": 0, "rejected_rate": 0,
+                          "rejected_client": 0, "rejected_queue": 0, "rejected_wait": 0,
+                          "rejected_timeout": 0}
+
+    def projected_wait(self) -> float:
+        """按当前排队深度预估新请求的等待时间"""
+        if self._active < self.max_active:
+            return 0.0
+        return (self._waiting + 1) * self._ewma_service / self.max_active
+
+    def _bucket(self, client_id: str) -> TokenBucket:
+        bucket = self._buckets.get(client_id)
+        if bucket is None:
+            if len(self._buckets) >= self.max_clients:
+                # 简单淘汰：丢掉已经攒满令牌 (长期空闲) 的客户端
+                now = time.monotonic()
+                for key in [k for k, b in self._buckets.items()
+                            if b.tokens + (now - b.updated) * b.rate >= b.capacity]:
+                    del self._buckets[key]
+            bucket = TokenBucket(self.rate_per_sec, self.burst)
+            self._buckets[client_id] = bucket
+        return bucket
+
+    def _reject(self, reason: str, retry_after: float):
+        self._counters[f"rejected_{reason}"] += 1
+        raise AdmissionRejected(reason, retry_after)
+
+    async def acquire(self, client_id: str) -> AdmissionTicket:
+        # 先检查并发 / 队列限制，最后才扣令牌：因其它原因被拒绝的请求不消耗限速额度
+        if self._per_client.get(client_id, 0) >= self.per_client:
+            self._reject("client", self._ewma_service)
+
+        if self._active >= self.max_active:
+            if self._waiting >= self.max_queue:
+                self._reject("queue", self.projected_wait())
+            projected = self.projected_wait()
+            if projected > self.max_wait:
+                self._reject("wait", projected)
+
+        wait_for_token = self._bucket(client_id).try_acquire()
+        if wait_for_token > 0:
+            self._reject("rate", wait_for_token)
+
+        self._per_client[client_id] = self._per_client.get(client_id, 0) + 1
+        self._waiting += 1
+        start = time.monotonic()
+        try:
+            acquired = await self._acquire_slot(self.max_wait)
+        except BaseException:
+            self._dec_client(client_id)
+            raise
+        finally:
+            self._waiting -= 1
+        if not acquired:
+            self._dec_client(client_id)
+            self._reject("timeout", self.projected_wait())
+
+        waited = time.monotonic() - start
+        self._active += 1
+        self._counters["admitted"] += 1
+        self._recent_waits.append(waited)
+        return AdmissionTicket(self, client_id, waited)
+
+    async def _acquire_slot(self, timeout: float) -> bool:
+        """
+        限时获取并发槽位；超时或被取消时保证不泄漏槽位
+        (不用 asyncio.wait_for：3.11 上它可能在 acquire 已经成功后仍抛出 TimeoutError)
+        """
+        task = asyncio.ensure_future(self._slots.acquire())
+        try:
+            done, _ = await asyncio.wait({task}, timeout=timeout)
+        except BaseException:
+            self._abandon(task)
+            raise
+        if done:
+            return True
+        self._abandon(task)
+        return False
+
+    def _abandon(self, task: asyncio.Future):
+        """放弃排队中的 acquire：已经拿到的槽位 (与取消竞争时可能发生) 立即归还"""
+        def give_back(t):
+            if not t.cancelled() and t.exception() is None:
+                self._slots.release()
+
+        if task.done():
+            give_back(task)
+        else:
+            task.cancel()
+            task.add_done_callback(give_back)
+
+    def _dec_client(self, client_id: str):
+        left = self._per_client.get(client_id, 0) - 1
+        if left > 0:
+            self._per_client[client_id] = left
+        else:
+            self._per_client.pop(client_id, None)
+
+    def _release(self, client_id: str, service_seconds: float):
+        self._active -= 1
+        self._counters["completed"] += 1
+        self._dec_client(client_id)
+        self._ewma_service = 0.8 * self._ewma_service + 0.2 * service_seconds
+        self._slots.release()
+
+    def snapshot(self) -> dict:
+        """导出队列深度、等待时间等指标"""
+        waits = sorted(self._recent_waits)
+
+        def pct(p):
+            if not waits:
+                return 0.0
+            return round(waits[min(len(waits) - 1, int(p * len(waits)))], 4)
+
+        return {
+            "active": self._active,
+            "queue_depth": self._waiting,
+            "max_active": self.max_active,
+            "max_queue": self.max_queue,
+            "projected_wait_s": round(self.projected_wait(), 3),
+            "ewma_service_s": round(self._ewma_service, 3),
+            "wait_s": {"p50": pct(0.50), "p90": pct(0.90), "p99": pct(0.99),
+                       "max": round(waits[-1], 4) if waits else 0.0},
+            "clients": len(self._per_client),
+            **self._counters,
+        }
+
+
+async def guarded_stream(stream, ticket: AdmissionTicket):
+    """包装流式生成器：无论正常结束、异常还是客户端断开，都归还并发槽位"""
+    try:
+        async for chunk in stream:
+            yield chunk
+    finally:
+        ticket.release()
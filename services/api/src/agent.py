@@ -1,13 +1,38 @@
-import json
 import asyncio
 from typing import AsyncGenerator, Union
 from langchain_openai import ChatOpenAI
-from langchain_core.prompts import ChatPromptTemplate, SystemMessagePromptTemplate, HumanMessagePromptTemplate
-from langchain_core.messages import HumanMessage, SystemMessage
 from .config import settings
+from .context_builder import ContextBuilder, PromptContext
+from .datasets import resolve_input, resolve_samples
+from .planner import WorkflowPlanner
+from .intent_router import IntentRouter, RUN_ID_PATTERN, MAPPING
+from .tracing import span, inject
+
+
+class ChatStream:
+    """
+    流式对话结果：可直接 async for 迭代，同时携带本次 prompt 的 token 统计
+    (main.py 通过 __aiter__ 判断是否为流式返回)
+    """
+
+    def __init__(self, generator: AsyncGenerator[str, None], context: PromptContext):
+        self._generator = generator
+        self.context = context
+        self.prompt_tokens = context.prompt_tokens
+
+    def __aiter__(self):
+        return self._generator.__aiter__()
+
+    async def aclose(self):
+        await self._generator.aclose()
+
+
+# 本地路由卡片上展示的步骤名
+_ACTION_LABELS = {"set_params": "调整参数后重新运行", "redraw": "重新出图", "rerun": "重新运行", "run": "运行分析"}
+
 
 class BioBlendAgent:
-    def __init__(self):
+    def __init__(self, skill_metas: list = None):
         # 连接到 vLLM (RTX 6000)
         self.llm = ChatOpenAI(
             model=settings.LLM_MODEL,
@@ -17,26 +42,78 @@ class BioBlendAgent:
             max_tokens=4096,
             streaming=True
         )
+        self.context_builder = ContextBuilder(
+            history_budget=settings.CHAT_HISTORY_TOKEN_BUDGET,
+            summary_budget=settings.CHAT_SUMMARY_TOKEN_BUDGET,
+        )
+        self.planner = WorkflowPlanner(settings.COST_HISTORY_PATH, fused=settings.FUSED_PREPROCESS)
+        # 本地意图路由 (由技能 META 构建；关闭时只保留原有关键词规则)
+        self.router = IntentRouter(skill_metas or [], threshold=settings.INTENT_ROUTER_THRESHOLD,
+                                   enabled=settings.INTENT_ROUTER_ENABLED)
 
-    async def process_query(self, query: str, history: list, uploaded_files: list = None) -> Union[dict, AsyncGenerator]:
+    async def process_query(self, query: str, history: list, uploaded_files: list = None,
+                            summary: str = "") -> Union[dict, AsyncGenerator]:
         """
         智能处理入口
         """
         query_text = query.lower().strip()
-        
-        # 1. 显式意图识别
-        if any(k in query_text for k in ["规划", "流程", "workflow", "pipeline"]):
-            return self._generate_workflow_config(query, uploaded_files)
+
+        # 1. 显式意图识别：原有关键词规则 + 本地意图路由 (命令式消息直接生成卡片，不调用大模型)
+        with span("agent.route") as s:
+            decision = self.router.route(query_text)
+            s.set_attributes({"intent": decision.intent, "method": decision.method,
+                              "confidence": round(decision.confidence, 4), "latency_us": round(decision.latency_us, 1)})
+            if decision.reason:
+                s.set_attribute("fallback_reason", decision.reason)
+        # 卡片生成会读取数据集元数据与代价历史 (同步文件 IO)，放到线程里执行，不阻塞事件循环
+        if decision.local:
+            return await asyncio.to_thread(self._generate_routed_config, decision, query, uploaded_files)
 
         # 2. 隐式意图识别 (Context Awareness)
         if uploaded_files and (not query_text or query_text == "发送了文件" or len(query_text) < 5):
             if history and len(history) > 0:
                 last_msg = history[-1]
                 if last_msg.get('role') == 'assistant' and "未上传数据" in last_msg.get('content', ''):
-                    return self._generate_workflow_config("规划流程", uploaded_files)
+                    return await asyncio.to_thread(self._generate_workflow_config, "规划流程", uploaded_files)
 
         # 3. 默认：流式对话 (带深度思考)
-        return self._stream_chat(query, uploaded_files)
+        return self._stream_chat(query, uploaded_files, history, summary)
+
+    def _generate_routed_config(self, decision, query, uploaded_files=None):
+        """
+        按路由结果生成卡片：关键词规则保持原有卡片，分类器路由额外预填抽取到的参数并说明未调用大模型
+        """
+        if decision.intent == MAPPING:
+            config = self._generate_mapping_config(query, uploaded_files)
+        else:
+            config = self._generate_workflow_config(query, uploaded_files)
+        self._apply_overrides(config, decision.params)
+        config["route"] = decision.to_dict()
+
+        notes = []
+        flat = decision.flat_params()
+        if flat:
+            notes.append("🎛️ 已按您的要求预填参数：" + "，".join(f"**{k} = {v}**" for k, v in flat.items()))
+        if decision.action == "redraw":
+            names = [step["name"] for step in config["steps"] if step["tool_id"] in decision.steps]
+            notes.append(f"🖼️ 将重新运行流程并输出 {', '.join(names)} 的图像。")
+        if notes:
+            config["reply"] += "\n\n" + "\n".join(notes)
+        if decision.method == "classifier":
+            config["thought"] = (f"本地意图路由识别为「{_ACTION_LABELS.get(decision.action, decision.action)}」"
+                                 f" (置信度 {decision.confidence:.2f}，耗时 {decision.latency_us:.0f}µs)，未调用大模型。")
+        return config
+
+    @staticmethod
+    def _apply_overrides(config, params):
+        """把路由抽取到的参数写进卡片：已有的参数改值，卡片上没有的参数追加为文本框"""
+        for step in config["steps"]:
+            for name, value in params.get(step["tool_id"], {}).items():
+                existing = next((p for p in step["params"] if p["name"] == name), None)
+                if existing is not None:
+                    existing["value"] = value
+                else:
+                    step["params"].append({"name": name, "label": name, "value": value, "type": "text"})
 
     def _get_filename(self, f):
         if isinstance(f, dict):
@@ -54,7 +131,7 @@ class BioBlendAgent:
             file_names = ", ".join(names)
             reply_text = f"收到文件：**{file_names}**。\n已为您自动匹配 **Standard Scanpy Pipeline (10 Steps)**，涵盖从质控到多维可视化的全流程。请确认参数："
 
-        return {
+        config = {
             "type": "workflow_config",
             "reply": reply_text,
             "workflow_name": "Standard Scanpy Pipeline",
@@ -72,40 +149,117 @@ class BioBlendAgent:
             ],
             "thought": "识别到用户需要规划分析流程，已加载 Scanpy 完整标准模板。"
         }
+        if uploaded_files:
+            self._apply_plan(config, uploaded_files)
+        return config
+
+    def _generate_mapping_config(self, query, uploaded_files=None):
+        """
+        参考映射卡片：把新样本投影到已完成的 run 上 (kNN 迁移聚类与 UMAP 位置，不重新聚类)
+        """
+        match = RUN_ID_PATTERN.search(query)
+        reference_run = match.group(0).lower() if match else ""
+        if not uploaded_files:
+            reply_text = "已为您准备参考映射流程。⚠️ **检测到您尚未上传数据**，请先上传需要映射的新样本。"
+        else:
+            file_names = ", ".join(self._get_filename(f) for f in uploaded_files)
+            reply_text = (f"收到文件：**{file_names}**。\n将把新样本投影到参考 run 的 PCA 空间，"
+                          f"并通过近似最近邻索引直接继承聚类标签与 UMAP 位置 (无需重新聚类，通常数秒完成)。")
+        if not reference_run:
+            reply_text += "\n\n请在下方填写参考 run 的任务 ID (标准流程完成后会自动保存映射索引)。"
+
+        return {
+            "type": "workflow_config",
+            "reply": reply_text,
+            "workflow_name": "Map to Reference",
+            "steps": [
+                {"name": "1. Map to Reference", "tool_id": "local_map_reference",
+                 "desc": "QC + LogNormalize, project onto reference PCs, kNN label & UMAP transfer",
+                 "params": [
+                     {"name": "reference_run", "label": "参考 Run ID", "value": reference_run, "type": "text"},
+                     {"name": "n_neighbors", "label": "kNN K", "value": "15", "type": "text"},
+                     {"name": "min_genes", "label": "Min Genes", "value": "200", "type": "text"},
+                     {"name": "max_mt", "label": "Max MT%", "value": "20", "type": "text"},
+                 ]},
+            ],
+            "thought": "识别到用户需要把新样本映射到已有结果，已加载参考映射模板。"
+        }
 
-    async def _stream_chat(self, query: str, uploaded_files=None) -> AsyncGenerator[str, None]:
+    @staticmethod
+    def _format_cost(seconds, peak_mb):
+        duration = f"{seconds:.0f}s" if seconds < 120 else f"{seconds / 60:.1f}min"
+        memory = f"{peak_mb}MB" if peak_mb < 1024 else f"{peak_mb / 1024:.1f}GB"
+        return duration, memory
+
+    def _apply_plan(self, config, uploaded_files):
         """
-        流式对话生成器 (注入思维链指令)
+        读取数据集规模，按规模选择算法变体 (PCA 求解器、t-SNE 策略等)，
+        并在卡片上给每一步标注预计耗时 / 峰值内存
+        """
+        try:
+            samples = resolve_samples(uploaded_files, settings.UPLOAD_DIR)
+            data_path = [path for _, path in samples] if samples else resolve_input(uploaded_files, settings.UPLOAD_DIR)
+            plan = self.planner.plan(data_path, [step["tool_id"] for step in config["steps"]])
+        except Exception as e:
+            print(f"⚠️ [Agent] 数据集规划失败，使用默认模板: {e}")
+            return
+
+        params = plan["params"]
+        extra_params = {
+            "local_pca": [
+                {"name": "svd_solver", "label": "SVD Solver", "value": params["svd_solver"], "type": "select",
+                 "options": [{"value": "arpack", "label": "ARPACK (精确)"}, {"value": "randomized", "label": "Randomized (大数据集更快)"}]},
+            ],
+            "local_neighbors": [
+                {"name": "n_pcs", "label": "N PCs", "value": params["n_pcs"], "type": "text"},
+            ],
+            "local_tsne": [
+                {"name": "tsne_mode", "label": "t-SNE 策略", "value": params["tsne_mode"], "type": "select",
+                 "options": [{"value": "full", "label": "全量"}, {"value": "sketch", "label": f"抽样 {params['tsne_sketch_size']} 细胞"}, {"value": "skip", "label": "跳过"}]},
+            ],
+        }
+        for step in config["steps"]:
+            step["params"] = step["params"] + extra_params.get(step["tool_id"], [])
+            estimate = plan["estimates"].get(step["tool_id"])
+            if estimate:
+                step["estimate"] = estimate
+                duration, memory = self._format_cost(estimate["seconds"], estimate["peak_mb"])
+                step["desc"] = f"{step['desc']} · 预计 {duration} / 峰值 {memory}"
+
+        meta = plan["dataset"]
+        duration, memory = self._format_cost(plan["total_seconds"], plan["peak_mb"])
+        approx = "约 " if meta.get("estimated") else ""
+        config["plan"] = plan
+        config["reply"] += (f"\n\n📊 数据规模：{approx}{meta['n_obs']:,} 细胞 × {meta['n_vars']:,} 基因"
+                            f" (非零元素 {meta['nnz']:,})。预计总耗时 **{duration}**，峰值内存 **{memory}**。")
+        if samples:
+            config["reply"] += (f"\n\n🧬 检测到 {len(samples)} 个样本 ({', '.join(name for name, _ in samples)})："
+                                f"将并行完成各样本的质控与标准化，合并后在共享 PCA 空间做批次校正，再联合聚类。")
+
+    def _stream_chat(self, query: str, uploaded_files=None, history=None, summary: str = "") -> ChatStream:
+        """
+        流式对话 (注入思维链指令)
+        Prompt 布局：静态 System 模板 → 文件上下文/历史摘要 → 近期历史窗口 → 当前问题
         """
         # 1. 构建上下文
         file_context = ""
         if uploaded_files:
             names = [self._get_filename(f) for f in uploaded_files]
-            file_context = f"\n[User Context - Uploaded Files]: {', '.join(names)}"
-
-        # 2. 定义系统人设 (System Prompt) - 🔥 核心修改：强制输出 <think> 标签
-        system_template = """你是一个专业的生物信息学专家助手 GIBH-Agent。
-
-请按照以下步骤回答问题：
-1. **深度思考 (Thinking Process)**：首先，在 `<think>` 和 `</think>` 标签内，详细规划你的回答逻辑、分析用户意图、检查是否有潜在的坑（如文件格式、参数设置）。这部分内容不要直接展示给用户看。
-2. **正式回答 (Response)**：思考结束后，在标签外给出最终的、结构清晰的回答。
-
-请遵循：
-- 准确性优先，不要编造。
-- 使用 Markdown 格式。
-- 拒绝无关问题。
-
-{file_context}
-"""
-        system_message = SystemMessagePromptTemplate.from_template(system_template)
-        human_message = HumanMessagePromptTemplate.from_template("{query}")
-        
-        chat_prompt = ChatPromptTemplate.from_messages([system_message, human_message])
-        
-        chain = chat_prompt | self.llm
-        
-        # 3. 执行流式生成
-        async for chunk in chain.astream({"query": query, "file_context": file_context}):
+            file_context = f"[User Context - Uploaded Files]: {', '.join(names)}"
+
+        with span("agent.build_context") as s:
+            context = self.context_builder.build(query, history, file_context, summary)
+            s.set_attributes({"prompt_tokens": context.prompt_tokens, "history_turns": context.history_turns,
+                              "summarized_turns": context.summarized_turns})
+        print(f"🧮 [Agent] prompt_tokens≈{context.prompt_tokens} "
+              f"(history={context.history_turns} turns, summarized={context.summarized_turns})")
+        # 生成器在 StreamingResponse 里才开始迭代，届时已不在请求的追踪上下文中：traceparent 现在取出
+        return ChatStream(self._generate(context.messages, inject()), context)
+
+    async def _generate(self, messages: list, trace_headers: dict = None) -> AsyncGenerator[str, None]:
+        # 执行流式生成 (traceparent 透传给 vLLM，开启 OTLP 追踪时两端的 span 可以拼起来)
+        kwargs = {"extra_headers": trace_headers} if trace_headers else {}
+        async for chunk in self.llm.astream(messages, **kwargs):
             content = ""
             if hasattr(chunk, 'content') and chunk.content:
                 content = chunk.content
@@ -1,9 +1,17 @@
 import os
+import time
 from celery import Celery
+from celery.signals import worker_init
 from langchain_openai import ChatOpenAI
 from langchain_core.prompts import ChatPromptTemplate
 from .config import settings
 from .skill_manager import SkillManager 
+from .result_store import result_store, run_dir
+from .datasets import resolve_input, resolve_samples, dataset_key
+from .planner import WorkflowPlanner
+from .run_control import RunGuard
+from .reference_index import reference_meta
+from .tracing import tracer, span, KIND_CLIENT, KIND_CONSUMER, KIND_PRODUCER
 
 celery_app = Celery(
     "gibh_worker",
@@ -11,7 +19,47 @@ celery_app = Celery(
     backend=settings.REDIS_URL
 )
 
+# API 进程里通过有界线程池访问 broker / backend (见 task_gateway.py)，
+# 连接池上限与线程数对齐，所有线程共享同一组 Redis 连接
+celery_app.conf.update(
+    broker_pool_limit=settings.TASK_IO_THREADS,
+    redis_max_connections=settings.TASK_IO_THREADS * 2,
+    # Worker 以 -Q celery,prefetch 启动：按列出顺序消费，正式任务队列非空时不会取预热任务
+    broker_transport_options={"queue_order_strategy": "priority"},
+    # 每个进程只预取一条消息，排队中的正式任务留在 broker 里 (预热任务据此判断是否需要让路)
+    worker_prefetch_multiplier=1,
+)
+
+# 投机预热 (低优先级队列)
+PREFETCH_QUEUE = "prefetch"
+PREFETCH_TASK_KEY = "prefetch:task:"      # + dataset_key -> 预热任务 id (去重)
+PREFETCH_CANCEL_KEY = "prefetch:cancel:"  # + dataset_key -> 取消标记
+
+# 工作流取消标记 (+ run_id)，Worker 在步骤之间 / 步骤执行中轮询
+RUN_CANCEL_KEY = "run:cancel:"
+
+@worker_init.connect
+def _configure_tracing(**kwargs):
+    # 只在 Worker 进程里以 gibh-worker 身份写 trace (API 进程导入本模块时由 main.py 配置)；prefork 子进程继承该配置
+    tracer.configure(settings.TRACE_DIR if settings.TRACE_ENABLED else None, service="gibh-worker",
+                     retention_seconds=settings.TRACE_RETENTION_HOURS * 3600)
+
+def _message_header(request, name):
+    # apply_async(headers=...) 的自定义消息头：Celery 5 并入 request 属性，部分版本保留在 request.headers 里
+    value = getattr(request, name, None)
+    if value is None:
+        value = (getattr(request, "headers", None) or {}).get(name)
+    return value
+
 skill_mgr = SkillManager()
+planner = WorkflowPlanner(settings.COST_HISTORY_PATH, fused=settings.FUSED_PREPROCESS)
+
+def _get_skill(skill_id="scanpy_local"):
+    skill = skill_mgr.get_skill(skill_id)
+    if not skill:
+        skill_mgr._load_skills()
+        skill = skill_mgr.get_skill(skill_id)
+    return skill
 
 @celery_app.task(bind=True)
 def run_bioinformatics_task(self, workflow_data: dict, files: list):
@@ -19,7 +67,51 @@ def run_bioinformatics_task(self, workflow_data: dict, files: list):
     统一任务入口
     """
     print(f"🚀 [Worker] 收到任务，文件列表: {[f.get('name') for f in files]}")
-    return _run_local_skill(self, workflow_data, files)
+    run_id = self.request.id
+    parent = _message_header(self.request, "traceparent")
+    enqueued_ns = _message_header(self.request, "enqueued_ns")
+    if enqueued_ns:
+        # 消息在 Redis 里排队的时间 (API 投递 → Worker 取到)
+        tracer.start_span("celery.queue", {"run_id": run_id}, traceparent=parent,
+                          kind=KIND_PRODUCER, start_ns=int(enqueued_ns)).end()
+    # 没有上游 trace (旧版 API 投递) 时在 Worker 里开启新 trace，保证每个 run 都能按 run_id 查询
+    with span("celery.run_workflow", {"run_id": run_id, "files": len(files)}, traceparent=parent,
+              root=True, kind=KIND_CONSUMER) as task_span:
+        tracer.link_run(run_id, task_span.trace_id)
+        result = _run_local_skill(self, workflow_data, files)
+        task_span.set_attribute("status", result.get("status"))
+        return result
+
+@celery_app.task(bind=True, queue=PREFETCH_QUEUE)
+def prefetch_dataset(self, files: list):
+    """
+    投机预热：用户挂载文件后、点击运行前，预先解析数据集并计算 QC 指标
+    可取消，且在每个阶段之间检查正式任务队列，有任务排队就立即让出 Worker
+    """
+    data_input_path = resolve_input(files, settings.UPLOAD_DIR)
+    if not data_input_path or not os.path.exists(data_input_path):
+        return {"status": "skipped", "reason": "input not found"}
+    skill = _get_skill()
+    if not skill or not hasattr(skill, "prefetch"):
+        return {"status": "skipped", "reason": "skill unavailable"}
+
+    key = dataset_key(data_input_path)
+    client = celery_app.backend.client
+    default_queue = celery_app.conf.task_default_queue
+
+    def should_stop():
+        return bool(client.exists(PREFETCH_CANCEL_KEY + key)) or client.llen(default_queue) > 0
+
+    try:
+        result = skill.prefetch(data_input_path, settings.UPLOAD_DIR, settings.PREFETCH_CACHE_DIR,
+                                should_stop=should_stop, max_cache_bytes=settings.PREFETCH_CACHE_MAX_BYTES)
+    except Exception as e:
+        result = {"status": "failed", "dataset_key": key, "error": str(e)}
+    if result["status"] in ("cancelled", "failed"):
+        # 释放去重标记，之后再次挂载同一数据集时可以重新预热
+        client.delete(PREFETCH_TASK_KEY + key)
+    print(f"🔥 [Worker] 预热 {key}: {result['status']}")
+    return result
 
 def _generate_ai_interpretation(qc_metrics, steps_details):
     """
@@ -29,6 +121,7 @@ def _generate_ai_interpretation(qc_metrics, steps_details):
         # 1. 提取关键信息
         raw_cells = qc_metrics.get('raw_cells', 'N/A')
         filtered_cells = qc_metrics.get('filtered_cells', 'N/A')
+        n_samples = qc_metrics.get('n_samples', 1)
         
         # 尝试从步骤详情中提取 Marker 基因信息
         markers_info = "未找到 Marker 基因信息"
@@ -43,12 +136,14 @@ def _generate_ai_interpretation(qc_metrics, steps_details):
                 markers_info = step.get('details', '未生成 Marker 表')
 
         # 2. 连接 vLLM (在 Docker 内部网络中)
+        llm_span = tracer.start_span("llm.diagnosis", {"model": settings.LLM_MODEL}, kind=KIND_CLIENT)
         llm = ChatOpenAI(
             model=settings.LLM_MODEL,
             base_url=settings.VLLM_URL, # http://inference-engine:8000/v1
             api_key="EMPTY",
             temperature=0.2,
-            max_tokens=2048
+            max_tokens=2048,
+            default_headers={"traceparent": llm_span.traceparent} if llm_span.recording else None,
         )
 
         # 3. 构造 Prompt
@@ -59,6 +154,7 @@ def _generate_ai_interpretation(qc_metrics, steps_details):
         - 原始细胞数: {raw_cells}
         - 质控后细胞数: {filtered_cells}
         - 聚类结果: {n_clusters}
+        - 样本数: {n_samples} (多样本时已按样本做批次校正)
 
         【差异基因 (Markers) 数据片段】
         {markers_info}
@@ -76,7 +172,14 @@ def _generate_ai_interpretation(qc_metrics, steps_details):
         chain = prompt | llm
         
         print("🧠 [Worker] 正在请求 AI 生成诊断报告...")
-        response = chain.invoke({})
+        try:
+            response = chain.invoke({})
+            llm_span.set_attribute("output_chars", len(response.content))
+        except Exception as e:
+            llm_span.record_exception(e)
+            raise
+        finally:
+            llm_span.end()
         return response.content
 
     except Exception as e:
@@ -86,58 +189,90 @@ def _generate_ai_interpretation(qc_metrics, steps_details):
 def _run_local_skill(task_instance, workflow_data, files):
     """执行本地 Python 插件"""
     
+    # Worker 实际开始执行的时间：与客户端提交时间相减即排队等待 (负载测试据此区分排队与计算)
+    started_at = time.time()
+
     if not files:
         return {"status": "failed", "error": "❌ 错误：未接收到文件信息。"}
     
-    # 智能路径处理
-    target_file_name = files[0]['name']
-    is_10x = False
-    for f in files:
-        if 'matrix.mtx' in f['name']:
-            is_10x = True
-            break
-    
-    if is_10x:
-        data_input_path = settings.UPLOAD_DIR
-    else:
-        data_input_path = os.path.join(settings.UPLOAD_DIR, target_file_name)
+    # 智能路径处理 (10x 目录 或 单个文件)；上传了多个样本文件时走多样本联合分析
+    samples = resolve_samples(files, settings.UPLOAD_DIR)
+    data_input_path = resolve_input(files, settings.UPLOAD_DIR)
 
-    if not os.path.exists(data_input_path):
-        return {"status": "failed", "error": f"❌ 错误：找不到路径 {data_input_path}"}
+    for path in ([p for _, p in samples] if samples else [data_input_path]):
+        if not os.path.exists(path):
+            return {"status": "failed", "error": f"❌ 错误：找不到路径 {path}"}
     
     merged_params = {}
     for step in workflow_data['steps']:
         merged_params.update(step.get('params', {}))
+
+    # 取消 / 时间预算：工作流参数 step_timeout / max_runtime (秒) 优先于全局默认值
+    run_id = task_instance.request.id
+    client = celery_app.backend.client
+    guard = RunGuard(
+        should_cancel=lambda: client.exists(RUN_CANCEL_KEY + run_id),
+        step_budget=merged_params.get('step_timeout', settings.WORKFLOW_STEP_TIMEOUT),
+        total_budget=merged_params.get('max_runtime', settings.WORKFLOW_MAX_RUNTIME),
+    )
+
+    def report_progress(steps):
+        task_instance.update_state(state='PROGRESS', meta={'steps': steps, 'started_at': started_at})
     
-    skill = skill_mgr.get_skill("scanpy_local")
+    # 参考映射工作流：校验参考 run，并把其目录交给插件
+    skill_id = "scanpy_local"
+    if any(step.get('tool_id') == 'local_map_reference' for step in workflow_data['steps']):
+        skill_id = "reference_mapping"
+        try:
+            reference_dir = run_dir(str(merged_params.get('reference_run', '')).strip())
+        except ValueError:
+            return {"status": "failed", "error": "❌ 错误：参考 run ID 无效。"}
+        if reference_meta(reference_dir) is None:
+            return {"status": "failed", "error": "❌ 错误：参考 run 不存在或没有可用的映射索引 (需要完整跑过标准流程)。"}
+        merged_params['reference_dir'] = reference_dir
+
+    skill = _get_skill(skill_id)
     if not skill:
-        skill_mgr._load_skills()
-        skill = skill_mgr.get_skill("scanpy_local")
-        if not skill:
-            return {"status": "failed", "error": "❌ 严重错误：无法加载 scanpy_local 插件。"}
+        return {"status": "failed", "error": f"❌ 严重错误：无法加载 {skill_id} 插件。"}
     
     try:
         print("▶️ 开始执行 Scanpy Pipeline...")
-        task_instance.update_state(state='PROGRESS', meta={'steps': [{"name": "正在初始化 Scanpy...", "status": "running"}]})
+        report_progress([{"name": "正在初始化 Scanpy...", "status": "running"}])
         
         # 1. 执行生信分析
-        result = skill.execute(data_input_path, merged_params, settings.UPLOAD_DIR)
-        
-        if result['status'] == 'success':
+        result = skill.execute(samples or data_input_path, merged_params, settings.UPLOAD_DIR,
+                               run_dir=run_dir(run_id, create=True), run_url=f"/api/runs/{run_id}",
+                               cache_dir=settings.PREFETCH_CACHE_DIR,
+                               guard=guard, on_progress=report_progress, sample_workers=settings.SAMPLE_WORKERS,
+                               fused=settings.FUSED_PREPROCESS)
+        client.delete(RUN_CANCEL_KEY + run_id)
+
+        if result['status'] == 'success' and skill_id == "scanpy_local":
+            # 记录各步骤实测耗时/内存，供规划器拟合代价模型
+            try:
+                meta = planner.dataset_meta([p for _, p in samples] if samples else data_input_path)
+                planner.record_run(meta, merged_params, result['steps_details'])
+            except Exception as e:
+                print(f"⚠️ [Worker] 代价记录失败: {e}")
+
             # 2. 🔥🔥🔥 核心修复：调用 LLM 生成真正的诊断报告
             # 用 AI 生成的内容覆盖原本 scrna_analysis.py 里硬编码的 diagnosis
-            task_instance.update_state(state='PROGRESS', meta={'steps': [{"name": "正在生成 AI 诊断报告...", "status": "running"}]})
+            report_progress(result['steps_details'] + [{"name": "正在生成 AI 诊断报告...", "status": "running"}])
             
             ai_diagnosis = _generate_ai_interpretation(result['qc_metrics'], result['steps_details'])
             result['diagnosis'] = ai_diagnosis
             
         print(f"✅ 执行结束，状态: {result.get('status')}")
-        return result
+        result['started_at'] = started_at
+        result['finished_at'] = time.time()
+        # 完整报告落盘，Redis 里只保留精简 manifest
+        return result_store.offload(task_instance.request.id, result)
         
     except Exception as e:
         import traceback
         traceback.print_exc()
-        return {"status": "failed", "error": f"运行异常: {str(e)}"}
+        return {"status": "failed", "error": f"运行异常: {str(e)}",
+                "started_at": started_at, "finished_at": time.time()}
 
 def _run_galaxy_task(task_instance, workflow_data, files):
     return {"status": "success", "steps": []}
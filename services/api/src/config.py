@@ -1,9 +1,12 @@
 import os
+from pydantic import model_validator
 from pydantic_settings import BaseSettings
 
 class Settings(BaseSettings):
     # 基础路径
     UPLOAD_DIR: str = "/app/uploads"
+    # 每个 run 的产物目录 (结果 blob、embedding、AnnData 等)；留空时为 {UPLOAD_DIR}/runs
+    RUNS_DIR: str = ""
     
     # 服务连接
     REDIS_URL: str = os.getenv("REDIS_URL", "redis://redis:6379/0")
@@ -14,5 +17,80 @@ class Settings(BaseSettings):
     GALAXY_URL: str = os.getenv("GALAXY_URL", "http://192.168.8.111:8080")
     GALAXY_KEY: str = os.getenv("GALAXY_API_KEY", "your_key")
 
+    # 对话准入控制 (LLM 饱和时快速 429，而不是让所有人一起变慢)
+    CHAT_MAX_ACTIVE: int = int(os.getenv("CHAT_MAX_ACTIVE", "32"))
+    CHAT_MAX_QUEUE: int = int(os.getenv("CHAT_MAX_QUEUE", "64"))
+    CHAT_PER_CLIENT: int = int(os.getenv("CHAT_PER_CLIENT", "2"))
+    CHAT_RATE_PER_MIN: float = float(os.getenv("CHAT_RATE_PER_MIN", "20"))
+    CHAT_BURST: int = int(os.getenv("CHAT_BURST", "5"))
+    CHAT_MAX_QUEUE_WAIT: float = float(os.getenv("CHAT_MAX_QUEUE_WAIT", "15"))
+
+    # 多轮对话上下文预算 (token)
+    CHAT_HISTORY_TOKEN_BUDGET: int = int(os.getenv("CHAT_HISTORY_TOKEN_BUDGET", "3000"))
+    CHAT_SUMMARY_TOKEN_BUDGET: int = int(os.getenv("CHAT_SUMMARY_TOKEN_BUDGET", "400"))
+
+    # API 侧访问 Celery broker / backend 的线程池大小 (同时也是连接池上限)
+    TASK_IO_THREADS: int = int(os.getenv("TASK_IO_THREADS", "8"))
+
+    # 结果存储：超过该字节数的报告字段卸载到磁盘，Celery 结果只保留 manifest
+    RESULT_INLINE_LIMIT: int = int(os.getenv("RESULT_INLINE_LIMIT", "2048"))
+
+    # 流程规划：历史运行的实测耗时/内存 (用于拟合代价模型)
+    COST_HISTORY_PATH: str = ""
+
+    # 结果查询：同时保持打开的 run 数量 (LRU)
+    QUERY_CACHE_RUNS: int = int(os.getenv("QUERY_CACHE_RUNS", "8"))
+
+    # 服务端会话 (Redis)
+    SESSION_TTL: int = int(os.getenv("SESSION_TTL", "86400"))
+    SESSION_MAX_HISTORY_TOKENS: int = int(os.getenv("SESSION_MAX_HISTORY_TOKENS", "6000"))
+    SESSION_MAX_BYTES: int = int(os.getenv("SESSION_MAX_BYTES", str(64 * 1024)))
+    SESSION_MAX_SESSIONS: int = int(os.getenv("SESSION_MAX_SESSIONS", "10000"))
+
+    # 工作流时间预算 (秒，0 表示不限)；可被工作流参数 step_timeout / max_runtime 覆盖
+    WORKFLOW_STEP_TIMEOUT: float = float(os.getenv("WORKFLOW_STEP_TIMEOUT", "0"))
+    WORKFLOW_MAX_RUNTIME: float = float(os.getenv("WORKFLOW_MAX_RUNTIME", "21600"))
+
+    # 多样本模式：并行预处理样本的进程数
+    SAMPLE_WORKERS: int = int(os.getenv("SAMPLE_WORKERS", str(min(4, os.cpu_count() or 1))))
+
+    # 融合预处理：QC / LogNormalize / HVG 统计合并为一次 numba 矩阵扫描 (numba 不可用时自动退回 scanpy 步骤)
+    FUSED_PREPROCESS: bool = os.getenv("FUSED_PREPROCESS", "true").lower() == "true"
+
+    # 投机预热：挂载文件后在低优先级队列里预先解析数据集，checkpoint 按数据集指纹缓存
+    PREFETCH_ENABLED: bool = os.getenv("PREFETCH_ENABLED", "true").lower() == "true"
+    PREFETCH_CACHE_DIR: str = ""
+    PREFETCH_CACHE_MAX_BYTES: int = int(os.getenv("PREFETCH_CACHE_MAX_BYTES", str(20 * 1024 ** 3)))
+    PREFETCH_TTL: int = int(os.getenv("PREFETCH_TTL", "1800"))
+
+    # QC 阈值预览：抽样细胞数上限与单次计算的时间预算 (秒)，抽样结果按数据集指纹缓存
+    QC_PREVIEW_MAX_CELLS: int = int(os.getenv("QC_PREVIEW_MAX_CELLS", "20000"))
+    QC_PREVIEW_BUDGET: float = float(os.getenv("QC_PREVIEW_BUDGET", "2.0"))
+    QC_PREVIEW_CACHE_DIR: str = ""
+
+    # 本地意图路由：命令式消息 (改参数重跑 / 重新出图) 在 CPU 上直接转成工作流卡片；置信度低于阈值时交给大模型
+    INTENT_ROUTER_ENABLED: bool = os.getenv("INTENT_ROUTER_ENABLED", "true").lower() == "true"
+    INTENT_ROUTER_THRESHOLD: float = float(os.getenv("INTENT_ROUTER_THRESHOLD", "0.8"))
+
+    # 链路追踪：OTLP/JSON span 逐行写入 {TRACE_DIR}/{trace_id}.jsonl，超过保留期的文件自动清理
+    TRACE_ENABLED: bool = os.getenv("TRACE_ENABLED", "true").lower() == "true"
+    TRACE_DIR: str = ""
+    TRACE_RETENTION_HOURS: float = float(os.getenv("TRACE_RETENTION_HOURS", "168"))
+
+    @model_validator(mode="after")
+    def _derive_paths(self):
+        # 派生路径跟随实际生效的 UPLOAD_DIR (环境变量 / .env / 构造参数)，单独配置过的保持不变
+        defaults = {
+            "RUNS_DIR": ("runs",),
+            "COST_HISTORY_PATH": ("runs", "cost_history.jsonl"),
+            "PREFETCH_CACHE_DIR": ("cache", "prefetch"),
+            "QC_PREVIEW_CACHE_DIR": ("cache", "qc_preview"),
+            "TRACE_DIR": ("traces",),
+        }
+        for name, parts in defaults.items():
+            if not getattr(self, name):
+                setattr(self, name, os.path.join(self.UPLOAD_DIR, *parts))
+        return self
+
 settings = Settings()
 os.makedirs(settings.UPLOAD_DIR, exist_ok=True)
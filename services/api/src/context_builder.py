@@ -0,0 +1,184 @@
+import re
+import hashlib
+from collections import OrderedDict
+from typing import List, Dict, Optional
+
+from langchain_core.messages import SystemMessage, HumanMessage, AIMessage
+
+# 静态系统提示词：所有用户、所有请求完全一致，放在 prompt 最前面，
+# 这样 vLLM 的 Automatic Prefix Caching 可以跨用户复用这段 KV Cache。
+# ⚠️ 不要在这里插入任何随请求变化的内容 (文件名、时间戳等)。
+SYSTEM_PROMPT = """你是一个专业的生物信息学专家助手 GIBH-Agent。
+
+请按照以下步骤回答问题：
+1. **深度思考 (Thinking Process)**：首先，在 `<think>` 和 `</think>` 标签内，详细规划你的回答逻辑、分析用户意图、检查是否有潜在的坑（如文件格式、参数设置）。这部分内容不要直接展示给用户看。
+2. **正式回答 (Response)**：思考结束后，在标签外给出最终的、结构清晰的回答。
+
+请遵循：
+- 准确性优先，不要编造。
+- 使用 Markdown 格式。
+- 拒绝无关问题。
+"""
+
+# CJK 字符基本一字一 token；其余按 BPE 经验值约 4 字符一个 token
+_CJK_RE = re.compile(r"[\u3000-\u303f\u3400-\u4dbf\u4e00-\u9fff\uff00-\uffef]")
+# 每条消息的 chat template 开销 (<|im_start|>role\n ... <|im_end|>)
+_MESSAGE_OVERHEAD = 4
+
+
+def count_tokens(text: str) -> int:
+    """
+    轻量 token 估算 (不依赖 tokenizer，单次调用为微秒级)
+    对 Qwen 系列分词器误差通常在 ±15% 以内，用于预算控制足够。
+    """
+    if not text:
+        return 0
+    cjk = len(_CJK_RE.findall(text))
+    other = len(text) - cjk
+    return cjk + (other + 3) // 4
+
+
+def normalize_history(history: Optional[list]) -> List[Dict[str, str]]:
+    """
+    统一历史消息格式为 [{"role": "user"|"assistant", "content": ...}]
+    兼容前端的 {"user": ..., "ai": ...} 结构
+    """
+    turns = []
+    for item in history or []:
+        if not isinstance(item, dict):
+            continue
+        if "role" in item:
+            if item.get("content"):
+                turn = {"role": item["role"], "content": item["content"]}
+                if item.get("tokens"):
+                    turn["tokens"] = item["tokens"]  # 会话中缓存的 token 数
+                turns.append(turn)
+            continue
+        if item.get("user"):
+            turns.append({"role": "user", "content": item["user"]})
+        if item.get("ai"):
+            turns.append({"role": "assistant", "content": item["ai"]})
+    return turns
+
+
+def _strip_think(text: str) -> str:
+    # 历史里的思维链对后续对话没有价值，只会吃掉预算
+    return re.sub(r"<think>.*?</think>", "", text, flags=re.S).strip()
+
+
+class PromptContext:
+    """构建好的 prompt：消息列表 + token 统计"""
+
+    def __init__(self, messages: list, prompt_tokens: int, history_turns: int, summarized_turns: int):
+        self.messages = messages
+        self.prompt_tokens = prompt_tokens
+        self.history_turns = history_turns
+        self.summarized_turns = summarized_turns
+
+
+class ContextBuilder:
+    """
+    固定 token 预算的历史窗口
+    - 最近的若干轮原样保留 (从新到旧装入，直到预算用完)
+    - 更早的轮次折叠成一段滚动摘要 (按前缀哈希缓存，增量更新)
+    - Prompt 布局：静态 System → 本次请求的文件上下文/摘要 → 历史窗口 → 当前问题
+    """
+
+    def __init__(self, history_budget: int = 3000, summary_budget: int = 400,
+                 turn_char_limit: int = 2000, cache_size: int = 1024):
+        self.history_budget = history_budget
+        self.summary_budget = summary_budget
+        self.turn_char_limit = turn_char_limit
+        self.cache_size = cache_size
+        self._summary_cache: "OrderedDict[str, str]" = OrderedDict()
+        self.system_tokens = count_tokens(SYSTEM_PROMPT) + _MESSAGE_OVERHEAD
+
+    def compact_turn(self, role: str, content: str) -> Dict:
+        """去掉思维链、截断超长内容并缓存 token 数 (会话存储用)"""
+        text = _strip_think(content or "")[: self.turn_char_limit]
+        return {"role": role, "content": text, "tokens": count_tokens(text)}
+
+    # ---------- 滚动摘要 ----------
+    def _turn_digest(self, prev_key: str, turn: Dict[str, str]) -> str:
+        h = hashlib.sha1(prev_key.encode())
+        h.update(turn["role"].encode())
+        h.update(turn["content"].encode())
+        return h.hexdigest()
+
+    def _cache_put(self, key: str, value: str):
+        self._summary_cache[key] = value
+        self._summary_cache.move_to_end(key)
+        while len(self._summary_cache) > self.cache_size:
+            self._summary_cache.popitem(last=False)
+
+    def _summarize_turn(self, turn: Dict[str, str]) -> str:
+        text = _strip_think(turn["content"]).replace("\n", " ")
+        prefix = "用户" if turn["role"] == "user" else "助手"
+        return f"- {prefix}: {text[:120]}{'…' if len(text) > 120 else ''}"
+
+    def extend_summary(self, summary: str, turn: Dict[str, str]) -> str:
+        """在已有摘要后追加一轮要点，超出摘要预算时丢弃最早的要点"""
+        lines = (summary.split("\n") if summary else []) + [self._summarize_turn(turn)]
+        while len(lines) > 1 and count_tokens("\n".join(lines)) > self.summary_budget:
+            lines.pop(0)
+        return "\n".join(lines)
+
+    def rolling_summary(self, turns: List[Dict[str, str]], base: str = "") -> str:
+        """
+        把被挤出窗口的旧轮次压缩成摘要 (base 为此前已折叠的摘要，如会话中保存的)
+        摘要按轮次前缀增量构建：第 N 轮的摘要 = 第 N-1 轮摘要 + 新轮次要点，
+        每一步都按前缀哈希缓存，多轮对话中每次请求只需处理新挤出的那一轮。
+        """
+        key = hashlib.sha1(base.encode()).hexdigest() if base else ""
+        summary = base
+        for turn in turns:
+            key = self._turn_digest(key, turn)
+            cached = self._summary_cache.get(key)
+            if cached is not None:
+                self._summary_cache.move_to_end(key)
+                summary = cached
+                continue
+            summary = self.extend_summary(summary, turn)
+            self._cache_put(key, summary)
+        return summary
+
+    # ---------- 构建 ----------
+    def build(self, query: str, history: Optional[list] = None, file_context: str = "",
+              summary: str = "") -> PromptContext:
+        turns = normalize_history(history)
+        for t in turns:
+            t["content"] = _strip_think(t["content"])[: self.turn_char_limit]
+
+        # 从最新一轮往前装，直到历史预算用完
+        window: List[Dict[str, str]] = []
+        used = 0
+        for turn in reversed(turns):
+            cost = (turn.get("tokens") or count_tokens(turn["content"])) + _MESSAGE_OVERHEAD
+            if used + cost > self.history_budget:
+                break
+            window.insert(0, turn)
+            used += cost
+        older = turns[: len(turns) - len(window)]
+        summary = self.rolling_summary(older, base=summary) if older else summary
+
+        dynamic_parts = []
+        if file_context:
+            dynamic_parts.append(file_context.strip())
+        if summary:
+            dynamic_parts.append(f"[Earlier Conversation Summary]\n{summary}")
+        dynamic_text = "\n\n".join(dynamic_parts)
+        # 动态内容追加在静态模板之后 (同一条 system 消息，兼容只接受单条 system 的 chat template)，
+        # token 前缀仍与其他请求一致，前缀缓存照常命中
+        system_text = f"{SYSTEM_PROMPT}\n{dynamic_text}\n" if dynamic_text else SYSTEM_PROMPT
+        messages = [SystemMessage(content=system_text)]
+
+        for turn in window:
+            cls = HumanMessage if turn["role"] == "user" else AIMessage
+            messages.append(cls(content=turn["content"]))
+        messages.append(HumanMessage(content=query))
+
+        prompt_tokens = (self.system_tokens
+                         + count_tokens(dynamic_text)
+                         + used
+                         + count_tokens(query) + _MESSAGE_OVERHEAD)
+        return PromptContext(messages, prompt_tokens, len(window), len(older))
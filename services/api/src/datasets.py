@@ -0,0 +1,185 @@
+import os
+import gzip
+import hashlib
+
+# 上传数据集的路径解析与元数据探测 (API 与 Worker 共用)
+# 只读文件头 / 索引，不加载表达矩阵，单次调用为毫秒级
+
+_TYPICAL_GENES = 30000         # 无法探测时假设的基因数
+_TYPICAL_GENES_PER_CELL = 2000  # 无法探测时假设的每细胞非零数
+
+
+def _file_name(f):
+    if isinstance(f, dict):
+        return f.get('name', '')
+    return getattr(f, 'name', '')
+
+
+def resolve_input(files, upload_dir: str):
+    """
+    根据上传文件列表确定流程输入：10x 目录 (含 matrix.mtx) 或单个文件
+    返回路径；没有文件时返回 None
+    """
+    if not files:
+        return None
+    for f in files:
+        if 'matrix.mtx' in _file_name(f):
+            return upload_dir
+    return os.path.join(upload_dir, _file_name(files[0]))
+
+
+# 多样本模式只接受可独立读取的单文件格式 (10x 目录上传后平铺在同一目录，无法区分样本)
+_SAMPLE_SUFFIXES = (".h5ad", ".loom")
+
+
+def resolve_samples(files, upload_dir: str):
+    """
+    多样本队列：上传了 2 个及以上单文件样本时返回 [(样本名, 路径)]，否则返回 None (单样本流程)
+    样本名取文件名去掉扩展名，重名时追加序号
+    """
+    if not files or any('matrix.mtx' in _file_name(f) for f in files):
+        return None
+    samples, seen = [], {}
+    for f in files:
+        name = _file_name(f)
+        if not name.endswith(_SAMPLE_SUFFIXES):
+            continue
+        path = os.path.join(upload_dir, name)
+        if any(path == p for _, p in samples):
+            continue
+        label = os.path.splitext(name)[0]
+        seen[label] = seen.get(label, 0) + 1
+        if seen[label] > 1:
+            label = f"{label}_{seen[label]}"
+        samples.append((label, path))
+    return samples if len(samples) >= 2 else None
+
+
+def dataset_key(path: str) -> str:
+    """数据集指纹：路径 + 大小 + 修改时间 (文件被覆盖后自动失效)"""
+    parts = [os.path.abspath(path)]
+    targets = [path]
+    if os.path.isdir(path):
+        targets = [os.path.join(path, n) for n in sorted(os.listdir(path))
+                   if n.startswith(("matrix", "features", "genes", "barcodes"))]
+    for t in targets:
+        st = os.stat(t)
+        parts.append(f"{os.path.basename(t)}:{st.st_size}:{int(st.st_mtime)}")
+    return hashlib.sha1("|".join(parts).encode()).hexdigest()[:16]
+
+
+def _find_mtx(path: str):
+    for name in ("matrix.mtx", "matrix.mtx.gz"):
+        candidate = os.path.join(path, name)
+        if os.path.exists(candidate):
+            return candidate
+    return None
+
+
+def _mtx_header(mtx_path: str):
+    opener = gzip.open if mtx_path.endswith(".gz") else open
+    with opener(mtx_path, "rt") as f:
+        for line in f:
+            if line.startswith("%"):
+                continue
+            rows, cols, nnz = (int(x) for x in line.split()[:3])
+            # 10x 的 mtx 为 genes x cells
+            return {"n_obs": cols, "n_vars": rows, "nnz": nnz}
+    return None
+
+
+def _h5ad_header(path: str):
+    import h5py
+    with h5py.File(path, "r") as f:
+        X = f["X"]
+        if isinstance(X, h5py.Group):
+            shape = X.attrs.get("shape", X.attrs.get("h5sparse_shape"))
+            return {"n_obs": int(shape[0]), "n_vars": int(shape[1]), "nnz": int(X["data"].shape[0])}
+        n_obs, n_vars = X.shape
+        # 稠密矩阵：非零数未知，按典型稀疏度估算
+        return {"n_obs": int(n_obs), "n_vars": int(n_vars),
+                "nnz": int(n_obs * min(n_vars, _TYPICAL_GENES_PER_CELL)), "estimated": True}
+
+
+def read_metadata(path: str) -> dict:
+    """
+    探测数据集规模：{n_obs, n_vars, nnz, format, bytes, estimated}
+    有索引/文件头时读精确值；否则按文件大小估算 (estimated=True)
+    """
+    meta = {"format": "unknown", "bytes": 0, "estimated": False}
+    if os.path.isdir(path):
+        mtx = _find_mtx(path)
+        meta["format"] = "10x_mtx"
+        if mtx:
+            meta["bytes"] = os.path.getsize(mtx)
+            try:
+                header = _mtx_header(mtx)
+                if header:
+                    meta.update(header)
+                    return meta
+            except (OSError, ValueError):
+                pass
+    else:
+        meta["bytes"] = os.path.getsize(path)
+        if path.endswith(".h5ad"):
+            meta["format"] = "h5ad"
+            try:
+                meta.update(_h5ad_header(path))
+                return meta
+            except Exception:
+                pass
+        else:
+            meta["format"] = os.path.splitext(path)[1].lstrip(".") or "unknown"
+
+    # 兜底估算：压缩存储下每个非零元素约 6 字节
+    nnz = max(1, meta["bytes"] // 6)
+    meta.update({"nnz": int(nnz), "n_vars": _TYPICAL_GENES,
+                 "n_obs": int(max(1, nnz // _TYPICAL_GENES_PER_CELL)), "estimated": True})
+    return meta
+
+
+def combine_metadata(metas: list) -> dict:
+    """多样本合并后的规模：细胞数 / 非零数相加，基因数取最大值 (inner join 后只会更少)"""
+    return {
+        "format": "multi_sample",
+        "n_samples": len(metas),
+        "bytes": sum(m["bytes"] for m in metas),
+        "n_obs": sum(m["n_obs"] for m in metas),
+        "n_vars": max(m["n_vars"] for m in metas),
+        "nnz": sum(m["nnz"] for m in metas),
+        "estimated": any(m.get("estimated") for m in metas),
+    }
+
+
+# ================= 预热 checkpoint =================
+# Worker 在用户点击“运行”之前预先解析数据集并计算 QC 指标，结果存为 {cache_dir}/{dataset_key}.h5ad
+# 正式运行时按同一指纹命中，跳过解析与 QC 指标计算
+
+def checkpoint_path(cache_dir: str, key: str) -> str:
+    return os.path.join(cache_dir, f"{key}.h5ad")
+
+
+def prune_cache(cache_dir: str, max_bytes: int, keep: str = None):
+    """按最近访问时间淘汰 checkpoint，直到总大小不超过 max_bytes (keep 指定的文件不删)"""
+    try:
+        entries = [os.path.join(cache_dir, n) for n in os.listdir(cache_dir) if n.endswith(".h5ad")]
+    except OSError:
+        return
+    stats = []
+    for path in entries:
+        try:
+            st = os.stat(path)
+        except OSError:
+            continue
+        stats.append((max(st.st_atime, st.st_mtime), st.st_size, path))
+    total = sum(size for _, size, _ in stats)
+    for _, size, path in sorted(stats):
+        if total <= max_bytes:
+            break
+        if keep and os.path.abspath(path) == os.path.abspath(keep):
+            continue
+        try:
+            os.remove(path)
+            total -= size
+        except OSError:
+            pass
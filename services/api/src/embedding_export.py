@@ -0,0 +1,141 @@
+import os
+import json
+import struct
+import numpy as np
+
+# 二进制 embedding 文件格式 (.gemb, 小端序)，供前端 WebGL 直接绘制：
+#
+#   magic  b"GEMB" | version u16 | reserved u16 | header_len u32 | header JSON (utf-8，补齐到 8 字节)
+#   coords   float32[n, 2]   按随机排列存储
+#   codes    uint8/uint16[n] 聚类类别编码 (可选，与 coords 同序)；未分配类别 (pandas 的 -1) 存为 header 里的 missing_code
+#   index    uint32[n]       第 i 个点对应的原始细胞行号 (用于和基因表达等查询结果对齐)
+#
+# 点已经随机打乱，所以任意前缀都是整体的均匀下采样：
+# LOD 第 k 层 = 前 levels[k]["n"] 个点，客户端只需一次 Range 请求读取前缀即可渐进加载。
+
+MAGIC = b"GEMB"
+VERSION = 1
+_PREAMBLE = struct.Struct("<4sHHI")
+
+
+def _lod_sizes(n: int, min_points: int, factor: int) -> list:
+    # 从全量开始每层缩小 factor 倍，最粗一层不少于 min_points
+    sizes = [n]
+    while sizes[-1] // factor >= min_points:
+        sizes.append(sizes[-1] // factor)
+    return sorted(sizes)
+
+
+def write_embedding(path: str, coords, codes=None, categories=None, basis: str = "umap",
+                    min_points: int = 20000, lod_factor: int = 4, seed: int = 0, rows=None) -> dict:
+    """
+    写出 embedding 二进制文件，返回 header (含每层 LOD 的字节区间)
+    codes: 聚类类别编码 (pandas cat.codes，-1 表示未分配)；rows: coords 的每一行对应的原始细胞行号 (embedding 只在抽样子集上计算时传入)
+    """
+    coords = np.ascontiguousarray(np.asarray(coords)[:, :2], dtype="<f4")
+    n = coords.shape[0]
+    perm = np.random.default_rng(seed).permutation(n)
+    coords = coords[perm]
+    order = (np.asarray(rows)[perm] if rows is not None else perm).astype("<u4")
+
+    code_arr = None
+    code_dtype = None
+    missing_code = None
+    if codes is not None:
+        # 类型的最大值留作 "未分配" 哨兵，类别编码只能占用 [0, 最大值)
+        n_categories = len(categories or [])
+        code_dtype = "<u1" if n_categories < 255 else "<u2"
+        missing_code = int(np.iinfo(code_dtype).max)
+        if n_categories > missing_code:
+            raise ValueError(f"类别数 {n_categories} 超过 embedding 编码上限 {missing_code}")
+        codes = np.asarray(codes)[perm]
+        if codes.size and (codes.max() >= n_categories or codes.min() < -1):
+            raise ValueError(f"聚类编码超出范围 [-1, {n_categories})")
+        code_arr = np.where(codes < 0, missing_code, codes).astype(code_dtype)
+
+    finite = coords[np.isfinite(coords).all(axis=1)]
+    bounds = ([float(finite[:, 0].min()), float(finite[:, 1].min()),
+               float(finite[:, 0].max()), float(finite[:, 1].max())] if len(finite) else [0, 0, 0, 0])
+
+    sizes = _lod_sizes(n, min_points, lod_factor)
+    code_size = np.dtype(code_dtype).itemsize if code_dtype else 0
+
+    def _build(sections):
+        return {
+            "basis": basis,
+            "n_points": int(n),
+            "dims": 2,
+            "bounds": bounds,
+            "categories": list(categories or []),
+            "code_dtype": code_dtype,
+            "missing_code": missing_code,
+            "sections": sections,
+            # 从粗到细，最后一层为全量；每层给出所需各段的字节区间 [start, end)，可直接拼成 Range 请求
+            "levels": [{
+                "n": m,
+                "coords": [sections["coords"][0], sections["coords"][0] + m * 8],
+                "codes": ([sections["codes"][0], sections["codes"][0] + m * code_size]
+                          if "codes" in sections else None),
+            } for m in sizes],
+        }
+
+    def _encode(h, pad_to=0):
+        raw = json.dumps(h, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+        raw += b" " * max(0, pad_to - len(raw))
+        return raw + b" " * (-(_PREAMBLE.size + len(raw)) % 8)
+
+    # header 长度依赖数据段偏移量：先用足够大的占位偏移量定出 header 长度
+    placeholder = {k: [10 ** 12, 10 ** 12] for k in ("coords", "index")}
+    if code_arr is not None:
+        placeholder["codes"] = [10 ** 12, 10 ** 12]
+    header_len = len(_encode(_build(placeholder)))
+
+    offset = _PREAMBLE.size + header_len
+    sections = {"coords": [offset, coords.nbytes]}
+    offset += coords.nbytes
+    if code_arr is not None:
+        sections["codes"] = [offset, code_arr.nbytes]
+        offset += code_arr.nbytes + (-code_arr.nbytes % 4)
+    sections["index"] = [offset, order.nbytes]
+    header = _build(sections)
+    encoded = _encode(header, pad_to=header_len)
+    assert len(encoded) == header_len
+
+    tmp = f"{path}.tmp"
+    with open(tmp, "wb") as f:
+        f.write(_PREAMBLE.pack(MAGIC, VERSION, 0, header_len))
+        f.write(encoded)
+        f.write(coords.tobytes())
+        if code_arr is not None:
+            f.write(code_arr.tobytes())
+            f.write(b"\0" * (-code_arr.nbytes % 4))
+        f.write(order.tobytes())
+    os.replace(tmp, path)
+    header["file_bytes"] = os.path.getsize(path)
+    return header
+
+
+def read_header(path: str) -> dict:
+    with open(path, "rb") as f:
+        magic, version, _, header_len = _PREAMBLE.unpack(f.read(_PREAMBLE.size))
+        if magic != MAGIC:
+            raise ValueError("不是 GEMB embedding 文件")
+        return json.loads(f.read(header_len).decode("utf-8"))
+
+
+def read_embedding(path: str, level: int = -1):
+    """读取某一层 LOD，返回 (header, coords, codes, index)"""
+    header = read_header(path)
+    n = header["levels"][level]["n"]
+    with open(path, "rb") as f:
+        start, _ = header["sections"]["coords"]
+        f.seek(start)
+        coords = np.frombuffer(f.read(n * 8), dtype="<f4").reshape(n, 2)
+        codes = None
+        if "codes" in header["sections"]:
+            dtype = np.dtype(header["code_dtype"])
+            f.seek(header["sections"]["codes"][0])
+            codes = np.frombuffer(f.read(n * dtype.itemsize), dtype=dtype)
+        f.seek(header["sections"]["index"][0])
+        index = np.frombuffer(f.read(n * 4), dtype="<u4")
+    return header, coords, codes, index
@@ -0,0 +1,251 @@
+import numpy as np
+import pandas as pd
+import scipy.sparse as sp
+
+# 融合预处理：一次扫描 CSR 的 data / indices 完成
+#   QC 指标 (每细胞总计数 / 检出基因数 / 线粒体比例 / top-N 基因占比，每基因检出细胞数 / 总计数)
+#   -> 过滤 (min_genes + max_mt) -> normalize_total -> log1p -> 每基因均值 / 方差 (seurat 风格 HVG 统计)
+# 结果与 calculate_qc_metrics + filter_cells + normalize_total + log1p + highly_variable_genes(flavor="seurat")
+# 的步骤序列一致 (浮点误差内)，但只读一遍矩阵，保留下来的行原地压缩写回同一个 data / indices 数组，不产生中间副本。
+# numba 未安装或矩阵不是 CSR 时由调用方退回 scanpy 步骤。
+try:
+    from numba import njit, prange, get_num_threads
+except ImportError:
+    njit = None
+
+# 与 sc.pp.calculate_qc_metrics 的默认 percent_top 一致
+PERCENT_TOP = (50, 100, 200, 500)
+MT_PREFIXES = ('MT-', 'mt-')
+# top-N 占比直方图覆盖的整数计数范围
+HIST_BINS = 256
+
+
+def _sweep(data, indices, indptr, mt, percent_top, min_genes, max_mt, target_sum, normalize, hvg, n_chunks):
+    """
+    按行块并行扫描；每行在缓存还热的时候依次完成 QC -> 过滤判断 -> 原地 normalize + log1p -> HVG 累加
+    每基因的累加量按行块分开存放 (无写冲突)，最后再求和
+    返回 (细胞指标, 保留掩码, 每基因 QC 指标, 每基因 HVG 累加量)
+    """
+    n_obs = len(indptr) - 1
+    n_vars = len(mt)
+    total = np.zeros(n_obs, dtype=np.float64)
+    total_mt = np.zeros(n_obs, dtype=np.float64)
+    n_genes = np.zeros(n_obs, dtype=np.int64)
+    top = np.zeros((n_obs, len(percent_top)), dtype=np.float64)
+    keep = np.zeros(n_obs, dtype=np.bool_)
+    gene_cells = np.zeros((n_chunks, n_vars), dtype=np.int64)
+    gene_total = np.zeros((n_chunks, n_vars), dtype=np.float64)
+    gene_sum = np.zeros((n_chunks, n_vars), dtype=np.float64)
+    gene_sumsq = np.zeros((n_chunks, n_vars), dtype=np.float64)
+    max_row = np.max(indptr[1:] - indptr[:-1]) if n_obs else 0
+
+    for c in prange(n_chunks):
+        hist = np.zeros(HIST_BINS, dtype=np.int64)
+        others = np.empty(max_row, dtype=data.dtype)
+        for i in range(c * n_obs // n_chunks, (c + 1) * n_obs // n_chunks):
+            start = indptr[i]
+            end = indptr[i + 1]
+            # ---- QC：本行的总计数 / 检出基因数 / 线粒体计数，以及每基因的检出统计 (过滤前全部细胞) ----
+            row_total = 0.0
+            row_mt = 0.0
+            row_genes = 0
+            n_other = 0
+            for j in range(start, end):
+                v = data[j]
+                g = indices[j]
+                row_total += v
+                gene_total[c, g] += v
+                if v > 0:
+                    row_genes += 1
+                    gene_cells[c, g] += 1
+                if mt[g]:
+                    row_mt += v
+                # top-N 占比：计数大多是小整数，记入直方图代替排序；大计数 / 非整数另存，排序后再归并
+                if 0 <= v < HIST_BINS and v == np.floor(v):
+                    hist[np.int64(v)] += 1
+                else:
+                    others[n_other] = v
+                    n_other += 1
+            total[i] = row_total
+            total_mt[i] = row_mt
+            n_genes[i] = row_genes
+
+            ordered = np.sort(others[:n_other])
+            o = n_other - 1
+            b = HIST_BINS - 1
+            acc = 0.0
+            k = 0
+            for t in range(len(percent_top)):
+                while k < percent_top[t] and k < end - start:
+                    while b > 0 and hist[b] == 0:
+                        b -= 1
+                    if o >= 0 and (hist[b] == 0 or ordered[o] >= b):
+                        acc += ordered[o]
+                        o -= 1
+                    else:
+                        acc += b
+                        hist[b] -= 1
+                    k += 1
+                top[i, t] = acc / row_total * 100 if row_total > 0 else np.nan
+            hist[:] = 0
+
+            # ---- 过滤：与 filter_cells(min_genes) 后再按 pct_counts_mt < max_mt 取子集一致 ----
+            pct_mt = row_mt / row_total * 100 if row_total > 0 else np.nan
+            if row_genes < min_genes or not (pct_mt < max_mt):
+                continue
+            keep[i] = True
+            if not normalize:
+                continue
+
+            # ---- normalize_total + log1p (与 scanpy 相同：float32 的每细胞因子 counts / target_sum) ----
+            factor = np.float32(np.float32(row_total) / np.float32(target_sum))
+            for j in range(start, end):
+                v = data[j]
+                if factor > 0:
+                    v = np.float32(v / factor)
+                data[j] = np.log1p(v)
+                if hvg:
+                    # seurat HVG 在 expm1(log1p(x)) 上计算均值 / 方差，这里直接用 log1p 之前的值 (差别在 float32 舍入误差内)
+                    g = indices[j]
+                    gene_sum[c, g] += v
+                    gene_sumsq[c, g] += np.float64(v) * v
+
+    return (total, total_mt, n_genes, top, keep,
+            gene_cells.sum(axis=0), gene_total.sum(axis=0), gene_sum.sum(axis=0), gene_sumsq.sum(axis=0))
+
+
+def _compact(data, indices, indptr, keep):
+    """把保留的行按顺序前移 (写位置永远不超过读位置，可以原地进行)，返回新的 indptr"""
+    new_indptr = np.zeros(keep.sum() + 1, dtype=indptr.dtype)
+    out = 0
+    row = 0
+    for i in range(len(keep)):
+        if not keep[i]:
+            continue
+        for j in range(indptr[i], indptr[i + 1]):
+            data[out] = data[j]
+            indices[out] = indices[j]
+            out += 1
+        row += 1
+        new_indptr[row] = out
+    return new_indptr
+
+
+# 不开 cache：技能以 fused_preprocess / src.fused_preprocess 两种模块名加载本文件，
+# numba 磁盘缓存记录的是导入时的模块名，另一种名字的进程读到缓存会 ModuleNotFoundError
+if njit is not None:
+    _sweep_jit = njit(nogil=True, parallel=True)(_sweep)
+    _compact_jit = njit(nogil=True)(_compact)
+else:
+    _sweep_jit = _compact_jit = None
+
+
+def available(adata) -> bool:
+    """numba 可用且表达矩阵为 CSR (非视图) 时可以走融合路径"""
+    X = adata.X
+    return (_sweep_jit is not None and not adata.is_view
+            and sp.issparse(X) and X.format == "csr")
+
+
+def _seurat_hvg(mean, var, n_top_genes, n_bins=20) -> pd.DataFrame:
+    """与 sc.pp.highly_variable_genes(flavor="seurat", n_top_genes=...) 相同的分箱归一化与选取"""
+    mean = mean.copy()
+    mean[mean == 0] = 1e-12
+    dispersion = var / mean
+    dispersion[dispersion == 0] = np.nan
+    with np.errstate(divide="ignore", invalid="ignore"):
+        dispersion = np.log(dispersion)
+    mean = np.log1p(mean)
+
+    df = pd.DataFrame({"means": mean, "dispersions": dispersion})
+    df["mean_bin"] = pd.cut(df["means"], bins=n_bins)
+    stats = df.groupby("mean_bin", observed=True)["dispersions"].agg(avg="mean", dev="std")
+    # 箱里只有一个基因时 std 为 NaN：该基因的归一化离散度记为 1
+    single = stats["dev"].isnull()
+    stats.loc[single, "dev"] = stats.loc[single, "avg"]
+    stats.loc[single, "avg"] = 0
+    stats = stats.loc[df["mean_bin"]].set_index(df.index)
+    df["dispersions_norm"] = (df["dispersions"] - stats["avg"]) / stats["dev"]
+
+    norm = df["dispersions_norm"].to_numpy()
+    ranked = np.sort(norm[~np.isnan(norm)])[::-1]
+    n_top = min(n_top_genes, len(mean), len(ranked))
+    cutoff = ranked[n_top - 1] if n_top else np.inf
+    df["highly_variable"] = np.nan_to_num(norm, nan=-np.inf) >= cutoff
+    return df
+
+
+def fused_preprocess(adata, min_genes: int = 200, max_mt: float = 20, target_sum=1e4, n_top_genes=None):
+    """
+    单次扫描完成 QC + 过滤 + LogNormalize (+ HVG 统计)，返回过滤后的新 AnnData
+    - adata.obs / adata.var 写入全部细胞的 QC 指标 (与 calculate_qc_metrics 同名列，可直接画过滤前的小提琴图)
+    - adata.X 的 data / indices 被原地复用为结果矩阵：float32 且可写时直接改写调用方的 X.data，
+      调用后 adata.X 替换为空矩阵，原矩阵 (及共享它的其它引用) 不再可用
+    - 非 float32 的输入 (如 float64) 先转成 float32 副本再扫描，结果矩阵为 float32，与 scanpy 在 float32 数据上的结果一致
+    target_sum=None 时只做 QC 过滤；n_top_genes 需要配合 target_sum，结果写入 var 的 highly_variable 等列
+    """
+    if not available(adata):
+        raise ValueError("融合预处理需要 numba 与 CSR 格式的表达矩阵")
+    normalize = target_sum is not None
+    if n_top_genes and not normalize:
+        raise ValueError("HVG 统计需要在 LogNormalize 之后计算 (target_sum 不能为空)")
+
+    X = adata.X
+    data = X.data
+    if data.dtype != np.float32 or not data.flags.writeable:
+        data = data.astype(np.float32)
+    indices = X.indices if X.indices.flags.writeable else X.indices.copy()
+    mt = np.asarray(adata.var_names.str.startswith(MT_PREFIXES))
+    adata.var['mt'] = mt
+
+    (total, total_mt, n_genes, top, keep,
+     gene_cells, gene_total, gene_sum, gene_sumsq) = _sweep_jit(
+        data, indices, X.indptr, mt, np.asarray(PERCENT_TOP, dtype=np.int64),
+        int(min_genes), float(max_mt), float(target_sum or 1), normalize, bool(n_top_genes),
+        max(1, min(get_num_threads(), adata.n_obs)))
+    indptr = _compact_jit(data, indices, X.indptr, keep)
+
+    # ---- QC 指标 (全部细胞) ----
+    n_obs = adata.n_obs
+    total32 = total.astype(np.float32)
+    mt32 = total_mt.astype(np.float32)
+    obs = adata.obs
+    obs['n_genes_by_counts'] = n_genes.astype(np.int32)
+    obs['log1p_n_genes_by_counts'] = np.log1p(n_genes)
+    obs['total_counts'] = total32
+    obs['log1p_total_counts'] = np.log1p(total32)
+    for t, n in enumerate(PERCENT_TOP):
+        obs[f'pct_counts_in_top_{n}_genes'] = top[:, t]
+    obs['total_counts_mt'] = mt32
+    obs['log1p_total_counts_mt'] = np.log1p(mt32)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        obs['pct_counts_mt'] = mt32 / total32 * 100
+    var = adata.var
+    var['n_cells_by_counts'] = gene_cells
+    var['mean_counts'] = gene_total / max(n_obs, 1)
+    var['log1p_mean_counts'] = np.log1p(var['mean_counts'].to_numpy())
+    var['pct_dropout_by_counts'] = (1 - gene_cells / max(n_obs, 1)) * 100
+    var['total_counts'] = gene_total.astype(np.float32)
+    var['log1p_total_counts'] = np.log1p(var['total_counts'].to_numpy())
+
+    # ---- 组装过滤后的对象：先换成空矩阵再切片，obs / obsm / layers 由 anndata 负责按行取子集 ----
+    nnz = int(indptr[-1])
+    result = sp.csr_matrix((data[:nnz], indices[:nnz], indptr), shape=(len(indptr) - 1, adata.n_vars))
+    adata.X = sp.csr_matrix(adata.shape, dtype=np.float32)
+    out = adata[keep].copy()
+    out.X = result
+    out.obs['n_genes'] = n_genes[keep]
+    if normalize:
+        out.uns['log1p'] = {'base': None}
+
+    if n_top_genes:
+        n = max(out.n_obs, 1)
+        mean = gene_sum / n
+        var_ = (gene_sumsq / n - mean ** 2) * (n / max(n - 1, 1))
+        df = _seurat_hvg(mean, var_, int(n_top_genes))
+        out.uns['hvg'] = {'flavor': 'seurat'}
+        out.var['highly_variable'] = df['highly_variable'].to_numpy()
+        out.var['means'] = df['means'].to_numpy()
+        out.var['dispersions'] = df['dispersions'].to_numpy()
+        out.var['dispersions_norm'] = df['dispersions_norm'].to_numpy().astype(np.float32)
+    return out
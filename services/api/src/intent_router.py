@@ -0,0 +1,515 @@
+import re
+import math
+import time
+import random
+from collections import Counter, deque
+from typing import Dict, List, Optional
+
+# 本地意图路由：命令式消息 ("把分辨率改成 0.8 再跑一次"、"重新画 UMAP") 在 CPU 上亚毫秒内转成工作流卡片，不占用 vLLM
+#   1. 多模式匹配：步骤 / 参数 / 取值 / 动作词 / 疑问词的别名编译成一个正则，一次扫描得到全部命中
+#   2. 分类器：多项式朴素贝叶斯 (特征 = 命中类别 + 剩余字符 / 单词的一元、二元组)，训练语料由技能 META 模板 × 别名生成
+#   3. 参数抽取：参数别名后跟连接词 (改成 / 设为 / to / = ...) 和取值，按 META 默认值推断类型并校验
+# 置信度不足、识别为问答、取值不合法或没有可执行的动作时退回大模型。
+
+# Celery 任务 id (即 run_id) 为 UUID
+RUN_ID_PATTERN = re.compile(r"[0-9a-f]{8}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{12}", re.I)
+
+# 原有的显式关键词规则 (参考映射优先：“映射到参考流程”也应走映射)，命中即路由，置信度记为 1
+MAPPING_KEYWORDS = ("映射", "reference mapping", "map to reference")
+WORKFLOW_KEYWORDS = ("规划", "流程", "workflow", "pipeline")
+
+WORKFLOW = "workflow"
+MAPPING = "mapping"
+CHAT = "chat"
+# 意图 -> 对应技能
+INTENT_SKILLS = {WORKFLOW: "scanpy_local", MAPPING: "reference_mapping"}
+
+# 步骤别名 (META 的步骤名 / tool_id 自动加入，这里补充中文与常见说法)
+STEP_ALIASES = {
+    "local_qc": ["质控", "质量控制", "过滤细胞", "qc"],
+    "local_normalize": ["标准化", "归一化", "normalization"],
+    "local_hvg": ["高变基因", "highly variable genes", "variable genes"],
+    "local_scale": ["缩放", "scaling"],
+    "local_pca": ["主成分分析", "降维"],
+    "local_neighbors": ["邻接图", "近邻图", "knn图", "neighbor graph"],
+    "local_cluster": ["聚类", "leiden", "clustering"],
+    "local_umap": ["umap图", "umap"],
+    "local_tsne": ["tsne图", "t-sne", "tsne"],
+    "local_markers": ["标记基因", "差异基因", "marker基因", "marker", "markers"],
+    "local_map_reference": ["参考映射", "投影到参考", "map to reference"],
+}
+# 参数别名 (参数名本身自动加入；不要与步骤别名重名，例如 "neighbors")
+PARAM_ALIASES = {
+    "min_genes": ["最少基因数", "最小基因数", "最低基因数", "基因数下限", "基因数阈值", "min genes"],
+    "max_mt": ["线粒体比例", "线粒体上限", "线粒体阈值", "线粒体", "mt比例", "max mt", "mt%", "mito"],
+    "resolution": ["聚类分辨率", "分辨率", "resolution", "res"],
+    "n_neighbors": ["邻居数", "近邻数", "邻居个数", "k值", "n neighbors"],
+    "n_pcs": ["主成分数", "主成分个数", "pc数", "n pcs", "pcs"],
+    "n_comps": ["成分数", "n comps", "components"],
+    "svd_solver": ["svd求解器", "求解器", "svd solver", "solver"],
+    "tsne_mode": ["t-sne策略", "tsne策略", "t-sne模式", "tsne模式", "tsne mode"],
+    "tsne_sketch_size": ["抽样细胞数", "抽样数", "sketch size"],
+    "render_png": ["出图", "render png"],
+    "reference_run": ["参考run", "参考 run", "reference run"],
+}
+# 枚举型参数：取值 -> 别名
+PARAM_CHOICES = {
+    "svd_solver": {"arpack": ["arpack", "精确"], "randomized": ["randomized", "随机化"]},
+    "tsne_mode": {"full": ["full", "全量"], "sketch": ["sketch", "抽样"], "skip": ["skip", "跳过"],
+                  "auto": ["auto", "自动"]},
+    "render_png": {"true": ["true", "开启"], "false": ["false", "关闭"]},
+}
+# 数值参数的合法范围 (未列出的整数参数要求 >= 1，浮点参数要求 > 0)
+PARAM_BOUNDS = {"min_genes": (0, 100000), "max_mt": (0, 100), "resolution": (0.01, 20)}
+
+VERB_ALIASES = {
+    "rerun": ["再跑一次", "再跑一遍", "再跑", "重跑", "重新跑", "重新运行", "重新执行", "再运行一次", "重新分析",
+              "再来一次", "重做", "重新做", "rerun", "re-run", "run again", "run it again"],
+    "run": ["跑一下", "跑一遍", "运行", "执行", "开始分析", "分析一下", "帮我分析", "跑流程",
+            "run", "execute", "analyze", "analyse"],
+    "redraw": ["重新画", "重画", "再画", "重新绘制", "重新出图", "画一下", "画一个", "画个", "绘制",
+               "redraw", "replot", "re-plot", "plot", "draw"],
+    "set": ["改成", "改为", "改到", "设为", "设成", "设置为", "设置成", "设置", "设到", "调到", "调成", "调为",
+            "调整为", "调整到", "调高", "调低", "换成", "改用", "修改", "set", "change", "use", "switch"],
+}
+QUESTION_MARKERS = ["什么", "为什么", "怎么", "怎样", "如何", "吗", "呢", "哪些", "哪个", "是否", "能否", "区别",
+                    "意思", "解释", "建议", "合适", "推荐", "?", "？",
+                    "what", "why", "how", "which", "explain", "should", "difference"]
+
+# 超过这个长度的消息通常包含多重要求，交给大模型
+MAX_CHARS = 80
+
+# 数值取值：参数别名之后允许 "从 x" 与不超过 6 个字符的连接词 (改成 / 设为 / to / = ...)
+_NUMBER_AFTER = re.compile(r"\s*(?:(?:从|from)\s*-?\d+(?:\.\d+)?\s*)?[^\d，,;；。]{0,6}?(-?\d+(?:\.\d+)?)")
+_GAP_TOKEN = re.compile(r"[a-z_]+|[㐀-鿿]")
+
+# 生成训练语料的模板：{step} / {param} / {value} / {choice} / {run} 由别名表填充，{analysis} / {gene} 取下面的样例
+_TEMPLATES = {
+    WORKFLOW: [
+        "把{param}改成{value}再跑一次", "{param}改成{value}", "{param}设为{value}", "{param}调到{value}重新跑",
+        "将{param}设置为{value}", "{param}={value}", "{param} {value}", "把{param}调成{value}重新分析",
+        "用{param} {value}重新运行", "{param}从{value}改成{value}", "{param}换成{value}再跑",
+        "set {param} to {value}", "change {param} to {value} and rerun", "rerun with {param} {value}",
+        "use {param} {value}", "{param}改成{value}，{param}设为{value}",
+        "重新画{step}", "重画一下{step}", "再画一次{step}", "帮我画{step}", "画个{step}", "重新绘制{step}",
+        "redraw {step}", "replot the {step}", "重新跑一下{step}", "重新做{step}", "rerun {step}",
+        "{step}重新跑一遍", "{step}用{choice}", "{step}改用{choice}再跑", "{step} {choice}",
+        "再跑一次", "重新运行", "重新分析一下", "再来一次", "run it again", "跑一下分析", "开始分析",
+        "帮我分析这个数据", "帮我跑一遍单细胞分析", "run the analysis",
+    ],
+    MAPPING: [
+        "把这个样本映射到{run}", "映射到参考 {run}", "用{run}做参考", "以{run}为参考注释新样本",
+        "把新样本投影到{run}上", "投影到参考 run {run}", "map this sample onto {run}",
+        "project the new data onto {run}", "参考 {run} 注释新样本", "把新数据投影到参考上",
+    ],
+    CHAT: [
+        "什么是{step}", "{step}是什么", "{step}是什么意思", "为什么要做{step}", "{step}有什么用",
+        "{param}一般设多少合适", "{param}设为{value}合适吗", "{param}是什么意思", "如何选择{param}",
+        "{param}调到{value}会有什么影响", "{param}越大越好吗", "为什么要把{param}调到{value}",
+        "{param}改成{value}会怎样", "为什么{param}用{value}", "{step}为什么要用{choice}", "{step}和{step}有什么区别",
+        "怎么解读{step}结果", "{step}的结果说明了什么", "解释一下{step}", "{step}结果怎么看",
+        "what is {step}", "why is {step} needed", "how should i choose {param}", "is {param} {value} reasonable?",
+        "explain the {step} result", "what does {param} mean",
+        "你好", "谢谢", "你是谁", "介绍一下你自己", "你能做什么", "这些基因说明什么细胞类型", "帮我解释这个结果",
+        "第{value}簇是什么细胞", "cd3e 是什么基因", "写一段方法学描述", "帮我总结一下分析结果",
+        "这个数据质量怎么样", "结果可信吗", "能推荐几篇文献吗", "hello", "thanks", "what can you do",
+        "how do i upload data", "这个报错是什么原因", "t细胞的 marker 有哪些",
+        # 流程里没有的分析 (即使带着动词和步骤名) 交给大模型
+        "画一个{analysis}", "帮我画一张{analysis}展示 {gene} 的表达", "画{analysis}", "执行{analysis}",
+        "做一下{analysis}", "帮我做{analysis}", "对第{value}簇做{analysis}", "{step}之后做{analysis}",
+        "run {analysis} on {step} {value}", "analyze {step} {value} vs {value}", "compare {step} {value} and {value}",
+        "draw a {analysis} of {gene}", "plot {gene} expression", "画出 {gene} 的表达",
+    ],
+}
+_SAMPLE_VALUES = ["0.8", "1.0", "1.2", "0.3", "300", "500", "10", "15", "30", "2000", "50"]
+_SAMPLE_ANALYSES = ["火山图", "热图", "小提琴图", "气泡图", "差异分析", "富集分析", "go富集分析", "gsea",
+                    "轨迹分析", "拟时序分析", "细胞通讯分析", "heatmap", "volcano plot", "violin plot",
+                    "trajectory analysis", "enrichment analysis"]
+_SAMPLE_GENES = ["cd3e", "ms4a1", "lyz", "gapdh", "nkg7"]
+_SAMPLE_RUN = "3f2a9c1e-7b4d-4e2f-9a1b-0c5d6e7f8a9b"
+_SAMPLES_PER_TEMPLATE = 12
+
+
+class RouteDecision:
+    """一次路由结果；local 为 True 时直接生成工作流卡片，否则交给大模型"""
+
+    def __init__(self, intent: str, method: str, confidence: float, skill_id: Optional[str] = None,
+                 action: Optional[str] = None, params: Optional[Dict[str, Dict[str, str]]] = None,
+                 steps: Optional[List[str]] = None, reason: Optional[str] = None):
+        self.intent = intent
+        self.method = method              # rule / classifier / fallback
+        self.confidence = confidence
+        self.skill_id = skill_id
+        self.action = action              # set_params / redraw / rerun / run / plan
+        self.params = params or {}        # {tool_id: {参数名: 取值}}
+        self.steps = steps or []          # 消息里提到的步骤 (tool_id)
+        self.reason = reason              # 退回大模型的原因
+        self.latency_us = 0.0
+
+    @property
+    def local(self) -> bool:
+        return self.method != "fallback"
+
+    def flat_params(self) -> Dict[str, str]:
+        flat = {}
+        for values in self.params.values():
+            flat.update(values)
+        return flat
+
+    def to_dict(self) -> dict:
+        return {"intent": self.intent, "method": self.method, "confidence": round(self.confidence, 4),
+                "skill_id": self.skill_id, "action": self.action, "params": self.params, "steps": self.steps,
+                "reason": self.reason, "latency_us": round(self.latency_us, 1)}
+
+
+class NaiveBayes:
+    """多项式朴素贝叶斯 (拉普拉斯平滑，类别先验取均匀分布，未见过的特征忽略)"""
+
+    def __init__(self, alpha: float = 0.5):
+        self.alpha = alpha
+        self.classes: List[str] = []
+        self.log_prob: Dict[str, List[float]] = {}
+
+    def fit(self, samples):
+        counts = {}
+        for features, label in samples:
+            counts.setdefault(label, Counter()).update(features)
+        self.classes = sorted(counts)
+        vocab = set().union(*counts.values())
+        self.log_prob = {}
+        for feature in vocab:
+            self.log_prob[feature] = [
+                math.log((counts[c][feature] + self.alpha) / (sum(counts[c].values()) + self.alpha * len(vocab)))
+                for c in self.classes]
+        return self
+
+    def predict(self, features):
+        """返回 (类别, 后验概率)"""
+        scores = [0.0] * len(self.classes)
+        for feature in features:
+            row = self.log_prob.get(feature)
+            if row is not None:
+                for i, value in enumerate(row):
+                    scores[i] += value
+        top = max(scores)
+        weights = [math.exp(s - top) for s in scores]
+        best = weights.index(1.0)
+        return self.classes[best], weights[best] / sum(weights)
+
+
+def _pattern(alias: str) -> str:
+    """ASCII 别名两侧要求不是字母数字，避免 "res" 命中 "result"；中文别名直接匹配"""
+    body = re.escape(alias)
+    if alias[0].isascii() and alias[0].isalnum():
+        body = r"(?<![a-z0-9_])" + body
+    if alias[-1].isascii() and alias[-1].isalnum():
+        body += r"(?![a-z0-9_])"
+    return body
+
+
+class IntentRouter:
+    """由技能 META 模板构建的本地意图路由器 (构建一次，route 为纯 CPU 计算、线程安全的只读操作 + 计数)"""
+
+    def __init__(self, skill_metas: List[dict], threshold: float = 0.8, enabled: bool = True,
+                 latency_window: int = 2048):
+        self.threshold = threshold
+        self.enabled = enabled
+        # 技能 -> {参数名: {"tools": [tool_id, ...], "kind": int / float / choice / run}}
+        self.skill_params: Dict[str, Dict[str, dict]] = {}
+        self.skill_tools: Dict[str, List[str]] = {}
+        # 别名 -> [(类别, 标识)]；类别为 step / param / choice / rerun / run / redraw / set / question
+        self.lexicon: Dict[str, List[tuple]] = {}
+
+        for meta in skill_metas:
+            self._register_skill(meta)
+        for verb, aliases in VERB_ALIASES.items():
+            for alias in aliases:
+                self._add(alias, verb, verb)
+        for alias in QUESTION_MARKERS:
+            self._add(alias, "question", "question")
+
+        # 长别名优先 ("再跑一次" 先于 "再跑")，数字与 run id 作为额外分支
+        aliases = sorted(self.lexicon, key=len, reverse=True)
+        self.matcher = re.compile(
+            r"(?P<run>" + RUN_ID_PATTERN.pattern + r")"
+            r"|(?P<alias>" + "|".join(_pattern(a) for a in aliases) + r")"
+            r"|(?P<num>(?<![a-z0-9_.])-?\d+(?:\.\d+)?)")
+
+        self.classifier = NaiveBayes().fit(self._training_samples())
+
+        self._counters = Counter()
+        self._intents = Counter()
+        self._fallback_reasons = Counter()
+        self._latencies = deque(maxlen=latency_window)
+
+    # ---------------- 构建 ----------------
+    def _add(self, alias: str, kind: str, ident: str):
+        entries = self.lexicon.setdefault(alias.lower(), [])
+        if (kind, ident) not in entries:
+            entries.append((kind, ident))
+
+    def _register_skill(self, meta: dict):
+        skill_id = meta["id"]
+        params = self.skill_params.setdefault(skill_id, {})
+        tools = self.skill_tools.setdefault(skill_id, [])
+        for step in meta.get("template", {}).get("steps", []):
+            tool_id = step["tool_id"]
+            tools.append(tool_id)
+            for alias in [step["name"], tool_id, tool_id.replace("local_", "")] + STEP_ALIASES.get(tool_id, []):
+                self._add(alias, "step", tool_id)
+            for name, default in step.get("params", {}).items():
+                kind = self._param_kind(name, str(default))
+                if kind is None:
+                    continue
+                spec = params.setdefault(name, {"tools": [], "kind": kind})
+                spec["tools"].append(tool_id)
+                for alias in [name, name.replace("_", " ")] + PARAM_ALIASES.get(name, []):
+                    self._add(alias, "param", name)
+                for value, aliases in PARAM_CHOICES.get(name, {}).items():
+                    for alias in aliases:
+                        self._add(alias, "choice", f"{name}={value}")
+
+    @staticmethod
+    def _param_kind(name: str, default: str) -> Optional[str]:
+        """按 META 默认值推断参数类型；推断不出的参数不做本地抽取"""
+        if name in PARAM_CHOICES:
+            return "choice"
+        if name == "reference_run":
+            return "run"
+        if default.isdigit():
+            return "int"
+        try:
+            float(default)
+            return "float"
+        except ValueError:
+            return None
+
+    def _training_samples(self):
+        """模板 × 别名生成训练语料 (固定随机种子，每次启动得到同一个模型)"""
+        rng = random.Random(0)
+        step_aliases, param_aliases, choice_aliases = [], [], []
+        for alias, entries in self.lexicon.items():
+            for kind, ident in entries:
+                if kind == "step":
+                    step_aliases.append(alias)
+                elif kind == "param" and self._kind_of(ident) in ("int", "float"):
+                    param_aliases.append(alias)
+                elif kind == "choice":
+                    choice_aliases.append(alias)
+        fillers = {"step": sorted(set(step_aliases)), "param": sorted(set(param_aliases)),
+                   "choice": sorted(set(choice_aliases)) or ["auto"], "value": _SAMPLE_VALUES, "run": [_SAMPLE_RUN],
+                   "analysis": _SAMPLE_ANALYSES, "gene": _SAMPLE_GENES}
+
+        samples = []
+        for label, templates in _TEMPLATES.items():
+            for template in templates:
+                for _ in range(_SAMPLES_PER_TEMPLATE):
+                    text = re.sub(r"\{(\w+)\}", lambda m: rng.choice(fillers[m.group(1)]), template)
+                    samples.append((self._features(self._scan(text.lower())[0]), label))
+        return samples
+
+    def _kind_of(self, name: str) -> Optional[str]:
+        for params in self.skill_params.values():
+            if name in params:
+                return params[name]["kind"]
+        return None
+
+    # ---------------- 扫描 / 特征 ----------------
+    def _scan(self, text: str):
+        """一次正则扫描：返回 (token 序列, 命中列表 [(start, end, 类别, 标识)])"""
+        tokens, hits = [], []
+        pos = 0
+        for m in self.matcher.finditer(text):
+            tokens.extend(_GAP_TOKEN.findall(text, pos, m.start()))
+            pos = m.end()
+            if m.lastgroup == "run":
+                tokens.append("#run_id")
+                hits.append((m.start(), m.end(), "run_id", m.group(0)))
+            elif m.lastgroup == "num":
+                tokens.append("#num")
+                hits.append((m.start(), m.end(), "num", m.group(0)))
+            else:
+                entries = self.lexicon[m.group(0)]
+                tokens.append("#" + "/".join(kind for kind, _ in entries))
+                for kind, ident in entries:
+                    hits.append((m.start(), m.end(), kind, ident))
+        tokens.extend(_GAP_TOKEN.findall(text, pos))
+        return tokens, hits
+
+    @staticmethod
+    def _features(tokens):
+        features = list(tokens)
+        padded = ["^"] + tokens + ["$"]
+        features.extend(a + "|" + b for a, b in zip(padded, padded[1:]))
+        return features
+
+    # ---------------- 参数抽取 ----------------
+    def _extract(self, text: str, hits, skill_id: str):
+        """返回 ({tool_id: {参数名: 取值}}, 提到的步骤, 取值不合法的参数)"""
+        registry = self.skill_params.get(skill_id, {})
+        tools = self.skill_tools.get(skill_id, [])
+        steps = []
+        for _, _, kind, ident in hits:
+            if kind == "step" and ident in tools and ident not in steps:
+                steps.append(ident)
+
+        values, invalid = {}, []
+        param_starts = sorted(start for start, _, kind, _ in hits if kind in ("param", "step"))
+        for start, end, kind, ident in hits:
+            if kind != "param" or ident not in registry or ident in values:
+                continue
+            limit = next((s for s in param_starts if s >= end), len(text))
+            value = self._value_after(text, end, limit, hits, ident, registry[ident]["kind"])
+            if value is None:
+                invalid.append(ident)
+            else:
+                values[ident] = value
+        # 省略参数名的枚举取值 ("t-SNE 跳过"、"PCA 用 randomized")：参数所属步骤被提到时才采用
+        for _, _, kind, ident in hits:
+            if kind != "choice":
+                continue
+            name, value = ident.split("=", 1)
+            spec = registry.get(name)
+            if spec and name not in values and set(spec["tools"]) & set(steps):
+                values[name] = value
+        if skill_id == "reference_mapping" and "reference_run" in registry:
+            run = next((ident for _, _, kind, ident in hits if kind == "run_id"), None)
+            if run:
+                values["reference_run"] = run.lower()
+        invalid = [name for name in invalid if name not in values]
+
+        params = {}
+        for name, value in values.items():
+            spec = registry[name]
+            # 同名参数出现在多个步骤 (如 UMAP / t-SNE 的 render_png) 时，优先落到消息里提到的步骤
+            targets = [t for t in spec["tools"] if t in steps] or spec["tools"]
+            for tool_id in targets:
+                params.setdefault(tool_id, {})[name] = value
+        return params, steps, invalid
+
+    @staticmethod
+    def _value_after(text, end, limit, hits, name, kind):
+        if kind == "choice":
+            for start, _, hit_kind, ident in hits:
+                if hit_kind == "choice" and end <= start < min(limit, end + 8) and ident.startswith(name + "="):
+                    return ident.split("=", 1)[1]
+            return None
+        if kind == "run":
+            run = RUN_ID_PATTERN.search(text, end)
+            return run.group(0).lower() if run else None
+
+        m = _NUMBER_AFTER.match(text, end)
+        if not m or m.start(1) >= limit:
+            return None
+        raw = m.group(1)
+        try:
+            value = int(raw) if kind == "int" else float(raw)
+        except ValueError:
+            return None
+        low, high = PARAM_BOUNDS.get(name, (1 if kind == "int" else 1e-9, math.inf))
+        if not low <= value <= high:
+            return None
+        return raw
+
+    # ---------------- 路由 ----------------
+    def route(self, query: str) -> RouteDecision:
+        start = time.perf_counter()
+        decision = self._decide((query or "").lower().strip())
+        decision.latency_us = (time.perf_counter() - start) * 1e6
+        self._record(decision)
+        return decision
+
+    def _decide(self, text: str) -> RouteDecision:
+        if not text:
+            return RouteDecision(CHAT, "fallback", 0.0, reason="empty")
+
+        # 1. 原有关键词规则 (置信度 1)
+        intent = None
+        if (any(k in text for k in MAPPING_KEYWORDS)
+                or ("参考" in text and RUN_ID_PATTERN.search(text))):
+            intent = MAPPING
+        elif any(k in text for k in WORKFLOW_KEYWORDS):
+            intent = WORKFLOW
+        if intent is None and not self.enabled:
+            return RouteDecision(CHAT, "fallback", 0.0, reason="disabled")
+        if intent is None and len(text) > MAX_CHARS:
+            return RouteDecision(CHAT, "fallback", 0.0, reason="too_long")
+
+        tokens, hits = self._scan(text)
+        if intent is not None:
+            method, confidence = "rule", 1.0
+        else:
+            # 2. 分类器
+            method = "classifier"
+            intent, confidence = self.classifier.predict(self._features(tokens))
+            if intent == CHAT:
+                return RouteDecision(CHAT, "fallback", confidence, reason="chat")
+            if confidence < self.threshold:
+                return RouteDecision(intent, "fallback", confidence, reason="low_confidence")
+
+        # 3. 参数抽取
+        skill_id = INTENT_SKILLS[intent]
+        params, steps, invalid = self._extract(text, hits, skill_id)
+        verbs = {kind for _, _, kind, _ in hits if kind in VERB_ALIASES}
+        if params:
+            action = "set_params"
+        elif intent == MAPPING:
+            # 映射卡片离不开参考 run：分类器路由要求消息里带 run id (落在上面的 set_params)
+            action = "plan" if method == "rule" else None
+        elif not steps:
+            # 只有动词 ("画一个火山图"、"执行差异分析") 说明不了要跑流程里的哪一步，分类器路由不接
+            action = "plan" if method == "rule" else None
+        elif "redraw" in verbs:
+            action = "redraw"
+        elif verbs & {"rerun", "run"}:
+            action = "rerun" if "rerun" in verbs else "run"
+        else:
+            action = "plan" if method == "rule" else None
+
+        if method == "classifier":
+            # 分类器路由还要求有可执行的内容：提到的参数都能解析，且识别出了要做的事
+            if invalid:
+                return RouteDecision(intent, "fallback", confidence, skill_id=skill_id, reason="invalid_value")
+            if action is None:
+                return RouteDecision(intent, "fallback", confidence, skill_id=skill_id, reason="no_action")
+        return RouteDecision(intent, method, confidence, skill_id=skill_id, action=action,
+                             params=params, steps=steps)
+
+    # ---------------- 指标 ----------------
+    def _record(self, decision: RouteDecision):
+        self._counters["routed"] += 1
+        self._counters[decision.method] += 1
+        self._latencies.append(decision.latency_us)
+        if decision.local:
+            self._intents[decision.intent] += 1
+            # 关键词规则本来就不走大模型，只有分类器接住的消息算作节省的 LLM 调用
+            if decision.method == "classifier":
+                self._counters["llm_calls_saved"] += 1
+        else:
+            self._fallback_reasons[decision.reason] += 1
+
+    def snapshot(self) -> dict:
+        """导出路由决策计数、节省的 LLM 调用数与路由耗时分位数 (微秒)"""
+        latencies = sorted(self._latencies)
+
+        def pct(p):
+            if not latencies:
+                return 0.0
+            return round(latencies[min(len(latencies) - 1, int(p * len(latencies)))], 1)
+
+        routed = self._counters["routed"]
+        return {
+            "enabled": self.enabled,
+            "threshold": self.threshold,
+            "routed": routed,
+            "rule": self._counters["rule"],
+            "classifier": self._counters["classifier"],
+            "fallback": self._counters["fallback"],
+            "llm_calls_saved": self._counters["llm_calls_saved"],
+            "local_ratio": round((routed - self._counters["fallback"]) / routed, 4) if routed else 0.0,
+            "intents": dict(self._intents),
+            "fallback_reasons": dict(self._fallback_reasons),
+            "latency_us": {"p50": pct(0.50), "p90": pct(0.90), "p99": pct(0.99),
+                           "max": round(latencies[-1], 1) if latencies else 0.0},
+            "vocabulary": len(self.classifier.log_prob),
+        }
@@ -1,14 +1,30 @@
 import os
+import gzip
+import json
+import hashlib
 import shutil
-from fastapi import FastAPI, UploadFile, File, HTTPException
+import numpy as np
+from fastapi import FastAPI, UploadFile, File, HTTPException, Request
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import StreamingResponse, JSONResponse
-from celery.result import AsyncResult
+from fastapi.responses import StreamingResponse, JSONResponse, Response
+from starlette.background import BackgroundTask
 
 from .config import settings
-from .schemas import ChatRequest
+from .schemas import ChatRequest, SessionCreateRequest, StatusBatchRequest
 from .agent import BioBlendAgent
-from .celery_app import celery_app, run_bioinformatics_task
+from .celery_app import skill_mgr
+from .task_gateway import (submit_workflow, fetch_status, fetch_statuses, load_report,
+                           schedule_prefetch, cancel_prefetch, cancel_run)
+from .result_store import result_store, run_dir
+from .embedding_export import read_header, read_embedding
+from .run_state import RunStateCache, query_genes, query_cluster
+from .reference_index import reference_meta
+from .admission import AdmissionController, AdmissionRejected, guarded_stream
+from .session_store import SessionStore, recording_stream
+from .tracing import tracer, span, traced_stream, summarize as summarize_trace, KIND_SERVER
+from .datasets import resolve_input, resolve_samples
+from .qc_preview import (QcPreviewCache, PreviewUnsupported, summarize as summarize_qc,
+                         DEFAULT_MIN_GENES, DEFAULT_MAX_MT)
 
 app = FastAPI(title="GIBH Commercial API")
 
@@ -20,39 +36,177 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
-agent = BioBlendAgent()
+# 意图路由的步骤 / 参数词表来自已加载技能的 META 模板
+agent = BioBlendAgent(skill_metas=[skill.META for skill in skill_mgr.skills.values()])
+
+# 对话准入控制：有界排队 + 单客户端并发上限 + 令牌桶限速
+admission = AdmissionController(
+    max_active=settings.CHAT_MAX_ACTIVE,
+    max_queue=settings.CHAT_MAX_QUEUE,
+    per_client=settings.CHAT_PER_CLIENT,
+    rate_per_sec=settings.CHAT_RATE_PER_MIN / 60.0,
+    burst=settings.CHAT_BURST,
+    max_wait=settings.CHAT_MAX_QUEUE_WAIT,
+)
+
+# 服务端会话：与 Agent 共用同一个 ContextBuilder (摘要缓存共享)
+sessions = SessionStore(
+    settings.REDIS_URL,
+    agent.context_builder,
+    ttl=settings.SESSION_TTL,
+    max_history_tokens=settings.SESSION_MAX_HISTORY_TOKENS,
+    max_bytes=settings.SESSION_MAX_BYTES,
+    max_sessions=settings.SESSION_MAX_SESSIONS,
+)
+
+# 已完成 run 的可查询状态 (LRU)
+run_states = RunStateCache(max_runs=settings.QUERY_CACHE_RUNS)
+
+# QC 阈值预览的抽样结果 (按数据集指纹缓存)
+qc_previews = QcPreviewCache(settings.QC_PREVIEW_CACHE_DIR)
+
+# 链路追踪 (Worker 进程在 celery_app.py 里以 gibh-worker 身份配置同一目录)
+tracer.configure(settings.TRACE_DIR if settings.TRACE_ENABLED else None, service="gibh-api",
+                 retention_seconds=settings.TRACE_RETENTION_HOURS * 3600)
+
+def _client_id(request: Request) -> str:
+    # Nginx 会透传真实 IP (X-Real-IP)
+    return request.headers.get("x-real-ip") or (request.client.host if request.client else "unknown")
 
 @app.post("/api/chat")
-async def chat_endpoint(req: ChatRequest):
+async def chat_endpoint(req: ChatRequest, request: Request, response: Response):
     """
     处理用户对话或工作流执行请求
+    携带 session_id 时，历史与已挂载文件从服务端会话读取，请求体只需包含新消息
+    每个请求一个 trace (响应头 X-Trace-Id)；流式对话的根 span 在生成结束时才关闭
     """
+    root = tracer.start_span("http.chat", {"client": _client_id(request), "session_id": req.session_id,
+                                           "workflow": bool(req.workflow_data)}, root=True, kind=KIND_SERVER)
+    try:
+        with tracer.use_span(root):
+            result = await _handle_chat(req, request, root)
+    except BaseException as e:
+        root.record_exception(e)
+        root.end()
+        raise
+    if not isinstance(result, StreamingResponse):
+        root.end()
+    if root.recording:
+        (result if isinstance(result, Response) else response).headers["X-Trace-Id"] = root.trace_id
+    return result
+
+async def _handle_chat(req: ChatRequest, request: Request, root):
+    files = [f.dict() for f in req.uploaded_files]
+    history = req.history
+    summary = ""
+    session = None
+    if req.session_id:
+        if files:
+            session = await sessions.attach(req.session_id, files)
+        else:
+            session = await sessions.load(req.session_id)
+        if session is None:
+            raise HTTPException(status_code=404, detail="会话不存在或已过期，请重新创建会话")
+        files = session["files"]
+        history = session["turns"]
+        summary = session["summary"]
+
     # 🟢 分支 A: 用户点击了“运行工作流”
     if req.workflow_data:
-        task = run_bioinformatics_task.delay(
-            workflow_data=req.workflow_data,
-            files=[f.dict() for f in req.uploaded_files]
-        )
+        with span("workflow.submit", {"steps": len(req.workflow_data.get("steps", []))}) as submit_span:
+            run_id = await submit_workflow(req.workflow_data, files)
+            submit_span.set_attribute("run_id", run_id)
+        root.set_attribute("run_id", run_id)
+        tracer.link_run(run_id, root.trace_id)
+        # 正式任务已投递，同一数据集尚未完成的预热不再需要
+        await cancel_prefetch(files)
         return {
             "type": "workflow_started",
-            "run_id": task.id,
-            "reply": f"🚀 工作流已启动！任务ID: {task.id}\n正在后台计算，请稍候...",
+            "run_id": run_id,
+            "reply": f"🚀 工作流已启动！任务ID: {run_id}\n正在后台计算，请稍候...",
             "thought": "任务已提交至 Celery 分布式队列。"
         }
 
     # 🔵 分支 B: 智能对话 / 意图识别
-    response = await agent.process_query(
-        query=req.message,
-        history=req.history,
-        uploaded_files=req.uploaded_files
-    )
+    # 用户通常会在看到流程卡片后十几秒才点击运行，趁这段空闲预先解析数据集
+    await schedule_prefetch(files)
+    with span("agent.process_query"):
+        response = await agent.process_query(
+            query=req.message,
+            history=history,
+            uploaded_files=files,
+            summary=summary
+        )
+    if isinstance(response, dict) and "route" in response:
+        root.set_attribute("route", response["route"]["method"])
     
     # 判断返回类型
     if hasattr(response, "__aiter__"):
-        return StreamingResponse(response, media_type="text/plain")
-    
+        # 只有真正会打到 vLLM 的流式对话才需要准入 (生成器此时尚未启动)
+        try:
+            with span("admission.acquire"):
+                ticket = await admission.acquire(_client_id(request))
+        except AdmissionRejected as e:
+            root.set_attribute("rejected", e.reason)
+            if hasattr(response, "aclose"):
+                await response.aclose()
+            return JSONResponse(
+                status_code=429,
+                headers={"Retry-After": str(e.retry_after)},
+                content={"type": "error", "reason": e.reason, "retry_after": e.retry_after,
+                         "reply": f"⏳ 当前请求较多，请 {e.retry_after} 秒后重试。"},
+            )
+        headers = {"X-Queue-Wait-Ms": str(int(ticket.wait_seconds * 1000))}
+        if hasattr(response, "prompt_tokens"):
+            headers["X-Prompt-Tokens"] = str(response.prompt_tokens)
+            root.set_attribute("prompt_tokens", response.prompt_tokens)
+        stream = response
+        if session is not None:
+            headers["X-Session-Id"] = session["id"]
+            stream = recording_stream(response, sessions, session["id"], req.message)
+        return StreamingResponse(
+            traced_stream(guarded_stream(stream, ticket), root),
+            media_type="text/plain",
+            headers=headers,
+            # 响应结束后再归还一次 (幂等)；连这里都没执行到时由 ticket 回收兜底
+            background=BackgroundTask(ticket.release),
+        )
+
+    if session is not None and isinstance(response, dict):
+        await sessions.append_turn(session["id"], req.message, response.get("reply", ""))
+        response["session_id"] = session["id"]
     return response
 
+@app.post("/api/session")
+async def create_session(req: SessionCreateRequest = None):
+    """创建服务端会话，之后 /api/chat 只需携带 session_id 和新消息"""
+    files = [f.dict() for f in req.uploaded_files] if req else []
+    session = await sessions.create(files)
+    await schedule_prefetch(files)
+    return sessions.public_view(session)
+
+@app.get("/api/session/{session_id}")
+async def get_session(session_id: str):
+    session = await sessions.load(session_id)
+    if session is None:
+        raise HTTPException(status_code=404, detail="会话不存在或已过期")
+    return sessions.public_view(session)
+
+@app.delete("/api/session/{session_id}")
+async def delete_session(session_id: str):
+    await sessions.delete(session_id)
+    return {"status": "success", "session_id": session_id}
+
+@app.get("/api/metrics/admission")
+async def admission_metrics():
+    """准入层指标：队列深度、等待时间分位数、拒绝计数"""
+    return admission.snapshot()
+
+@app.get("/api/metrics/router")
+async def router_metrics():
+    """本地意图路由指标：各意图 / 方法的路由计数、退回大模型的原因、节省的 LLM 调用数、路由耗时分位数"""
+    return agent.router.snapshot()
+
 @app.post("/api/upload")
 async def upload_file(file: UploadFile = File(...)):
     try:
@@ -64,44 +218,268 @@ async def upload_file(file: UploadFile = File(...)):
     except Exception as e:
         return {"status": "error", "message": str(e)}
 
+def _threshold_list(text: str, default):
+    if not text.strip():
+        return list(default)
+    try:
+        values = [float(v) for v in text.split(",") if v.strip()][:20]
+    except ValueError:
+        raise HTTPException(status_code=400, detail="阈值应为逗号分隔的数字，如 min_genes=200,500")
+    return [int(v) if v.is_integer() else v for v in values]
+
+@app.get("/api/datasets/qc_preview")
+def get_qc_preview(files: str, min_genes: str = "", max_mt: str = ""):
+    """
+    QC 阈值预览：不跑流程，抽样计算检出基因数 / 总计数 / 线粒体比例分布，估算候选阈值各保留多少细胞
+    - files: 已上传的文件名，逗号分隔 (10x 数据传 matrix.mtx 等文件名；2 个及以上 h5ad 按多样本合并统计)
+    - min_genes / max_mt: 候选阈值，逗号分隔；不传时给一组常用值
+    同一数据集只抽样一次 (时间预算 QC_PREVIEW_BUDGET 秒)，之后调整阈值只重新计数
+    """
+    names = [n.strip() for n in files.split(",") if n.strip()]
+    if not names or any(os.path.basename(n) != n or n in (".", "..") for n in names):
+        raise HTTPException(status_code=400, detail="请提供已上传的文件名，如 files=pbmc3k.h5ad")
+    uploaded = [{"name": n} for n in names]
+    inputs = resolve_samples(uploaded, settings.UPLOAD_DIR) or [(None, resolve_input(uploaded, settings.UPLOAD_DIR))]
+
+    # 多样本时时间预算与抽样细胞数在样本间均分
+    budget = settings.QC_PREVIEW_BUDGET / len(inputs)
+    max_cells = max(1, settings.QC_PREVIEW_MAX_CELLS // len(inputs))
+    samples, hits = [], []
+    for _, path in inputs:
+        if not path or not os.path.exists(path):
+            raise HTTPException(status_code=404, detail=f"文件不存在: {os.path.basename(path or '')}")
+        try:
+            sample, cached = qc_previews.get(path, checkpoint_dir=settings.PREFETCH_CACHE_DIR,
+                                             max_cells=max_cells, budget=budget)
+        except PreviewUnsupported as e:
+            raise HTTPException(status_code=415, detail=str(e))
+        samples.append(sample)
+        hits.append(cached)
+
+    result = summarize_qc(samples, names=[name for name, _ in inputs],
+                          min_genes=_threshold_list(min_genes, DEFAULT_MIN_GENES),
+                          max_mt=_threshold_list(max_mt, DEFAULT_MAX_MT))
+    result["cached"] = all(hits)
+    result["compute_seconds"] = round(sum(s.get("seconds", 0) for s in samples), 3)
+    return result
+
+def _etag_matches(request: Request, etag: str) -> bool:
+    """If-None-Match 逐个比较完整的实体标签 (弱比较：忽略 W/ 前缀)；* 匹配任意版本"""
+    for tag in request.headers.get("if-none-match", "").split(","):
+        tag = tag.strip()
+        if tag == "*" or (tag and tag.removeprefix("W/") == etag):
+            return True
+    return False
+
+def _conditional_json(request: Request, payload, etag: str = None, immutable: bool = False) -> Response:
+    """带 ETag 的 JSON 响应；If-None-Match 命中时返回 304 (无响应体)"""
+    body = json.dumps(payload, ensure_ascii=False, separators=(",", ":"), default=str).encode("utf-8")
+    etag = f'"{etag or hashlib.sha1(body).hexdigest()}"'
+    headers = {
+        "ETag": etag,
+        "Cache-Control": "private, max-age=31536000, immutable" if immutable else "no-cache",
+    }
+    if _etag_matches(request, etag):
+        return Response(status_code=304, headers=headers)
+    return Response(content=body, media_type="application/json", headers=headers)
+
 @app.get("/api/workflow/status/{run_id}")
-async def get_status(run_id: str):
-    task_result = AsyncResult(run_id, app=celery_app)
-    
-    response = {
-        "status": "running",
-        "completed": False,
-        "steps_status": [], 
-        "error": None
+async def get_status(run_id: str, request: Request):
+    # 轮询通常返回相同内容：浏览器携带 If-None-Match，未变化时直接 304
+    status = await fetch_status(run_id)
+    if status.get("completed"):
+        status["result_url"] = f"/api/workflow/result/{run_id}"
+    return _conditional_json(request, status)
+
+@app.post("/api/workflow/cancel/{run_id}")
+async def cancel_workflow(run_id: str):
+    """
+    取消工作流：排队中的直接撤销；运行中的在下一个检查点退出，
+    已完成的步骤 (图、指标) 作为部分结果保留在 /api/workflow/result/{run_id}
+    """
+    try:
+        run_dir(run_id)
+    except ValueError:
+        raise HTTPException(status_code=400, detail="非法 run_id")
+    return await cancel_run(run_id)
+
+@app.get("/api/workflow/result/{run_id}")
+async def get_result(run_id: str, request: Request):
+    """完整报告 (从结果存储还原)，内容寻址，可被客户端永久缓存"""
+    try:
+        report, digest = await load_report(run_id)
+    except ValueError:
+        raise HTTPException(status_code=400, detail="非法 run_id")
+    if report is None:
+        raise HTTPException(status_code=404, detail="结果尚未就绪或已过期")
+    return _conditional_json(request, report, etag=digest, immutable=digest is not None)
+
+@app.get("/api/workflow/result/{run_id}/artifacts/{digest}")
+async def get_artifact(run_id: str, digest: str, request: Request):
+    """单个卸载字段 (如 Marker 表 HTML)，按 sha256 寻址"""
+    try:
+        path = result_store.blob_path(run_id, digest)
+    except ValueError:
+        path = None
+    if path is None:
+        raise HTTPException(status_code=404, detail="artifact 不存在")
+    headers = {"ETag": f'"{digest}"', "Cache-Control": "private, max-age=31536000, immutable"}
+    if _etag_matches(request, headers["ETag"]):
+        return Response(status_code=304, headers=headers)
+    with open(path, "rb") as f:
+        data = f.read()
+    if "gzip" in request.headers.get("accept-encoding", ""):
+        # 磁盘上本来就是 gzip，直接透传
+        headers["Content-Encoding"] = "gzip"
+        return Response(content=data, media_type="text/plain; charset=utf-8", headers=headers)
+    return Response(content=gzip.decompress(data), media_type="text/plain; charset=utf-8", headers=headers)
+
+def _ranged_file(request: Request, path: str, media_type: str = "application/octet-stream") -> Response:
+    """支持单段 Range 的文件读取 (bytes=start-end / bytes=start- / bytes=-suffix)"""
+    stat = os.stat(path)
+    size = stat.st_size
+    etag = f'"{int(stat.st_mtime)}-{size}"'
+    headers = {"Accept-Ranges": "bytes", "ETag": etag, "Cache-Control": "no-cache"}
+    if _etag_matches(request, etag):
+        return Response(status_code=304, headers=headers)
+
+    start, end = 0, size - 1
+    status_code = 200
+    range_header = request.headers.get("range", "")
+    if range_header.startswith("bytes=") and "," not in range_header:
+        first, _, last = range_header[6:].strip().partition("-")
+        try:
+            if first:
+                start = int(first)
+                end = min(int(last), size - 1) if last else size - 1
+            else:
+                start = max(0, size - int(last))
+        except ValueError:
+            start, end = 0, size - 1
+        if start > end or start >= size:
+            return Response(status_code=416, headers={**headers, "Content-Range": f"bytes */{size}"})
+        status_code = 206
+        headers["Content-Range"] = f"bytes {start}-{end}/{size}"
+
+    with open(path, "rb") as f:
+        f.seek(start)
+        data = f.read(end - start + 1)
+    return Response(content=data, status_code=status_code, media_type=media_type, headers=headers)
+
+@app.get("/api/runs/{run_id}/reference")
+async def get_reference(run_id: str):
+    """该 run 是否可作为参考映射的目标 (ANN 索引元数据：细胞数、簇、PC 数)"""
+    try:
+        meta = reference_meta(run_dir(run_id))
+    except ValueError:
+        raise HTTPException(status_code=400, detail="非法 run_id")
+    if meta is None:
+        raise HTTPException(status_code=404, detail="该 run 没有参考映射索引")
+    return {"run_id": run_id, **meta}
+
+def _trace_payload(trace_id: str, **extra):
+    spans = tracer.load_trace(trace_id) if trace_id else None
+    if spans is None:
+        raise HTTPException(status_code=404, detail="没有找到对应的 trace (未开启追踪或已超过保留期)")
+    return {**extra, "trace_id": trace_id, "summary": summarize_trace(spans), "spans": spans}
+
+@app.get("/api/runs/{run_id}/trace")
+def get_run_trace(run_id: str):
+    """工作流全链路 span：API 提交 → Redis 排队 → Worker 各步骤 / 绘图 / 保存 → vLLM 诊断"""
+    try:
+        run_dir(run_id)
+    except ValueError:
+        raise HTTPException(status_code=400, detail="非法 run_id")
+    return _trace_payload(tracer.trace_for_run(run_id), run_id=run_id)
+
+@app.get("/api/traces/{trace_id}")
+def get_trace(trace_id: str):
+    """按 trace id (响应头 X-Trace-Id) 查询，对话请求的 TTFT / 生成耗时也在这里"""
+    return _trace_payload(trace_id)
+
+@app.get("/api/runs/{run_id}/embedding/{basis}")
+async def get_embedding(run_id: str, basis: str, request: Request, header: bool = False):
+    """
+    二进制 embedding (GEMB 格式，见 embedding_export.py)
+    前端先读 header (或 ?header=true 直接拿 JSON)，再按 LOD 层的字节区间发 Range 请求
+    """
+    if basis not in ("umap", "tsne"):
+        raise HTTPException(status_code=404, detail="未知的 embedding")
+    try:
+        path = os.path.join(run_dir(run_id), f"embedding_{basis}.gemb")
+    except ValueError:
+        raise HTTPException(status_code=400, detail="非法 run_id")
+    if not os.path.exists(path):
+        raise HTTPException(status_code=404, detail="该 run 没有导出此 embedding")
+    if header:
+        return read_header(path)
+    return _ranged_file(request, path)
+
+def _open_run_state(run_id: str):
+    try:
+        path = run_dir(run_id)
+    except ValueError:
+        raise HTTPException(status_code=400, detail="非法 run_id")
+    if not os.path.isdir(os.path.join(path, "state.zarr")):
+        raise HTTPException(status_code=404, detail="该 run 没有保存可查询的分析状态")
+    return run_states.get(path), path
+
+@app.get("/api/runs/{run_id}/genes")
+def get_gene_values(run_id: str, names: str, order: str = "cells", basis: str = "umap", format: str = "json"):
+    """
+    惰性读取基因表达 (只读请求的基因列)，无需重跑流程
+    - order=cells: 按保存的细胞行顺序；order=embedding: 与 embedding 二进制文件的点顺序对齐
+    - format=f32: 返回 float32 小端二进制 (每个基因 n 个值依次排列)，可直接作为 WebGL 着色 buffer
+    """
+    genes = [g for g in names.split(",") if g.strip()][:50]
+    if not genes:
+        raise HTTPException(status_code=400, detail="请提供基因名，如 names=CD3E,MS4A1")
+    state, path = _open_run_state(run_id)
+
+    row_order = None
+    if order == "embedding":
+        emb_path = os.path.join(path, f"embedding_{basis}.gemb")
+        if not os.path.exists(emb_path):
+            raise HTTPException(status_code=404, detail="该 run 没有导出此 embedding")
+        _, _, _, row_order = read_embedding(emb_path)
+
+    result = query_genes(state, genes, row_order)
+    if format == "f32":
+        names_found = list(result["values"].keys())
+        payload = b"".join(np.asarray(result["values"][g], dtype="<f4").tobytes() for g in names_found)
+        return Response(content=payload, media_type="application/octet-stream",
+                        headers={"X-Genes": ",".join(names_found), "X-Missing": ",".join(result["missing"]),
+                                 "X-N-Obs": str(state.n_obs if row_order is None else len(row_order))})
+    return {
+        "run_id": run_id,
+        "order": order,
+        "n_obs": state.n_obs if row_order is None else len(row_order),
+        "genes": {g: [round(float(v), 4) for v in vals] for g, vals in result["values"].items()},
+        "stats": result["stats"],
+        "missing": result["missing"],
     }
 
-    if task_result.state == 'PENDING':
-        response["status"] = "running"
-        
-    elif task_result.state == 'SUCCESS':
-        response["status"] = "success"
-        response["completed"] = True
-        
-        result_data = task_result.result 
-        if result_data:
-            # 🔥🔥🔥 核心修复：将 Worker 的结果（包含图片路径）透传给前端
-            response["report_data"] = result_data
-            
-            # 兼容进度条显示
-            if "steps_details" in result_data:
-                response["steps_status"] = result_data["steps_details"]
-            elif "steps" in result_data:
-                response["steps_status"] = result_data["steps"]
-                
-    elif task_result.state == 'FAILURE':
-        response["status"] = "failed"
-        response["completed"] = True
-        response["error"] = str(task_result.result)
-        
-    elif task_result.state == 'PROGRESS':
-        info = task_result.info
-        if isinstance(info, dict):
-            response["steps_status"] = info.get("steps", [])
-    
-    return response
+@app.get("/api/runs/{run_id}/clusters")
+def get_clusters(run_id: str):
+    state, _ = _open_run_state(run_id)
+    clusters = state.clusters()
+    if clusters is None:
+        raise HTTPException(status_code=404, detail="该 run 没有聚类结果")
+    counts = clusters.value_counts()
+    return {"run_id": run_id, "n_obs": state.n_obs,
+            "clusters": [{"cluster": str(c), "n_cells": int(counts[c])} for c in clusters.cat.categories]}
+
+@app.get("/api/runs/{run_id}/clusters/{cluster}")
+def get_cluster(run_id: str, cluster: str, n_markers: int = 20, genes: str = ""):
+    """单个簇：Marker 基因表 + 可选基因的簇内/簇外平均表达"""
+    state, _ = _open_run_state(run_id)
+    try:
+        result = query_cluster(state, cluster, n_markers, [g for g in genes.split(",") if g.strip()])
+    except KeyError as e:
+        raise HTTPException(status_code=404, detail=str(e.args[0]))
+    return {"run_id": run_id, **result}
 
+@app.post("/api/workflow/status/batch")
+async def get_status_batch(req: StatusBatchRequest):
+    """批量查询多个 run 的状态 (一次 Redis 往返)，供任务列表/看板使用"""
+    return {"statuses": await fetch_statuses(req.run_ids)}
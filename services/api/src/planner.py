@@ -0,0 +1,230 @@
+import os
+import json
+import math
+import time
+import threading
+
+import numpy as np
+
+from .datasets import read_metadata, combine_metadata
+
+# ================= 默认代价模型 =================
+# 特征: [1, n_obs/1e4, nnz/1e7]，单位：秒 / MB
+# 系数为 16 核 CPU 上的经验值；有足够的历史运行记录后会被拟合值替代
+_DEFAULT_SECONDS = {
+    "local_qc":              (1.0, 0.6, 0.8),
+    "local_normalize":       (0.2, 0.1, 0.5),
+    "local_hvg":             (0.8, 0.2, 1.0),
+    # 融合预处理：QC / LogNormalize / HVG 统计一次扫描完成，耗时都计在 QC 步，后两步只剩出图与筛选
+    "local_qc:fused":        (1.0, 0.6, 1.2),
+    "local_normalize:fused": (0.0, 0.0, 0.0),
+    "local_hvg:fused":       (0.3, 0.1, 0.0),
+    "local_scale":           (0.2, 0.5, 0.0),
+    "local_pca:arpack":      (1.0, 3.0, 0.0),
+    "local_pca:randomized":  (1.0, 1.0, 0.0),
+    "local_neighbors":       (5.0, 1.5, 0.0),
+    "local_cluster":         (0.5, 1.0, 0.0),
+    "local_umap":            (5.0, 3.0, 0.0),
+    "local_tsne:full":       (2.0, 20.0, 0.0),
+    "local_tsne:sketch":     (2.0, 20.0, 0.0),
+    "local_tsne:skip":       (0.0, 0.0, 0.0),
+    "local_markers":         (1.0, 1.5, 0.0),
+}
+# 峰值内存：常驻基线 + 稀疏矩阵 (≈12 字节/非零) + HVG 稠密矩阵 (2000 基因 x 4 字节/细胞)
+_DEFAULT_MB = {
+    "local_qc":              (400, 10, 230),
+    "local_normalize":       (400, 10, 230),
+    "local_hvg":             (400, 10, 350),
+    "local_qc:fused":        (400, 10, 350),
+    "local_normalize:fused": (400, 10, 230),
+    "local_hvg:fused":       (400, 10, 350),
+    "local_scale":           (400, 160, 120),
+    "local_pca:arpack":      (400, 200, 120),
+    "local_pca:randomized":  (400, 240, 120),
+    "local_neighbors":       (400, 180, 120),
+    "local_cluster":         (400, 180, 120),
+    "local_umap":            (400, 200, 120),
+    "local_tsne:full":       (400, 220, 120),
+    "local_tsne:sketch":     (400, 220, 120),
+    "local_tsne:skip":       (400, 160, 120),
+    "local_markers":         (400, 260, 120),
+}
+
+# 融合预处理覆盖的步骤 (见 fused_preprocess)，代价按 "{tool_id}:fused" 单独拟合
+_FUSED_STEPS = ("local_qc", "local_normalize", "local_hvg")
+
+_MIN_SAMPLES = 5          # 某一步的历史记录达到该数量才用拟合值
+_HISTORY_TAIL = 5000      # 拟合时最多读取最近 N 条记录
+
+
+def _features(n_obs: float, nnz: float) -> np.ndarray:
+    return np.array([1.0, n_obs / 1e4, nnz / 1e7])
+
+
+class CostModel:
+    """
+    每个步骤 (及算法变体) 一个线性模型：cost = w · [1, n_obs/1e4, nnz/1e7]
+    历史记录 (cost_history.jsonl) 每行：
+        {"key": "local_pca:arpack", "n_obs": ..., "nnz": ..., "seconds": ..., "peak_mb": ..., "ts": ...}
+    """
+
+    def __init__(self, history_path: str):
+        self.history_path = history_path
+        self._lock = threading.Lock()
+        self._fitted = {}
+        self._fitted_mtime = None
+
+    def _load_fitted(self):
+        try:
+            mtime = os.path.getmtime(self.history_path)
+        except OSError:
+            return {}
+        with self._lock:
+            if mtime == self._fitted_mtime:
+                return self._fitted
+            samples = {}
+            with open(self.history_path, encoding="utf-8") as f:
+                lines = f.readlines()[-_HISTORY_TAIL:]
+            for line in lines:
+                try:
+                    rec = json.loads(line)
+                except ValueError:
+                    continue
+                samples.setdefault(rec["key"], []).append(rec)
+
+            fitted = {}
+            for key, recs in samples.items():
+                if len(recs) < _MIN_SAMPLES:
+                    continue
+                A = np.stack([_features(r["n_obs"], r["nnz"]) for r in recs])
+                entry = {"samples": len(recs)}
+                for target in ("seconds", "peak_mb"):
+                    y = np.array([r[target] for r in recs], dtype=float)
+                    w, *_ = np.linalg.lstsq(A, y, rcond=None)
+                    # 代价不会随规模减小：负系数截断为 0
+                    entry[target] = np.clip(w, 0, None)
+                fitted[key] = entry
+            self._fitted, self._fitted_mtime = fitted, mtime
+            return fitted
+
+    def predict(self, key: str, n_obs: float, nnz: float) -> dict:
+        x = _features(n_obs, nnz)
+        fitted = self._load_fitted().get(key)
+        if fitted is not None:
+            return {"seconds": float(x @ fitted["seconds"]), "peak_mb": float(x @ fitted["peak_mb"]),
+                    "source": "fitted", "samples": fitted["samples"]}
+        step = key.split(":")[0]
+        w_s = _DEFAULT_SECONDS.get(key, _DEFAULT_SECONDS.get(step, (1.0, 0.0, 0.0)))
+        w_m = _DEFAULT_MB.get(key, _DEFAULT_MB.get(step, (400, 0, 0)))
+        return {"seconds": float(x @ np.array(w_s)), "peak_mb": float(x @ np.array(w_m)),
+                "source": "default", "samples": 0}
+
+    def record(self, samples: list):
+        if not samples:
+            return
+        os.makedirs(os.path.dirname(self.history_path), exist_ok=True)
+        with self._lock, open(self.history_path, "a", encoding="utf-8") as f:
+            for s in samples:
+                f.write(json.dumps(s) + "\n")
+
+
+class WorkflowPlanner:
+    """
+    根据数据集规模选择算法变体，并给每一步附上预计耗时 / 峰值内存
+    """
+
+    def __init__(self, history_path: str, fused: bool = False):
+        self.model = CostModel(history_path)
+        self.fused = fused
+
+    @staticmethod
+    def choose(meta: dict, fused: bool = False) -> dict:
+        """fused: 流程会走融合预处理 (单样本且 QC 后紧跟 LogNormalize)，QC / 标准化 / HVG 按融合变体估算"""
+        n_obs = meta["n_obs"]
+        params = {
+            # 大数据集上 randomized SVD 比 ARPACK 快数倍，精度差异可忽略
+            "svd_solver": "randomized" if n_obs > 50000 else "arpack",
+            "n_comps": "50",
+            "n_pcs": "30" if n_obs < 2000 else "40",
+            "tsne_sketch_size": "20000",
+        }
+        if n_obs < 5000:
+            params["tsne_mode"] = "full"
+        elif n_obs <= 500000:
+            # 均匀抽样一个子集跑 t-SNE，时间与总细胞数无关
+            params["tsne_mode"] = "sketch"
+        else:
+            params["tsne_mode"] = "skip"
+        params["preprocess"] = "fused" if fused else "standard"
+        return params
+
+    @staticmethod
+    def step_key(tool_id: str, params: dict) -> str:
+        if tool_id == "local_pca":
+            return f"local_pca:{params.get('svd_solver', 'arpack')}"
+        if tool_id == "local_tsne":
+            return f"local_tsne:{params.get('tsne_mode', 'full')}"
+        if tool_id in _FUSED_STEPS and params.get("preprocess") == "fused":
+            return f"{tool_id}:fused"
+        return tool_id
+
+    @staticmethod
+    def _effective_obs(tool_id: str, n_obs: float, params: dict) -> float:
+        if tool_id == "local_tsne" and params.get("tsne_mode") == "sketch":
+            return min(n_obs, float(params.get("tsne_sketch_size", 20000)))
+        return n_obs
+
+    def estimate(self, meta: dict, params: dict, tool_ids: list) -> dict:
+        estimates = {}
+        for tool_id in tool_ids:
+            key = self.step_key(tool_id, params)
+            n_eff = self._effective_obs(tool_id, meta["n_obs"], params)
+            pred = self.model.predict(key, n_eff, meta["nnz"] * n_eff / max(meta["n_obs"], 1))
+            estimates[tool_id] = {"variant": key, "seconds": round(pred["seconds"], 1),
+                                  "peak_mb": int(math.ceil(pred["peak_mb"])), "source": pred["source"]}
+        return estimates
+
+    @staticmethod
+    def dataset_meta(data_path) -> dict:
+        """单个路径，或多样本模式下的路径列表"""
+        if isinstance(data_path, (list, tuple)):
+            return combine_metadata([read_metadata(p) for p in data_path])
+        return read_metadata(data_path)
+
+    def plan(self, data_path, tool_ids: list) -> dict:
+        meta = self.dataset_meta(data_path)
+        # 与流水线的判断一致：多样本在子进程里逐个预处理，不走融合路径
+        fused = (self.fused and not isinstance(data_path, (list, tuple)) and "local_qc" in tool_ids
+                 and tool_ids[tool_ids.index("local_qc") + 1:][:1] == ["local_normalize"])
+        params = self.choose(meta, fused=fused)
+        estimates = self.estimate(meta, params, tool_ids)
+        return {
+            "dataset": meta,
+            "params": params,
+            "estimates": estimates,
+            "total_seconds": round(sum(e["seconds"] for e in estimates.values()), 1),
+            "peak_mb": max((e["peak_mb"] for e in estimates.values()), default=0),
+        }
+
+    def record_run(self, meta: dict, params: dict, steps_details: list):
+        """把一次成功运行的实测耗时/内存写入历史，供后续拟合"""
+        samples = []
+        for step in steps_details:
+            if "elapsed" not in step or step.get("status") != "success" or step.get("prefetched") or step.get("per_sample"):
+                continue
+            tool_id = step["name"]
+            # 以流程实际采用的变体为准 (如 tsne_mode=auto 时实际可能是 full 或 skip；融合预处理失败时退回标准步骤)
+            variant_params = dict(params)
+            variant_params["preprocess"] = "fused" if step.get("fused") else "standard"
+            if step.get("variant"):
+                variant_params["svd_solver" if tool_id == "local_pca" else "tsne_mode"] = step["variant"]
+            n_eff = self._effective_obs(tool_id, meta["n_obs"], variant_params)
+            samples.append({
+                "key": self.step_key(tool_id, variant_params),
+                "n_obs": n_eff,
+                "nnz": meta["nnz"] * n_eff / max(meta["n_obs"], 1),
+                "seconds": step["elapsed"],
+                "peak_mb": step.get("peak_mb", 0),
+                "ts": int(time.time()),
+            })
+        self.model.record(samples)
@@ -0,0 +1,321 @@
+import os
+import gzip
+import time
+import threading
+from collections import OrderedDict
+
+import numpy as np
+import pandas as pd
+
+from .datasets import dataset_key, checkpoint_path
+
+# QC 阈值预览：不跑流程，抽样计算每细胞检出基因数 / 总计数 / 线粒体比例的分布，
+# 并估算候选 min_genes / max_mt 阈值各保留多少细胞 (规则与流程里的 local_qc 一致)
+#   - 有预热 checkpoint 时直接读取其中已算好的 QC 指标 (全部细胞，精确值)
+#   - h5ad (CSR / 稠密)：按随机行块抽样，只读抽中的行，超出时间预算就用已读到的部分
+#   - 10x mtx：顺序流式读取，超出时间预算时只用已完整读到的细胞
+# 抽样结果按数据集指纹缓存 (内存 LRU + 磁盘 npz)，之后改阈值只做计数，毫秒级返回
+
+MT_PREFIXES = ('MT-', 'mt-')
+BLOCK_ROWS = 64             # h5ad 抽样的行块大小 (块内连续读取；块小一些，按样本 / 批次排好序的数据抽样偏差更小)
+MTX_CHUNK_LINES = 500000    # mtx 流式读取每批行数
+HIST_BINS = 40
+DEFAULT_MIN_GENES = (0, 100, 200, 300, 500, 1000)
+DEFAULT_MAX_MT = (5, 10, 15, 20, 30, 50)
+METRICS = ("n_genes", "total_counts", "pct_mt")
+
+
+class PreviewUnsupported(ValueError):
+    """该数据格式无法在不完整加载的情况下预览"""
+
+
+def _mt_mask(names) -> np.ndarray:
+    return np.asarray(pd.Index(names).astype(str).str.startswith(MT_PREFIXES), dtype=bool)
+
+
+def _row_metrics(data, indices, indptr, mt):
+    """一个 CSR 行块的 (检出基因数, 总计数, 线粒体计数)"""
+    n = len(indptr) - 1
+    rows = np.repeat(np.arange(n), np.diff(indptr))
+    data = np.asarray(data, dtype=np.float64)
+    total = np.bincount(rows, weights=data, minlength=n)
+    n_genes = np.bincount(rows[data > 0], minlength=n)
+    mt_counts = np.bincount(rows, weights=data * mt[indices], minlength=n)
+    return n_genes, total, mt_counts
+
+
+def _join(parts):
+    if isinstance(parts, list):
+        return np.concatenate(parts) if parts else np.zeros(0)
+    return parts
+
+
+def _pack(n_genes, total, mt_counts, n_obs, exact, source):
+    n_genes, total, mt_counts = _join(n_genes), _join(total), _join(mt_counts)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        pct_mt = np.where(total > 0, mt_counts / total * 100, np.nan)
+    return {
+        "n_genes": np.asarray(n_genes, dtype=np.float32),
+        "total_counts": np.asarray(total, dtype=np.float32),
+        "pct_mt": np.asarray(pct_mt, dtype=np.float32),
+        "n_obs": int(n_obs),
+        "exact": bool(exact),
+        "source": source,
+    }
+
+
+# ================= 读取 / 抽样 =================
+
+def _from_checkpoint(path: str):
+    """预热 checkpoint 的 obs 里已有全部细胞的 QC 指标"""
+    import h5py
+    with h5py.File(path, "r") as f:
+        obs = f["obs"]
+        if not all(c in obs for c in ("n_genes_by_counts", "total_counts", "total_counts_mt")):
+            return None
+        n_genes = np.asarray(obs["n_genes_by_counts"][:])
+        total = np.asarray(obs["total_counts"][:], dtype=np.float64)
+        mt_counts = np.asarray(obs["total_counts_mt"][:], dtype=np.float64)
+    return _pack(n_genes, total, mt_counts, len(total), True, "checkpoint")
+
+
+def _h5ad_var_names(f):
+    var = f["var"]
+    index = var.attrs.get("_index", "_index")
+    values = var[index][:]
+    return [v.decode() if isinstance(v, bytes) else str(v) for v in values]
+
+
+def _sample_h5ad(path: str, max_cells: int, budget: float, rng):
+    import h5py
+    t0 = time.perf_counter()
+    with h5py.File(path, "r") as f:
+        mt = _mt_mask(_h5ad_var_names(f))
+        X = f["X"]
+        if isinstance(X, h5py.Group):
+            encoding = X.attrs.get("encoding-type", X.attrs.get("h5sparse_format", ""))
+            if isinstance(encoding, bytes):
+                encoding = encoding.decode()
+            if "csr" not in encoding:
+                raise PreviewUnsupported("CSC 存储的 h5ad 需要完整读取才能得到每细胞指标，暂不支持预览")
+            indptr = X["indptr"][:]
+            n_obs = len(indptr) - 1
+        else:
+            indptr = None
+            n_obs = X.shape[0]
+
+        # 分层抽样：行块等分成 k 段，每段随机取一块；再打乱读取顺序，预算耗尽提前停止时已读部分仍覆盖全体
+        total_blocks = int(np.ceil(n_obs / BLOCK_ROWS))
+        k = min(total_blocks, int(np.ceil(max_cells / BLOCK_ROWS)))
+        blocks = ((np.arange(k) + rng.random(k)) * total_blocks / k).astype(np.int64)
+        rng.shuffle(blocks)
+        parts = ([], [], [])
+        read = 0
+        for start in blocks * BLOCK_ROWS:
+            stop = min(start + BLOCK_ROWS, n_obs)
+            if indptr is not None:
+                a, b = indptr[start], indptr[stop]
+                metrics = _row_metrics(X["data"][a:b], X["indices"][a:b], indptr[start:stop + 1] - a, mt)
+            else:
+                block = np.asarray(X[start:stop], dtype=np.float64)
+                metrics = ((block > 0).sum(axis=1), block.sum(axis=1), block[:, mt].sum(axis=1))
+            for part, values in zip(parts, metrics):
+                part.append(values)
+            read += stop - start
+            if time.perf_counter() - t0 > budget:
+                break
+    return _pack(*parts, n_obs, read >= n_obs, "h5ad")
+
+
+def _find(directory: str, names):
+    for name in names:
+        for candidate in (name, name + ".gz"):
+            path = os.path.join(directory, candidate)
+            if os.path.exists(path):
+                return path
+    return None
+
+
+def _open_text(path: str):
+    return gzip.open(path, "rt") if path.endswith(".gz") else open(path, "rt")
+
+
+def _sample_mtx(directory: str, budget: float):
+    """10x mtx (基因 x 细胞)：顺序流式累加，超出预算时只保留已完整读到的细胞 (CellRanger 按细胞排序写出)"""
+    t0 = time.perf_counter()
+    mtx = _find(directory, ("matrix.mtx",))
+    features = _find(directory, ("features.tsv", "genes.tsv"))
+    if mtx is None or features is None:
+        raise PreviewUnsupported("10x 目录缺少 matrix.mtx 或 features.tsv")
+    genes = pd.read_csv(features, sep="\t", header=None)
+    mt = _mt_mask(genes[1] if genes.shape[1] > 1 else genes[0])
+
+    with _open_text(mtx) as f:
+        for line in f:
+            if not line.startswith("%"):
+                n_vars, n_obs, _ = (int(x) for x in line.split()[:3])
+                break
+        n_genes = np.zeros(n_obs, dtype=np.int64)
+        total = np.zeros(n_obs, dtype=np.float64)
+        mt_counts = np.zeros(n_obs, dtype=np.float64)
+        first, last, ordered, complete = n_obs, -1, True, True
+        for chunk in pd.read_csv(f, sep=r"\s+", header=None, names=["gene", "cell", "value"],
+                                 chunksize=MTX_CHUNK_LINES):
+            gene = chunk["gene"].to_numpy() - 1
+            cell = chunk["cell"].to_numpy() - 1
+            value = chunk["value"].to_numpy(dtype=np.float64)
+            ordered = ordered and bool(np.all(np.diff(cell) >= 0)) and (len(cell) == 0 or cell[0] >= last)
+            first, last = min(first, int(cell.min())), max(last, int(cell.max()))
+            total += np.bincount(cell, weights=value, minlength=n_obs)
+            n_genes += np.bincount(cell[value > 0], minlength=n_obs)
+            mt_counts += np.bincount(cell, weights=value * mt[gene], minlength=n_obs)
+            if time.perf_counter() - t0 > budget:
+                complete = False
+                break
+
+    if complete:
+        return _pack(n_genes, total, mt_counts, n_obs, True, "mtx")
+    if not ordered:
+        raise PreviewUnsupported("mtx 未按细胞排序，无法在时间预算内得到完整的每细胞指标")
+    # 最后一个细胞可能只读到一部分
+    cells = slice(first, max(first, last))
+    return _pack(n_genes[cells], total[cells], mt_counts[cells], n_obs, False, "mtx")
+
+
+def sample_dataset(path: str, max_cells: int = 20000, budget: float = 2.0, cache_dir: str = None, seed: int = 0):
+    """计算 (或抽样) 一个数据集的每细胞 QC 指标"""
+    if cache_dir:
+        checkpoint = checkpoint_path(cache_dir, dataset_key(path))
+        if os.path.exists(checkpoint):
+            try:
+                result = _from_checkpoint(checkpoint)
+                if result is not None:
+                    return result
+            except Exception as e:
+                print(f"⚠️ 读取预热 checkpoint 的 QC 指标失败，改为抽样: {e}")
+    rng = np.random.default_rng(seed)
+    if os.path.isdir(path):
+        return _sample_mtx(path, budget)
+    if path.endswith(".h5ad"):
+        return _sample_h5ad(path, max_cells, budget, rng)
+    raise PreviewUnsupported(f"暂不支持预览该格式: {os.path.basename(path)}")
+
+
+# ================= 汇总 =================
+
+def _histogram(values: np.ndarray, bins: int = HIST_BINS) -> dict:
+    values = values[np.isfinite(values)]
+    if not len(values):
+        return {"edges": [], "counts": [], "overflow": 0, "quantiles": {}}
+    # 上界取 99.5 分位，极端值单独计数，避免长尾把主体压成一根柱子
+    upper = float(np.percentile(values, 99.5)) or float(values.max()) or 1.0
+    edges = np.linspace(0, upper, bins + 1)
+    counts, _ = np.histogram(values[values <= upper], bins=edges)
+    quantiles = np.percentile(values, [1, 5, 25, 50, 75, 95, 99])
+    return {
+        "edges": [round(float(e), 3) for e in edges],
+        "counts": counts.tolist(),
+        "overflow": int((values > upper).sum()),
+        "quantiles": {f"p{q}": round(float(v), 3) for q, v in zip((1, 5, 25, 50, 75, 95, 99), quantiles)},
+    }
+
+
+def _kept(sample: dict, min_genes=None, max_mt=None) -> np.ndarray:
+    # 与流程一致：filter_cells(min_genes) 后再取 pct_counts_mt < max_mt (总计数为 0 的细胞 pct 为 NaN，不保留)
+    mask = np.ones(len(sample["n_genes"]), dtype=bool)
+    if min_genes is not None:
+        mask &= sample["n_genes"] >= min_genes
+    if max_mt is not None:
+        with np.errstate(invalid="ignore"):
+            mask &= sample["pct_mt"] < max_mt
+    return mask
+
+
+def _keep_entry(samples: list, **thresholds) -> dict:
+    sampled = sum(len(s["n_genes"]) for s in samples)
+    kept = [int(_kept(s, **thresholds).sum()) for s in samples]
+    # 抽样时按各样本的抽样比例放大到全体细胞
+    estimate = sum(k if s["exact"] else k / max(len(s["n_genes"]), 1) * s["n_obs"] for k, s in zip(kept, samples))
+    entry = {**thresholds, "keep_fraction": round(sum(kept) / max(sampled, 1), 4), "keep_cells": int(round(estimate))}
+    if len(samples) > 1:
+        entry["per_sample"] = [int(round(k if s["exact"] else k / max(len(s["n_genes"]), 1) * s["n_obs"]))
+                               for k, s in zip(kept, samples)]
+    return entry
+
+
+def summarize(samples: list, names: list = None, min_genes=DEFAULT_MIN_GENES, max_mt=DEFAULT_MAX_MT) -> dict:
+    """分布直方图 + 候选阈值保留细胞数 (单个阈值与 min_genes x max_mt 组合)"""
+    merged = {m: np.concatenate([s[m] for s in samples]) for m in METRICS}
+    return {
+        "n_obs": sum(s["n_obs"] for s in samples),
+        "sampled_cells": len(merged["n_genes"]),
+        "exact": all(s["exact"] for s in samples),
+        "sources": sorted({s["source"] for s in samples}),
+        "samples": [{"name": name, "n_obs": s["n_obs"], "sampled_cells": len(s["n_genes"]), "exact": s["exact"]}
+                    for name, s in zip(names or [None] * len(samples), samples)] if len(samples) > 1 else None,
+        "histograms": {m: _histogram(merged[m]) for m in METRICS},
+        "thresholds": {
+            "min_genes": [_keep_entry(samples, min_genes=v) for v in min_genes],
+            "max_mt": [_keep_entry(samples, max_mt=v) for v in max_mt],
+            "grid": [_keep_entry(samples, min_genes=g, max_mt=m) for g in min_genes for m in max_mt],
+        },
+    }
+
+
+class QcPreviewCache:
+    """按数据集指纹缓存抽样结果：进程内 LRU + 磁盘 npz (多个 API 进程 / 重启后共享)"""
+
+    def __init__(self, cache_dir: str, max_items: int = 32):
+        self.cache_dir = cache_dir
+        self.max_items = max_items
+        self._items: "OrderedDict[str, dict]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def _path(self, key: str) -> str:
+        return os.path.join(self.cache_dir, f"{key}.npz")
+
+    def _load(self, key: str):
+        path = self._path(key)
+        if not os.path.exists(path):
+            return None
+        with np.load(path, allow_pickle=False) as f:
+            sample = {m: f[m] for m in METRICS}
+            sample.update({"n_obs": int(f["n_obs"]), "exact": bool(f["exact"]), "source": str(f["source"]),
+                           "seconds": float(f["seconds"])})
+        return sample
+
+    def _store(self, key: str, sample: dict):
+        os.makedirs(self.cache_dir, exist_ok=True)
+        tmp = os.path.join(self.cache_dir, f".{key}.{os.getpid()}.{threading.get_ident()}.npz")
+        np.savez(tmp, **sample)
+        os.replace(tmp, self._path(key))
+
+    def get(self, path: str, checkpoint_dir: str = None, **kwargs):
+        """返回 (抽样结果, 是否命中缓存)"""
+        key = dataset_key(path)
+        with self._lock:
+            sample = self._items.get(key)
+            if sample is not None:
+                self._items.move_to_end(key)
+        if sample is None:
+            try:
+                sample = self._load(key)
+            except Exception as e:
+                print(f"⚠️ QC 预览缓存损坏，重新计算: {e}")
+        # 抽样结果在预热 checkpoint 生成后升级为精确值
+        stale = (sample is not None and not sample["exact"] and checkpoint_dir
+                 and os.path.exists(checkpoint_path(checkpoint_dir, key)))
+        if sample is None or stale:
+            t0 = time.perf_counter()
+            sample = sample_dataset(path, cache_dir=checkpoint_dir, **kwargs)
+            sample["seconds"] = round(time.perf_counter() - t0, 3)
+            self._store(key, sample)
+            cached = False
+        else:
+            cached = True
+        with self._lock:
+            self._items[key] = sample
+            self._items.move_to_end(key)
+            while len(self._items) > self.max_items:
+                self._items.popitem(last=False)
+        return sample, cached
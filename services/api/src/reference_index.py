@@ -0,0 +1,197 @@
+import os
+import json
+import time
+import pickle
+import threading
+from collections import OrderedDict
+
+import numpy as np
+import scipy.sparse as sp
+
+# 参考映射 (reference mapping)：把新样本投影到已完成 run 的 PCA 空间，用 kNN 直接继承聚类与 UMAP 位置
+#   runs/{run_id}/reference/
+#       model.npz  : HVG 基因名、scale 用的均值/标准差、PCA 中心与载荷、参考细胞的 PC 坐标 / UMAP / 聚类编码
+#       index.pkl  : 参考细胞 PC 坐标上的近邻索引 (大参考用 pynndescent 近似索引；小参考或未安装时用 sklearn)
+#       meta.json  : 聚类类别、使用的 PC 数、归一化参数、索引类型等
+# 投影在未做批次校正的 PCA 空间里进行 (新样本没有对应的批次校正模型)。
+REFERENCE_DIR = "reference"
+_MODEL = "model.npz"
+_INDEX = "index.pkl"
+_META = "meta.json"
+
+_INDEX_NEIGHBORS = 30  # 建索引时的图度数，查询 k 不超过该值时精度最好
+# 低于该细胞数时用精确 KD 树：构建 / 查询都在秒级以内，且免去 pynndescent 首次使用时数十秒的 numba 编译
+_ANN_MIN_CELLS = 50000
+
+
+def _build_index(coords: np.ndarray):
+    try:
+        if len(coords) < _ANN_MIN_CELLS:
+            raise ImportError
+        from pynndescent import NNDescent
+        index = NNDescent(coords, n_neighbors=_INDEX_NEIGHBORS, metric="euclidean", random_state=0)
+        index.prepare()
+        return index, "pynndescent"
+    except ImportError:
+        from sklearn.neighbors import NearestNeighbors
+        return NearestNeighbors().fit(coords), "sklearn"
+
+
+def persist_reference(run_dir: str, adata, max_value: float = 10, target_sum: float = 1e4):
+    """
+    保存参考映射模型与 ANN 索引；adata 需已完成 HVG 筛选 + scale + PCA (+ UMAP / leiden)
+    缺少必要信息 (例如跳过了 scale 步骤) 时返回 None
+    """
+    required = ("mean" in adata.var and "std" in adata.var and "PCs" in adata.varm
+                and "X_pca" in adata.obsm and "leiden" in adata.obs)
+    if not required:
+        return None
+
+    t0 = time.perf_counter()
+    n_pcs = (adata.uns.get("neighbors", {}).get("params", {}).get("n_pcs")
+             or adata.obsm["X_pca"].shape[1])
+    n_pcs = int(min(n_pcs, adata.obsm["X_pca"].shape[1]))
+    coords = np.ascontiguousarray(adata.obsm["X_pca"][:, :n_pcs], dtype=np.float32)
+    X = adata.X.toarray() if sp.issparse(adata.X) else np.asarray(adata.X)
+    leiden = adata.obs["leiden"].astype("category")
+
+    path = os.path.join(run_dir, REFERENCE_DIR)
+    os.makedirs(path, exist_ok=True)
+    np.savez(
+        os.path.join(path, _MODEL),
+        genes=np.asarray(adata.var_names, dtype=str),
+        mean=np.asarray(adata.var["mean"], dtype=np.float32),
+        std=np.asarray(adata.var["std"], dtype=np.float32),
+        # PCA 在 scale 之后的矩阵上计算，投影时减去同一个中心
+        center=X.mean(axis=0).astype(np.float32),
+        loadings=np.asarray(adata.varm["PCs"][:, :n_pcs], dtype=np.float32),
+        coords=coords,
+        umap=np.asarray(adata.obsm["X_umap"], dtype=np.float32) if "X_umap" in adata.obsm else np.zeros((0, 2), np.float32),
+        codes=leiden.cat.codes.values.astype(np.int32),
+    )
+    index, kind = _build_index(coords)
+    with open(os.path.join(path, _INDEX), "wb") as f:
+        pickle.dump(index, f, protocol=pickle.HIGHEST_PROTOCOL)
+
+    meta = {
+        "n_cells": int(adata.n_obs),
+        "n_genes": int(adata.n_vars),
+        "n_pcs": n_pcs,
+        "categories": [str(c) for c in leiden.cat.categories],
+        "max_value": max_value,
+        "target_sum": target_sum,
+        "index": kind,
+        "has_umap": "X_umap" in adata.obsm,
+        "build_seconds": round(time.perf_counter() - t0, 3),
+    }
+    with open(os.path.join(path, _META), "w", encoding="utf-8") as f:
+        json.dump(meta, f, ensure_ascii=False)
+    return meta
+
+
+def reference_meta(run_dir: str):
+    path = os.path.join(run_dir, REFERENCE_DIR, _META)
+    if not os.path.exists(path):
+        return None
+    with open(path, encoding="utf-8") as f:
+        return json.load(f)
+
+
+class ReferenceIndex:
+    """已保存的参考模型：投影 + kNN 标签/坐标迁移"""
+
+    def __init__(self, run_dir: str):
+        path = os.path.join(run_dir, REFERENCE_DIR)
+        self.meta = reference_meta(run_dir)
+        if self.meta is None:
+            raise FileNotFoundError(f"run 没有参考索引: {run_dir}")
+        model = np.load(os.path.join(path, _MODEL))
+        self.genes = model["genes"]
+        self.mean = model["mean"]
+        self.std = model["std"]
+        self.center = model["center"]
+        self.loadings = model["loadings"]
+        self.coords = model["coords"]
+        self.umap = model["umap"] if self.meta["has_umap"] else None
+        self.codes = model["codes"]
+        with open(os.path.join(path, _INDEX), "rb") as f:
+            self.index = pickle.load(f)
+
+    def project(self, adata):
+        """
+        把 log-normalized 的查询数据投影到参考 PCA 空间，返回 (PC 坐标, 参考 HVG 的覆盖率)
+        参考 HVG 在查询数据中缺失时按参考均值处理 (scale 后为 0)
+        """
+        lookup = {g: i for i, g in enumerate(adata.var_names)}
+        ref_cols, query_cols = [], []
+        for j, gene in enumerate(self.genes):
+            i = lookup.get(gene)
+            if i is not None:
+                ref_cols.append(j)
+                query_cols.append(i)
+        Z = np.zeros((adata.n_obs, len(self.genes)), dtype=np.float32)
+        if query_cols:
+            X = adata.X[:, query_cols]
+            X = X.toarray() if sp.issparse(X) else np.asarray(X)
+            ref_cols = np.asarray(ref_cols)
+            std = np.where(self.std[ref_cols] > 0, self.std[ref_cols], 1)
+            Z[:, ref_cols] = (X - self.mean[ref_cols]) / std
+        # 与 sc.pp.scale(zero_center=True, max_value=...) 一致：双侧截断
+        np.clip(Z, -self.meta["max_value"], self.meta["max_value"], out=Z)
+        return (Z - self.center) @ self.loadings, len(query_cols) / max(len(self.genes), 1)
+
+    def kneighbors(self, coords: np.ndarray, k: int):
+        coords = np.ascontiguousarray(coords, dtype=np.float32)
+        if self.meta["index"] == "pynndescent":
+            idx, dist = self.index.query(coords, k=k)
+        else:
+            dist, idx = self.index.kneighbors(coords, n_neighbors=k)
+        return idx, dist
+
+    def transfer(self, coords: np.ndarray, k: int = 15) -> dict:
+        """
+        kNN 加权投票迁移聚类标签，UMAP 位置取邻居坐标的加权平均
+        权重为高斯核，带宽取每个查询细胞到第 k 个邻居的距离
+        """
+        k = int(min(k, len(self.codes)))
+        idx, dist = self.kneighbors(coords, k)
+        sigma = np.maximum(dist[:, -1:], 1e-6)
+        weights = np.exp(-(dist / sigma) ** 2)
+        weights /= weights.sum(axis=1, keepdims=True)
+
+        n_cat = len(self.meta["categories"])
+        votes = np.zeros((len(coords), n_cat), dtype=np.float64)
+        rows = np.repeat(np.arange(len(coords)), k)
+        np.add.at(votes, (rows, self.codes[idx].ravel()), weights.ravel())
+        labels = votes.argmax(axis=1)
+        result = {
+            "labels": labels,
+            "confidence": votes[np.arange(len(coords)), labels],
+            "distance": dist.mean(axis=1),
+        }
+        if self.umap is not None:
+            result["umap"] = (weights[:, :, None] * self.umap[idx]).sum(axis=1).astype(np.float32)
+        return result
+
+
+class ReferenceCache:
+    """Worker 进程内缓存最近用过的参考 (同一参考连续映射多个样本时免去重复加载索引)"""
+
+    def __init__(self, max_items: int = 4):
+        self.max_items = max_items
+        self._items: "OrderedDict[tuple, ReferenceIndex]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, run_dir: str) -> ReferenceIndex:
+        key = (run_dir, os.path.getmtime(os.path.join(run_dir, REFERENCE_DIR, _META)))
+        with self._lock:
+            ref = self._items.get(key)
+            if ref is not None:
+                self._items.move_to_end(key)
+                return ref
+        ref = ReferenceIndex(run_dir)
+        with self._lock:
+            self._items[key] = ref
+            while len(self._items) > self.max_items:
+                self._items.popitem(last=False)
+        return ref
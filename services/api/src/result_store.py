@@ -0,0 +1,109 @@
+import os
+import re
+import gzip
+import json
+import hashlib
+from typing import Optional, Tuple
+
+from .config import settings
+
+_DIGEST_RE = re.compile(r"^[0-9a-f]{64}$")
+_RUN_ID_RE = re.compile(r"^[0-9A-Za-z_-]{1,128}$")
+
+
+def run_dir(run_id: str, create: bool = False) -> str:
+    """每个 run 的产物目录: {UPLOAD_DIR}/runs/{run_id}"""
+    if not _RUN_ID_RE.match(run_id or ""):
+        raise ValueError(f"非法 run_id: {run_id}")
+    path = os.path.join(settings.RUNS_DIR, run_id)
+    if create:
+        os.makedirs(path, exist_ok=True)
+    return path
+
+
+class ResultStore:
+    """
+    大结果卸载：完整报告 (HTML Marker 表、诊断文本、步骤详情) 写入磁盘，
+    gzip 压缩 + 按 sha256 内容寻址 (相同内容只存一份)：
+        runs/{run_id}/blobs/{sha256}.gz
+    Celery 结果里只保留一个精简 manifest：
+    {
+        "status", "error", "qc_metrics", "final_plot",
+        "steps_details": [{"name", "status", "plot", "summary", "details_ref"?}],
+        "report_ref": {"sha256", "size", "stored"},
+        "artifacts": {"diagnosis": {...}, "local_markers.details": {...}}
+    }
+    """
+
+    def __init__(self, inline_limit: int = 2048):
+        # 小于该字节数的字段直接内联在 manifest 中
+        self.inline_limit = inline_limit
+
+    def _blob_path(self, run_id: str, digest: str) -> str:
+        return os.path.join(run_dir(run_id), "blobs", f"{digest}.gz")
+
+    def put_blob(self, run_id: str, data: bytes) -> dict:
+        digest = hashlib.sha256(data).hexdigest()
+        path = self._blob_path(run_id, digest)
+        if not os.path.exists(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            tmp = f"{path}.tmp"
+            with open(tmp, "wb") as f:
+                # mtime=0 保证相同内容的压缩结果字节一致
+                f.write(gzip.compress(data, compresslevel=6, mtime=0))
+            os.replace(tmp, path)
+        return {"sha256": digest, "size": len(data), "stored": os.path.getsize(path)}
+
+    def blob_path(self, run_id: str, digest: str) -> Optional[str]:
+        if not _DIGEST_RE.match(digest or ""):
+            return None
+        path = self._blob_path(run_id, digest)
+        return path if os.path.exists(path) else None
+
+    def read_blob(self, run_id: str, digest: str) -> Optional[bytes]:
+        path = self.blob_path(run_id, digest)
+        if path is None:
+            return None
+        with open(path, "rb") as f:
+            return gzip.decompress(f.read())
+
+    def offload(self, run_id: str, report: dict) -> dict:
+        """把完整报告落盘，返回精简 manifest (作为 Celery 任务结果)"""
+        full = json.dumps(report, ensure_ascii=False, default=str).encode("utf-8")
+        manifest = {k: v for k, v in report.items() if k not in ("steps_details", "diagnosis")}
+        manifest["report_ref"] = self.put_blob(run_id, full)
+        manifest["artifacts"] = {}
+
+        diagnosis = report.get("diagnosis") or ""
+        if len(diagnosis.encode("utf-8")) > self.inline_limit:
+            manifest["artifacts"]["diagnosis"] = self.put_blob(run_id, diagnosis.encode("utf-8"))
+        else:
+            manifest["diagnosis"] = diagnosis
+
+        steps = []
+        for step in report.get("steps_details", []):
+            compact = {k: v for k, v in step.items() if k != "details"}
+            details = step.get("details") or ""
+            if len(details.encode("utf-8")) > self.inline_limit:
+                ref = self.put_blob(run_id, details.encode("utf-8"))
+                manifest["artifacts"][f"{step.get('name')}.details"] = ref
+                compact["details_ref"] = ref["sha256"]
+            elif details:
+                compact["details"] = details
+            steps.append(compact)
+        manifest["steps_details"] = steps
+        manifest["offloaded"] = True
+        return manifest
+
+    def load_report(self, run_id: str, manifest: dict) -> Tuple[Optional[dict], Optional[str]]:
+        """按 manifest 还原完整报告，返回 (report, digest)"""
+        ref = (manifest or {}).get("report_ref")
+        if not ref:
+            return None, None
+        data = self.read_blob(run_id, ref["sha256"])
+        if data is None:
+            return None, None
+        return json.loads(data), ref["sha256"]
+
+
+result_store = ResultStore(inline_limit=settings.RESULT_INLINE_LIMIT)
@@ -0,0 +1,125 @@
+import signal
+import threading
+import time
+from contextlib import contextmanager
+
+# 工作流运行控制：协作式取消 + 单步 / 总时长预算
+#
+# 步骤之间调用 guard.check()；步骤执行期间 (guard.step) 用 SIGALRM 打断：
+#   - 预算到期：ITIMER_REAL 定时器触发
+#   - 收到取消：后台线程轮询取消标记，置位后向主线程发送 SIGALRM
+# 信号处理函数只能在 Python 字节码之间执行，长时间运行的 C 扩展调用 (BLAS / numba) 返回后才会被打断。
+# 非主线程中无法安装信号处理函数，此时退化为只在步骤之间检查。
+
+
+class RunInterrupted(BaseException):
+    """
+    继承 BaseException (与 KeyboardInterrupt 一样)：步骤内部的 except Exception 兜底不会把取消 / 超时吞掉
+    """
+
+    def __init__(self, reason: str, step: str = None):
+        self.reason = reason  # "cancelled" | "timeout"
+        self.step = step
+        super().__init__(f"{reason} at {step or 'start'}")
+
+
+def _budget(value):
+    try:
+        value = float(value)
+    except (TypeError, ValueError):
+        return None
+    return value if value > 0 else None
+
+
+class RunGuard:
+    # 技能里以 run_control、Worker 里以 src.run_control 导入本模块，两边的 RunInterrupted 不是同一个类：
+    # 调用方用 except guard.Interrupted 捕获，保证与实际抛出的类一致
+    Interrupted = RunInterrupted
+
+    def __init__(self, should_cancel=None, step_budget=None, total_budget=None, poll_interval: float = 1.0):
+        self.should_cancel = should_cancel
+        self.step_budget = _budget(step_budget)
+        self.total_budget = _budget(total_budget)
+        self.poll_interval = poll_interval
+        self.started = time.monotonic()
+        self._cancelled = False
+        self._current = None
+
+    @property
+    def elapsed(self) -> float:
+        return time.monotonic() - self.started
+
+    def remaining(self):
+        if self.total_budget is None:
+            return None
+        return self.total_budget - self.elapsed
+
+    def cancelled(self) -> bool:
+        if not self._cancelled and self.should_cancel is not None:
+            try:
+                self._cancelled = bool(self.should_cancel())
+            except Exception:
+                # 取消标记读不到 (Redis 抖动) 时继续运行
+                pass
+        return self._cancelled
+
+    def check(self, step: str = None):
+        """步骤边界检查：已取消或总预算耗尽时抛出 RunInterrupted"""
+        if self.cancelled():
+            raise RunInterrupted("cancelled", step)
+        remaining = self.remaining()
+        if remaining is not None and remaining <= 0:
+            raise RunInterrupted("timeout", step)
+
+    def _limit_for_step(self):
+        limits = [b for b in (self.step_budget, self.remaining()) if b is not None]
+        return max(min(limits), 0.001) if limits else None
+
+    def _on_alarm(self, signum, frame):
+        raise RunInterrupted("cancelled" if self._cancelled else "timeout", self._current)
+
+    def _watch(self, stop: threading.Event, main_ident: int):
+        while not stop.wait(self.poll_interval):
+            if self.cancelled():
+                signal.pthread_kill(main_ident, signal.SIGALRM)
+                return
+
+    @contextmanager
+    def step(self, name: str):
+        self.check(name)
+        self._current = name
+        limit = self._limit_for_step()
+        if (threading.current_thread() is not threading.main_thread()
+                or (limit is None and self.should_cancel is None)):
+            try:
+                yield
+            finally:
+                self._current = None
+            return
+
+        previous = signal.signal(signal.SIGALRM, self._on_alarm)
+        stop = threading.Event()
+        watcher = None
+        if self.should_cancel is not None:
+            watcher = threading.Thread(target=self._watch, args=(stop, threading.main_thread().ident), daemon=True)
+            watcher.start()
+        if limit is not None:
+            signal.setitimer(signal.ITIMER_REAL, limit)
+        try:
+            yield
+        finally:
+            # 先屏蔽 SIGALRM 再拆除：join 期间定时器到期或 watcher 补发的信号不能在 finally 里抛出，
+            # 否则定时器和处理函数会残留下来，打断之后无关的代码 (AI 诊断、同一子进程的下一个任务)
+            signal.pthread_sigmask(signal.SIG_BLOCK, {signal.SIGALRM})
+            try:
+                signal.setitimer(signal.ITIMER_REAL, 0)
+                stop.set()
+                if watcher is not None:
+                    watcher.join()
+                # 丢弃屏蔽期间挂起的 SIGALRM (恢复的处理函数可能是 SIG_DFL，收到就会终止进程)
+                while signal.sigtimedwait({signal.SIGALRM}, 0) is not None:
+                    pass
+                signal.signal(signal.SIGALRM, previous)
+            finally:
+                signal.pthread_sigmask(signal.SIG_UNBLOCK, {signal.SIGALRM})
+                self._current = None
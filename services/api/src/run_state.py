@@ -0,0 +1,247 @@
+import os
+import json
+import shutil
+import threading
+from collections import OrderedDict
+
+import numpy as np
+import pandas as pd
+import scipy.sparse as sp
+import anndata as ad
+
+try:
+    from anndata.io import sparse_dataset, read_elem, write_elem
+except ImportError:
+    # anndata < 0.11
+    from anndata.experimental import sparse_dataset, read_elem, write_elem
+
+import zarr
+
+# 分析结束后保存的可查询状态 (每个 run 一份)：
+#   runs/{run_id}/state.zarr
+#       X     : log-normalized 全基因表达，CSC 稀疏 (按列=基因 分块存储，单基因查询只读对应的列区间)
+#       obs   : leiden 等细胞注释
+#       obsm  : X_umap / X_tsne / X_pca
+#   runs/{run_id}/markers.json : 每个簇的 Marker 基因表 (score / logFC / p 值)
+STATE_NAME = "state.zarr"
+MARKERS_NAME = "markers.json"
+# HVG 筛选前先落盘的全基因矩阵，流程成功结束时补写注释并改名为 STATE_NAME
+STAGED_NAME = STATE_NAME + ".partial"
+OBS_COLUMNS = ("leiden", "batch", "mapping_confidence", "n_genes_by_counts", "total_counts", "pct_counts_mt")
+OBSM_KEYS = ("X_umap", "X_tsne", "X_pca")
+
+
+def stage_expression(run_dir: str, lognorm) -> str:
+    """
+    HVG 筛选前调用：把全基因 log-normalized 矩阵按 CSC 写入暂存目录
+    调用方随即丢掉对全基因对象的引用，之后的 scale / PCA / UMAP / t-SNE / Marker 不再背着它，峰值内存不翻倍
+    """
+    path = os.path.join(run_dir, STAGED_NAME)
+    discard_staged(run_dir)
+    ad.AnnData(
+        X=sp.csc_matrix(lognorm.X, dtype=np.float32),
+        obs=pd.DataFrame(index=lognorm.obs_names.copy()),
+        var=pd.DataFrame(index=lognorm.var_names.copy()),
+    ).write_zarr(path)
+    return path
+
+
+def discard_staged(run_dir: str):
+    """流程失败 / 被打断时清理暂存矩阵"""
+    shutil.rmtree(os.path.join(run_dir, STAGED_NAME), ignore_errors=True)
+
+
+def _finish_staged(run_dir: str, adata) -> str:
+    """在暂存矩阵上补写最终的 obs / obsm，再改名为正式状态目录 (HVG 之后不再过滤细胞，行顺序一致)"""
+    staged = os.path.join(run_dir, STAGED_NAME)
+    try:
+        # anndata 写出的是合并元数据 (consolidated) 的 store，要绕开它才能改写；改完重新合并
+        group = zarr.open_group(staged, mode="r+", use_consolidated=False)
+    except TypeError:
+        # zarr 2 的 open_group 本来就不读合并元数据
+        group = zarr.open_group(staged, mode="r+")
+    staged_cells = pd.Index(read_elem(group["obs"]).index)
+    if not staged_cells.equals(pd.Index(adata.obs_names)):
+        raise ValueError("暂存矩阵的细胞与最终结果不一致")
+
+    del group["obs"]
+    write_elem(group, "obs", adata.obs[[c for c in OBS_COLUMNS if c in adata.obs]].copy())
+    obsm = group.require_group("obsm")
+    for key in OBSM_KEYS:
+        if key in adata.obsm:
+            write_elem(obsm, key, np.asarray(adata.obsm[key], dtype=np.float32))
+    zarr.consolidate_metadata(staged)
+
+    path = os.path.join(run_dir, STATE_NAME)
+    shutil.rmtree(path, ignore_errors=True)
+    os.replace(staged, path)
+    return path
+
+
+def persist_run_state(run_dir: str, adata, n_markers: int = 100) -> str:
+    """
+    保存最终 AnnData 的精简版本，供后续“在 UMAP 上看 CD3E”之类的查询直接读取
+    表达矩阵优先用 stage_expression 暂存的全基因矩阵；没有暂存时退回 adata.X
+    """
+    if os.path.exists(os.path.join(run_dir, STAGED_NAME)):
+        path = _finish_staged(run_dir, adata)
+    else:
+        slim = ad.AnnData(
+            X=sp.csc_matrix(adata.X, dtype=np.float32),
+            obs=adata.obs[[c for c in OBS_COLUMNS if c in adata.obs]].copy(),
+            var=pd.DataFrame(index=adata.var_names.copy()),
+            obsm={k: np.asarray(adata.obsm[k], dtype=np.float32) for k in OBSM_KEYS if k in adata.obsm},
+        )
+        path = os.path.join(run_dir, STATE_NAME)
+        slim.write_zarr(path)
+
+    if "rank_genes_groups" in adata.uns:
+        result = adata.uns["rank_genes_groups"]
+        markers = {}
+        for group in result["names"].dtype.names:
+            rows = []
+            for i in range(min(n_markers, len(result["names"][group]))):
+                row = {"gene": str(result["names"][group][i])}
+                for key in ("scores", "logfoldchanges", "pvals", "pvals_adj"):
+                    if key in result:
+                        value = float(result[key][group][i])
+                        row[key] = value if np.isfinite(value) else None  # NaN 不是合法 JSON
+                rows.append(row)
+            markers[str(group)] = rows
+        with open(os.path.join(run_dir, MARKERS_NAME), "w", encoding="utf-8") as f:
+            json.dump(markers, f, ensure_ascii=False)
+    return path
+
+
+class RunState:
+    """已保存 run 的惰性只读视图：打开时只读元数据，表达矩阵按基因列按需读取"""
+
+    def __init__(self, run_dir: str):
+        self.run_dir = run_dir
+        group = zarr.open_group(os.path.join(run_dir, STATE_NAME), mode="r")
+        self.X = sparse_dataset(group["X"])
+        self.var_names = pd.Index(read_elem(group["var"]).index)
+        self._var_lookup = {name.upper(): i for i, name in enumerate(self.var_names)}
+        self.obs = read_elem(group["obs"])
+        self._obsm_group = group["obsm"] if "obsm" in group else None
+        self._obsm = {}
+        self._markers = None
+        self.n_obs = len(self.obs)
+
+    def resolve_genes(self, genes):
+        """大小写不敏感地把基因名映射到列号，返回 (found[(name, col)], missing[])"""
+        found, missing = [], []
+        for g in genes:
+            col = self._var_lookup.get(g.strip().upper())
+            if col is None:
+                missing.append(g)
+            elif col not in {c for _, c in found}:
+                found.append((str(self.var_names[col]), col))
+        return found, missing
+
+    def gene_matrix(self, cols) -> np.ndarray:
+        """读取若干基因列，返回 dense (n_obs, len(cols)) float32"""
+        if not cols:
+            return np.zeros((self.n_obs, 0), dtype=np.float32)
+        order = np.argsort(cols)
+        sub = self.X[:, np.asarray(cols)[order]]
+        dense = np.asarray(sub.todense() if sp.issparse(sub) else sub, dtype=np.float32)
+        out = np.empty_like(dense)
+        out[:, order] = dense
+        return out
+
+    def embedding(self, basis: str):
+        key = f"X_{basis}"
+        if key not in self._obsm:
+            if self._obsm_group is None or key not in self._obsm_group:
+                return None
+            self._obsm[key] = np.asarray(self._obsm_group[key][:], dtype=np.float32)
+        return self._obsm[key]
+
+    def clusters(self):
+        if "leiden" not in self.obs:
+            return None
+        return self.obs["leiden"].astype("category")
+
+    def markers(self):
+        if self._markers is None:
+            path = os.path.join(self.run_dir, MARKERS_NAME)
+            self._markers = {}
+            if os.path.exists(path):
+                with open(path, encoding="utf-8") as f:
+                    self._markers = json.load(f)
+        return self._markers
+
+
+class RunStateCache:
+    """最近打开的 run 的 LRU 缓存 (避免每次查询都重新解析 zarr 元数据)"""
+
+    def __init__(self, max_runs: int = 8):
+        self.max_runs = max_runs
+        self._items: "OrderedDict[str, RunState]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, run_dir: str) -> RunState:
+        with self._lock:
+            state = self._items.get(run_dir)
+            if state is not None:
+                self._items.move_to_end(run_dir)
+                return state
+        # 打开放在锁外，慢的 run 不阻塞其他查询
+        state = RunState(run_dir)
+        with self._lock:
+            self._items[run_dir] = state
+            self._items.move_to_end(run_dir)
+            while len(self._items) > self.max_runs:
+                self._items.popitem(last=False)
+        return state
+
+
+def query_genes(state: RunState, genes, order=None) -> dict:
+    """
+    读取基因表达值 (只读这些基因对应的列)
+    order: 可选的行号排列 (如 embedding 文件里的 index)，返回值按该顺序对齐
+    """
+    found, missing = state.resolve_genes(genes)
+    matrix = state.gene_matrix([col for _, col in found])
+    if order is not None:
+        matrix = matrix[np.asarray(order)]
+    values, stats = {}, {}
+    for j, (name, _) in enumerate(found):
+        col = matrix[:, j]
+        values[name] = col
+        stats[name] = {
+            "mean": round(float(col.mean()), 4) if len(col) else 0.0,
+            "max": round(float(col.max()), 4) if len(col) else 0.0,
+            "pct_expressed": round(float((col > 0).mean() * 100), 2) if len(col) else 0.0,
+        }
+    return {"values": values, "stats": stats, "missing": missing}
+
+
+def query_cluster(state: RunState, cluster: str, n_markers: int = 20, genes=None) -> dict:
+    """单个簇的切片：细胞数、Marker 基因，以及可选基因在簇内/簇外的平均表达"""
+    clusters = state.clusters()
+    if clusters is None:
+        raise KeyError("该 run 没有聚类结果")
+    if str(cluster) not in set(map(str, clusters.cat.categories)):
+        raise KeyError(f"簇 {cluster} 不存在")
+    mask = (clusters.astype(str) == str(cluster)).values
+    result = {
+        "cluster": str(cluster),
+        "n_cells": int(mask.sum()),
+        "fraction": round(float(mask.mean()), 4),
+        "markers": state.markers().get(str(cluster), [])[:n_markers],
+    }
+    if genes:
+        found, missing = state.resolve_genes(genes)
+        matrix = state.gene_matrix([col for _, col in found])
+        rest = ~mask
+        result["gene_means"] = {
+            name: {
+                "in_cluster": round(float(matrix[mask, j].mean()), 4),
+                "rest": round(float(matrix[rest, j].mean()), 4) if rest.any() else None,
+            }
+            for j, (name, _) in enumerate(found)
+        }
+        result["missing"] = missing
+    return result
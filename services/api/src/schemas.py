@@ -1,4 +1,4 @@
-from pydantic import BaseModel
+from pydantic import BaseModel, Field
 from typing import List, Optional, Dict, Any
 
 class FileInfo(BaseModel):
@@ -7,6 +7,8 @@ class FileInfo(BaseModel):
 
 class ChatRequest(BaseModel):
     message: str
+    # 服务端会话 ID：携带时只需发送新消息，history / uploaded_files 由服务端补全
+    session_id: Optional[str] = None
     history: List[Dict[str, str]] = []
     # 对应前端的 selectedTool
     selected_tool: Optional[Dict[str, Any]] = None
@@ -18,3 +20,9 @@ class ChatRequest(BaseModel):
     uploaded_files: List[FileInfo] = []
     # 对应前端的 useHistoryFiles
     use_history_files: bool = False
+
+class SessionCreateRequest(BaseModel):
+    uploaded_files: List[FileInfo] = []
+
+class StatusBatchRequest(BaseModel):
+    run_ids: List[str] = Field(default_factory=list, max_length=500)
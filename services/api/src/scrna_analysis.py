@@ -3,31 +3,385 @@ import os
 import matplotlib
 matplotlib.use('Agg') 
 import matplotlib.pyplot as plt
+import numpy as np
 import pandas as pd
 import time
 import warnings
 import io
 import base64
+import resource
+import signal
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, as_completed
+import anndata as ad
+
+try:
+    from embedding_export import write_embedding
+    from run_state import persist_run_state, stage_expression, discard_staged
+    from rss_monitor import RssMonitor
+    from datasets import dataset_key, checkpoint_path, prune_cache
+    from run_control import RunGuard
+    from reference_index import persist_reference
+    from tracing import span
+    from fused_preprocess import fused_preprocess, available as fused_available
+except ImportError:
+    # Docker 环境下的备用导入
+    from src.embedding_export import write_embedding
+    from src.run_state import persist_run_state, stage_expression, discard_staged
+    from src.rss_monitor import RssMonitor
+    from src.datasets import dataset_key, checkpoint_path, prune_cache
+    from src.run_control import RunGuard
+    from src.reference_index import persist_reference
+    from src.tracing import span
+    from src.fused_preprocess import fused_preprocess, available as fused_available
 
 warnings.filterwarnings("ignore")
 
+# 预热 checkpoint 在 adata.uns 里的标记
+PREFETCH_MARK = "gibh_prefetch"
+
+# 多样本模式下合并后的批次列
+BATCH_KEY = "batch"
+# 每个样本在子进程里完成的步骤 (合并后在流程里只出汇总)
+PER_SAMPLE_STEPS = ("local_qc", "local_normalize")
+# 样本总大小低于该值时串行预处理：spawn 子进程重新 import scanpy 要数秒，小队列并行反而更慢
+POOL_MIN_BYTES = 256 * 1024 ** 2
+
 sc.settings.verbosity = 3
 sc.settings.set_figure_params(dpi=300, facecolor='white', frameon=True, vector_friendly=True)
 
+def _register_worker(pids, aborted):
+    """
+    进程池 initializer：子进程启动时登记 pid，主进程取消时据此终止仍在运行的子进程
+    先登记再检查 aborted：主进程置位后才登记的子进程在这里直接退出，不会漏杀
+    """
+    pids.put(os.getpid())
+    if aborted.is_set():
+        os._exit(0)
+
+
+def _terminate_workers(pids, aborted):
+    aborted.set()
+    while not pids.empty():
+        try:
+            os.kill(pids.get(), signal.SIGTERM)
+        except (ProcessLookupError, PermissionError):
+            pass
+
+
+def _preprocess_sample(name, path, output_dir, cache_dir, min_genes, max_mt, do_qc, do_normalize):
+    """多样本模式的子进程入口：单个样本的读取 + QC 过滤 + LogNormalize，返回 (adata, 计时)"""
+    t0 = time.perf_counter()
+    pipeline = LocalSingleCellPipeline(output_dir=output_dir, cache_dir=cache_dir)
+    adata = pipeline.load_data(path)
+    prefetched = bool(adata.uns.get(PREFETCH_MARK, {}).get("qc"))
+    raw_cells = adata.n_obs
+    t1 = time.perf_counter()
+    if do_qc:
+        # 预热 checkpoint 已含 QC 指标时 _annotate_qc 直接跳过
+        pipeline._annotate_qc(adata)
+        sc.pp.filter_cells(adata, min_genes=min_genes)
+        adata = adata[adata.obs.pct_counts_mt < max_mt, :].copy()
+    adata.uns.pop(PREFETCH_MARK, None)
+    t2 = time.perf_counter()
+    if do_normalize:
+        sc.pp.normalize_total(adata, target_sum=1e4)
+        sc.pp.log1p(adata)
+    t3 = time.perf_counter()
+    return adata, {
+        "sample": name,
+        "prefetched": prefetched,
+        "raw_cells": raw_cells,
+        "filtered_cells": adata.n_obs,
+        "n_genes": adata.n_vars,
+        "load_seconds": round(t1 - t0, 3),
+        "qc_seconds": round(t2 - t1, 3),
+        "normalize_seconds": round(t3 - t2, 3),
+        "total_seconds": round(t3 - t0, 3),
+        "peak_mb": round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1),
+    }
+
+
 class LocalSingleCellPipeline:
-    def __init__(self, output_dir="/app/uploads/results"):
+    def __init__(self, output_dir="/app/uploads/results", run_dir=None, run_url=None, cache_dir=None,
+                 sample_workers=4, fused=True):
         self.output_dir = output_dir
         os.makedirs(self.output_dir, exist_ok=True)
+        # 本次 run 的产物目录 (embedding 二进制等)，以及对应的 API 访问前缀
+        self.run_dir = run_dir
+        self.run_url = run_url
+        if self.run_dir:
+            os.makedirs(self.run_dir, exist_ok=True)
+        # 预热 checkpoint 目录 (见 prefetch)
+        self.cache_dir = cache_dir
+        # 多样本模式下并行预处理的进程数
+        self.sample_workers = sample_workers
+        # 单样本流程的 QC / LogNormalize / HVG 统计合并为一次矩阵扫描 (见 fused_preprocess)
+        self.fused = fused
 
     def _save_plot(self, name_prefix):
         timestamp = int(time.time())
         filename = f"{name_prefix}_{timestamp}.png"
         save_path = os.path.join(self.output_dir, filename)
-        plt.savefig(save_path, bbox_inches='tight', dpi=300)
-        plt.close()
+        with span("render_plot", {"plot": name_prefix}):
+            plt.savefig(save_path, bbox_inches='tight', dpi=300)
+            plt.close()
         return f"/uploads/results/{filename}"
 
-    def run_pipeline(self, data_input, steps_config=None):
+    def _export_embedding(self, adata, basis, rows=None):
+        """导出 float32 坐标 + 聚类编码的紧凑二进制，前端用 WebGL 直接绘制/重新着色"""
+        if not self.run_dir or f"X_{basis}" not in adata.obsm:
+            return None
+        codes, categories = None, None
+        if 'leiden' in adata.obs:
+            leiden = adata.obs['leiden'].astype('category')
+            codes = leiden.cat.codes.values
+            categories = [str(c) for c in leiden.cat.categories]
+        path = os.path.join(self.run_dir, f"embedding_{basis}.gemb")
+        header = write_embedding(path, adata.obsm[f"X_{basis}"], codes, categories, basis=basis, rows=rows)
+        return {
+            "basis": basis,
+            "url": f"{self.run_url}/embedding/{basis}" if self.run_url else None,
+            "n_points": header["n_points"],
+            "bytes": header["file_bytes"],
+            "levels": [level["n"] for level in header["levels"]],
+        }
+
+    def _read_input(self, data_input):
+        """从原始文件读取 AnnData (10x 目录 / h5ad / 其他 scanpy 支持的格式)"""
+        # === 🛠️ 核心修复：更健壮的数据读取逻辑 ===
+        if os.path.isdir(data_input):
+            # 尝试读取 10x 目录
+            try:
+                # 优先尝试标准读取 (会自动找 .gz)
+                adata = sc.read_10x_mtx(data_input, var_names='gene_symbols', cache=False)
+            except FileNotFoundError:
+                print("⚠️ read_10x_mtx failed, trying manual mtx load...")
+                # 如果失败 (比如文件没压缩)，尝试手动读取
+                # 假设文件名是标准的 matrix.mtx, features.tsv, barcodes.tsv
+                mtx_path = os.path.join(data_input, "matrix.mtx")
+                if not os.path.exists(mtx_path): mtx_path = os.path.join(data_input, "matrix.mtx.gz")
+                
+                adata = sc.read_mtx(mtx_path).T  # 读入后转置 (Cells x Genes)
+                
+                # 读取 features (genes)
+                genes_path = os.path.join(data_input, "features.tsv")
+                if not os.path.exists(genes_path): genes_path = os.path.join(data_input, "genes.tsv")
+                genes = pd.read_csv(genes_path, header=None, sep='\t')
+                adata.var_names = genes[1].values # 假设第二列是基因名
+                adata.var['gene_ids'] = genes[0].values
+                
+                # 读取 barcodes
+                barcodes_path = os.path.join(data_input, "barcodes.tsv")
+                barcodes = pd.read_csv(barcodes_path, header=None, sep='\t')
+                adata.obs_names = barcodes[0].values
+            
+            adata.var_names_make_unique()
+            
+        elif data_input.endswith('.h5ad'):
+            adata = sc.read_h5ad(data_input)
+        else:
+            adata = sc.read(data_input)
+        # ===========================================
+        return adata
+
+    def load_data(self, data_input):
+        """读取数据集；有预热 checkpoint 时直接读取 (已含 QC 指标)"""
+        if self.cache_dir:
+            try:
+                path = checkpoint_path(self.cache_dir, dataset_key(data_input))
+                if os.path.exists(path):
+                    adata = sc.read_h5ad(path)
+                    os.utime(path)  # 刷新访问时间，供 LRU 淘汰参考
+                    print(f"⚡ 命中预热 checkpoint: {path}")
+                    return adata
+            except Exception as e:
+                print(f"⚠️ 读取预热 checkpoint 失败，改为读取原始数据: {e}")
+        return self._read_input(data_input)
+
+    @staticmethod
+    def _run_fused(adata, **kwargs):
+        """
+        融合预处理；JIT 编译 / 加载失败时返回 None，由调用方退回 scanpy 步骤
+        (这类错误在扫描开始前抛出，此时矩阵尚未改动)
+        """
+        try:
+            return fused_preprocess(adata, **kwargs)
+        except Exception as e:
+            print(f"⚠️ 融合预处理不可用，退回 scanpy 步骤: {e}")
+            return None
+
+    @staticmethod
+    def _annotate_qc(adata):
+        # 预热阶段已算过的 QC 指标直接复用
+        if adata.uns.get(PREFETCH_MARK, {}).get("qc"):
+            return
+        adata.var['mt'] = adata.var_names.str.startswith(('MT-', 'mt-'))
+        sc.pp.calculate_qc_metrics(adata, qc_vars=['mt'], inplace=True)
+
+    def prefetch(self, data_input, should_stop=None, max_cache_bytes=None):
+        """
+        投机预热：解析数据集 + 计算 QC 指标，写入 checkpoint
+        should_stop: 返回 True 时放弃 (被取消或有正式任务在排队)；每个阶段开始前检查，
+        阶段执行期间由 RunGuard 在后台轮询并打断 (大文件的读取可能持续很久，不能一直占着 Worker)
+        """
+        key = dataset_key(data_input)
+        path = checkpoint_path(self.cache_dir, key)
+        if os.path.exists(path):
+            return {"status": "cached", "dataset_key": key}
+
+        guard = RunGuard(should_cancel=should_stop)
+        tmp = os.path.join(self.cache_dir, f".{key}.{os.getpid()}.h5ad")
+        t0 = time.perf_counter()
+        try:
+            with guard.step("load"):
+                adata = self._read_input(data_input)
+            with guard.step("qc"):
+                self._annotate_qc(adata)
+                adata.uns[PREFETCH_MARK] = {"qc": True, "dataset_key": key}
+            with guard.step("write"):
+                os.makedirs(self.cache_dir, exist_ok=True)
+                adata.write_h5ad(tmp)
+                os.replace(tmp, path)
+        except guard.Interrupted as e:
+            if os.path.exists(tmp):
+                os.remove(tmp)
+            return {"status": "cancelled", "dataset_key": key, "stage": e.step}
+
+        if max_cache_bytes:
+            prune_cache(self.cache_dir, max_cache_bytes, keep=path)
+        return {"status": "success", "dataset_key": key, "n_obs": adata.n_obs, "n_vars": adata.n_vars,
+                "seconds": round(time.perf_counter() - t0, 3)}
+
+    def _preprocess_samples(self, samples, steps_config):
+        """
+        多样本模式：进程池里并行完成各样本的读取 / QC / 标准化，再按共同基因合并 (obs["batch"] 为样本名)
+        返回 (合并后的 adata, 每个样本的计时与细胞数, 预处理总墙钟时间)
+        """
+        tool_ids = {step['tool_id'] for step in steps_config}
+        qc_params = next((step.get('params', {}) for step in steps_config if step['tool_id'] == 'local_qc'), {})
+        kwargs = {
+            "output_dir": self.output_dir,
+            "cache_dir": self.cache_dir,
+            "min_genes": int(qc_params.get('min_genes', 200)),
+            "max_mt": float(qc_params.get('max_mt', 20)),
+            "do_qc": 'local_qc' in tool_ids,
+            "do_normalize": 'local_normalize' in tool_ids,
+        }
+        t0 = time.perf_counter()
+        results = {}
+        pool = None
+        worker_pids = aborted = None
+        workers = min(len(samples), self.sample_workers or 1)
+        if sum(os.path.getsize(path) for _, path in samples) < POOL_MIN_BYTES:
+            workers = 1
+        if workers > 1:
+            try:
+                # spawn：Worker 进程里已有 BLAS / 采样线程，fork 后子进程可能死锁
+                ctx = multiprocessing.get_context("spawn")
+                worker_pids, aborted = ctx.SimpleQueue(), ctx.Event()
+                pool = ProcessPoolExecutor(max_workers=workers, mp_context=ctx,
+                                           initializer=_register_worker, initargs=(worker_pids, aborted))
+            except (OSError, AssertionError, NotImplementedError) as e:
+                print(f"⚠️ 无法创建进程池，改为串行预处理: {e}")
+
+        if pool is None:
+            for name, path in samples:
+                results[name] = _preprocess_sample(name, path, **kwargs)
+        else:
+            try:
+                futures = {pool.submit(_preprocess_sample, name, path, **kwargs): name for name, path in samples}
+                for future in as_completed(futures):
+                    name = futures[future]
+                    try:
+                        results[name] = future.result()
+                    except Exception as e:
+                        raise RuntimeError(f"样本 {name} 预处理失败: {e}") from e
+            except BaseException:
+                # 取消 / 超时 / 单个样本失败：立即终止其余子进程，不等它们跑完
+                _terminate_workers(worker_pids, aborted)
+                pool.shutdown(wait=False, cancel_futures=True)
+                raise
+            pool.shutdown()
+
+        names = [name for name, _ in samples]
+        adata = ad.concat([results[name][0] for name in names], join="inner", merge="same", uns_merge="same",
+                          label=BATCH_KEY, keys=names, index_unique="-")
+        return adata, [results[name][1] for name in names], round(time.perf_counter() - t0, 3)
+
+    def _fused_plan(self, adata, steps_config):
+        """
+        QC 之后紧跟 LogNormalize (可再接 HVG) 时返回由融合预处理一次完成的步骤集合
+        未开启、numba 不可用、矩阵不是 CSR 或步骤顺序不同时返回空集合，按原步骤逐个执行
+        """
+        if not self.fused or not fused_available(adata):
+            return set()
+        tool_ids = [step['tool_id'] for step in steps_config]
+        if 'local_qc' not in tool_ids:
+            return set()
+        plan = {'local_qc'}
+        i = tool_ids.index('local_qc')
+        for tool_id in ('local_normalize', 'local_hvg'):
+            i += 1
+            if i >= len(tool_ids) or tool_ids[i] != tool_id:
+                break
+            plan.add(tool_id)
+        return plan if 'local_normalize' in plan else set()
+
+    @staticmethod
+    def _pca_rep(adata):
+        # 有批次校正结果时邻接图 / t-SNE 用校正后的 PC
+        return adata.uns.get('batch_correction', {}).get('rep', 'X_pca')
+
+    @staticmethod
+    def _correct_batches(adata):
+        """
+        在共享 PCA 空间上做批次校正，结果写入 obsm["X_pca_corrected"]
+        装了 harmonypy 时用 Harmony；否则退化为逐批次中心化 (去掉各样本 PC 均值的平移)
+        """
+        try:
+            import harmonypy  # noqa: F401
+            sc.external.pp.harmony_integrate(adata, BATCH_KEY, basis='X_pca', adjusted_basis='X_pca_corrected')
+            method = "harmony"
+        except ImportError:
+            X = np.asarray(adata.obsm['X_pca'], dtype=np.float64)
+            corrected = X - X.mean(axis=0)
+            batches = adata.obs[BATCH_KEY].values
+            for batch in np.unique(batches):
+                mask = batches == batch
+                corrected[mask] -= corrected[mask].mean(axis=0)
+            adata.obsm['X_pca_corrected'] = (corrected + X.mean(axis=0)).astype(np.float32)
+            method = "center"
+        adata.uns['batch_correction'] = {"method": method, "rep": "X_pca_corrected"}
+        return method
+
+    @staticmethod
+    def _interrupted_report(report, e, guard):
+        """取消 / 超时：保留已完成步骤 (图、指标) 作为部分结果，不保存可查询状态"""
+        print(f"⏹️ Pipeline interrupted ({e.reason}) at: {e.step}")
+        label = "已取消" if e.reason == "cancelled" else "超出时间预算"
+        report["steps_details"].append({"name": e.step, "status": e.reason, "plot": None,
+                                        "details": "", "summary": label})
+        report["status"] = e.reason
+        report["partial"] = True
+        report["interrupted"] = {"reason": e.reason, "step": e.step, "elapsed": round(guard.elapsed, 3)}
+        done = sum(1 for st in report["steps_details"] if st["status"] == "success")
+        report["diagnosis"] = f"""
+            ### ⏹️ 分析未完成 ({label})
+            - **中断步骤**: {e.step}
+            - **已完成步骤**: {done}
+            - **原始细胞**: {report['qc_metrics'].get('raw_cells', 'N/A')}
+            - **过滤后**: {report['qc_metrics'].get('filtered_cells', 'N/A')}
+            """
+        return report
+
+    def run_pipeline(self, data_input, steps_config=None, guard=None, on_progress=None):
+        """
+        data_input: 单个数据集路径；或 [(样本名, 路径), ...] 表示多样本联合分析
+        guard: RunGuard，提供取消 / 时间预算；被打断时返回已完成步骤组成的部分结果
+        on_progress: 每一步开始前回调 (已完成步骤 + 当前运行步骤)，用于上报进度
+        """
+        guard = guard or RunGuard()
         report = {
             "status": "running",
             "steps_details": [],
@@ -37,49 +391,48 @@ class LocalSingleCellPipeline:
             "error": None
         }
         adata = None
+        staged_seconds = 0.0  # HVG 筛选前暂存全基因矩阵 (可查询状态) 的耗时，计入 persist
 
         try:
-            print(f"📂 Loading data from: {data_input}")
-            
-            # === 🛠️ 核心修复：更健壮的数据读取逻辑 ===
-            if os.path.isdir(data_input):
-                # 尝试读取 10x 目录
-                try:
-                    # 优先尝试标准读取 (会自动找 .gz)
-                    adata = sc.read_10x_mtx(data_input, var_names='gene_symbols', cache=False)
-                except FileNotFoundError:
-                    print("⚠️ read_10x_mtx failed, trying manual mtx load...")
-                    # 如果失败 (比如文件没压缩)，尝试手动读取
-                    # 假设文件名是标准的 matrix.mtx, features.tsv, barcodes.tsv
-                    mtx_path = os.path.join(data_input, "matrix.mtx")
-                    if not os.path.exists(mtx_path): mtx_path = os.path.join(data_input, "matrix.mtx.gz")
-                    
-                    adata = sc.read_mtx(mtx_path).T  # 读入后转置 (Cells x Genes)
-                    
-                    # 读取 features (genes)
-                    genes_path = os.path.join(data_input, "features.tsv")
-                    if not os.path.exists(genes_path): genes_path = os.path.join(data_input, "genes.tsv")
-                    genes = pd.read_csv(genes_path, header=None, sep='\t')
-                    adata.var_names = genes[1].values # 假设第二列是基因名
-                    adata.var['gene_ids'] = genes[0].values
-                    
-                    # 读取 barcodes
-                    barcodes_path = os.path.join(data_input, "barcodes.tsv")
-                    barcodes = pd.read_csv(barcodes_path, header=None, sep='\t')
-                    adata.obs_names = barcodes[0].values
-                
-                adata.var_names_make_unique()
-                
-            elif data_input.endswith('.h5ad'):
-                adata = sc.read_h5ad(data_input)
-            else:
-                adata = sc.read(data_input)
-            # ===========================================
-            
-            report["qc_metrics"]["raw_cells"] = adata.n_obs
-            report["qc_metrics"]["raw_genes"] = adata.n_vars
-            
             if not steps_config: steps_config = []
+            samples = data_input if isinstance(data_input, (list, tuple)) else None
+            t_load = time.perf_counter()
+
+            if samples:
+                print(f"📂 Preprocessing {len(samples)} samples in parallel")
+                if on_progress:
+                    on_progress([{"name": "preprocess_samples", "status": "running"}])
+                with guard.step("preprocess_samples"), span("preprocess_samples", {"samples": len(samples)}):
+                    adata, sample_reports, wall = self._preprocess_samples(samples, steps_config)
+                report["samples"] = sample_reports
+                report["batch_key"] = BATCH_KEY
+                report["qc_metrics"]["n_samples"] = len(samples)
+                report["qc_metrics"]["raw_cells"] = sum(r["raw_cells"] for r in sample_reports)
+                report["qc_metrics"]["raw_genes"] = adata.n_vars
+                report["qc_metrics"]["sample_preprocess_seconds"] = wall
+                # 批次校正放在 PCA 之后、构建邻接图之前
+                expanded = []
+                for step in steps_config:
+                    expanded.append(step)
+                    if step['tool_id'] == 'local_pca':
+                        expanded.append({"name": "Batch Correction", "tool_id": "local_batch_correct", "params": {}})
+                steps_config = expanded
+            else:
+                print(f"📂 Loading data from: {data_input}")
+                if on_progress:
+                    on_progress([{"name": "load_data", "status": "running"}])
+                with guard.step("load_data"), span("load_data") as load_span:
+                    adata = self.load_data(data_input)
+                    load_span.set_attributes({"n_obs": int(adata.n_obs), "n_vars": int(adata.n_vars),
+                                              "prefetched": bool(adata.uns.get(PREFETCH_MARK))})
+                if adata.uns.get(PREFETCH_MARK):
+                    report["prefetched"] = True
+
+                report["qc_metrics"]["raw_cells"] = adata.n_obs
+                report["qc_metrics"]["raw_genes"] = adata.n_vars
+            # 步骤之外的耗时 (读取 / 保存状态)，供基准测试与排查使用
+            report["timings"] = {"load": round(time.perf_counter() - t_load, 3)}
+            fused = set() if samples else self._fused_plan(adata, steps_config)
 
             for step in steps_config:
                 tool_id = step['tool_id']
@@ -87,83 +440,176 @@ class LocalSingleCellPipeline:
                 step_result = {"name": tool_id, "status": "success", "plot": None, "details": ""}
 
                 print(f"▶️ Running step: {tool_id}")
+                if on_progress:
+                    on_progress(report["steps_details"] + [{"name": tool_id, "status": "running"}])
+
+                with guard.step(tool_id), RssMonitor() as mon, span(f"step.{tool_id}") as step_span:
+                    if samples and tool_id in PER_SAMPLE_STEPS:
+                        # 已在子进程里按样本完成，这里只汇总 (耗时不计入规划器的代价样本)
+                        step_result["per_sample"] = True
+                        key = "qc_seconds" if tool_id == "local_qc" else "normalize_seconds"
+                        step_result["samples"] = [{"sample": r["sample"], "seconds": r[key],
+                                                   "raw_cells": r["raw_cells"], "filtered_cells": r["filtered_cells"]}
+                                                  for r in sample_reports]
+                        if tool_id == "local_qc":
+                            sc.pl.violin(adata, ['n_genes_by_counts', 'total_counts', 'pct_counts_mt'], groupby=BATCH_KEY,
+                                         jitter=0.4, multi_panel=True, rotation=45, show=False)
+                            step_result["plot"] = self._save_plot("qc_violin")
+                            report["qc_metrics"]["filtered_cells"] = adata.n_obs
+                            step_result["summary"] = f"{len(samples)} 个样本并行质控，剩余 {adata.n_obs} 细胞"
+                        else:
+                            step_result["summary"] = f"{len(samples)} 个样本并行 LogNormalize 完成"
 
-                if tool_id == "local_qc":
-                    adata.var['mt'] = adata.var_names.str.startswith(('MT-', 'mt-'))
-                    sc.pp.calculate_qc_metrics(adata, qc_vars=['mt'], inplace=True)
-                    sc.pl.violin(adata, ['n_genes_by_counts', 'total_counts', 'pct_counts_mt'], jitter=0.4, multi_panel=True, show=False)
-                    step_result["plot"] = self._save_plot("qc_violin")
+                    elif tool_id == "local_qc":
+                        if adata.uns.get(PREFETCH_MARK, {}).get("qc"):
+                            # 耗时不代表真实 QC 代价，规划器不记录该样本
+                            step_result["prefetched"] = True
+                        min_genes = int(params.get('min_genes', 200))
+                        max_mt = float(params.get('max_mt', 20))
+                        if fused:
+                            # 一次扫描同时完成后续 LogNormalize / HVG 统计；耗时都计在本步，规划器按融合变体单独记录
+                            filtered = self._run_fused(adata, min_genes=min_genes, max_mt=max_mt, target_sum=1e4,
+                                                       n_top_genes=2000 if 'local_hvg' in fused else None)
+                            if filtered is None:
+                                fused = set()
+                            else:
+                                step_result["fused"] = True
+                        if not fused:
+                            self._annotate_qc(adata)
+                        # adata.obs 保留全部细胞的 QC 指标，小提琴图展示过滤前的分布
+                        sc.pl.violin(adata, ['n_genes_by_counts', 'total_counts', 'pct_counts_mt'], jitter=0.4, multi_panel=True, show=False)
+                        step_result["plot"] = self._save_plot("qc_violin")
                     
-                    min_genes = int(params.get('min_genes', 200))
-                    max_mt = float(params.get('max_mt', 20))
-                    sc.pp.filter_cells(adata, min_genes=min_genes)
-                    adata = adata[adata.obs.pct_counts_mt < max_mt, :]
+                        if fused:
+                            adata = filtered
+                        else:
+                            sc.pp.filter_cells(adata, min_genes=min_genes)
+                            adata = adata[adata.obs.pct_counts_mt < max_mt, :]
                     
-                    report["qc_metrics"]["filtered_cells"] = adata.n_obs
-                    step_result["summary"] = f"剩余 {adata.n_obs} 细胞"
-
-                elif tool_id == "local_normalize":
-                    sc.pp.normalize_total(adata, target_sum=1e4)
-                    sc.pp.log1p(adata)
-                    step_result["summary"] = "LogNormalize 完成"
-
-                elif tool_id == "local_hvg":
-                    sc.pp.highly_variable_genes(adata, n_top_genes=2000)
-                    sc.pl.highly_variable_genes(adata, show=False)
-                    step_result["plot"] = self._save_plot("hvg")
-                    adata = adata[:, adata.var.highly_variable]
-                    step_result["summary"] = "筛选 2000 高变基因"
-
-                elif tool_id == "local_scale":
-                    sc.pp.scale(adata, max_value=10)
-                    step_result["summary"] = "数据缩放完成"
-
-                elif tool_id == "local_pca":
-                    sc.tl.pca(adata, svd_solver='arpack')
-                    sc.pl.pca_variance_ratio(adata, log=True, show=False)
-                    step_result["plot"] = self._save_plot("pca_variance")
-                    step_result["summary"] = "PCA 降维完成"
-
-                elif tool_id == "local_neighbors":
-                    sc.pp.neighbors(adata, n_neighbors=10, n_pcs=40)
-                    step_result["summary"] = "邻接图构建完成"
-
-                elif tool_id == "local_cluster":
-                    resolution = float(params.get('resolution', 0.5))
-                    sc.tl.leiden(adata, resolution=resolution)
-                    n_clusters = len(adata.obs['leiden'].unique())
-                    step_result["summary"] = f"Leiden 聚类 (Res={resolution}): {n_clusters} 簇"
-
-                elif tool_id == "local_umap":
-                    sc.tl.umap(adata)
-                    fig, ax = plt.subplots(figsize=(8, 6))
-                    sc.pl.umap(adata, color=['leiden'], ax=ax, show=False, title="UMAP", legend_loc='on data', frameon=False)
-                    umap_path = self._save_plot("final_umap")
-                    step_result["plot"] = umap_path
-                    report["final_plot"] = umap_path
-                    step_result["summary"] = "UMAP 生成完毕"
-
-                elif tool_id == "local_tsne":
-                    if adata.n_obs < 5000: 
-                        sc.tl.tsne(adata)
-                        fig, ax = plt.subplots(figsize=(8, 6))
-                        sc.pl.tsne(adata, color=['leiden'], ax=ax, show=False, title="t-SNE", frameon=False)
-                        step_result["plot"] = self._save_plot("final_tsne")
-                        step_result["summary"] = "t-SNE 生成完毕"
-                    else:
-                        step_result["summary"] = "细胞数过多，跳过 t-SNE"
-
-                elif tool_id == "local_markers":
-                    sc.tl.rank_genes_groups(adata, 'leiden', method='t-test')
-                    result = adata.uns['rank_genes_groups']
-                    groups = result['names'].dtype.names
-                    markers_df = pd.DataFrame(
-                        {group + '_' + key: result[key][group]
-                        for group in groups for key in ['names', 'pvals']}
-                    ).head(5)
-                    step_result["details"] = markers_df.to_html(classes="table table-sm", index=False)
-                    step_result["summary"] = "Marker 基因鉴定完成"
+                        report["qc_metrics"]["filtered_cells"] = adata.n_obs
+                        step_result["summary"] = f"剩余 {adata.n_obs} 细胞"
+
+                    elif tool_id == "local_normalize":
+                        if tool_id in fused:
+                            step_result["fused"] = True
+                        else:
+                            sc.pp.normalize_total(adata, target_sum=1e4)
+                            sc.pp.log1p(adata)
+                        step_result["summary"] = "LogNormalize 完成"
 
+                    elif tool_id == "local_hvg":
+                        if tool_id in fused:
+                            step_result["fused"] = True
+                        else:
+                            # 多样本：各批次分别打分后合并排序，避免批次效应本身被选成高变基因
+                            sc.pp.highly_variable_genes(adata, n_top_genes=2000, batch_key=BATCH_KEY if samples else None)
+                        sc.pl.highly_variable_genes(adata, show=False)
+                        step_result["plot"] = self._save_plot("hvg")
+                        if self.run_dir:
+                            # 全基因 log-normalized 矩阵现在就落盘并丢掉引用，后续步骤的峰值内存不再包含它
+                            t_stage = time.perf_counter()
+                            try:
+                                with span("stage_expression"):
+                                    stage_expression(self.run_dir, adata)
+                            except Exception as e:
+                                print(f"⚠️ 暂存全基因表达矩阵失败，可查询状态将只包含高变基因: {e}")
+                            step_result["io_seconds"] = round(time.perf_counter() - t_stage, 3)
+                            staged_seconds += step_result["io_seconds"]
+                        adata = adata[:, adata.var.highly_variable].copy()
+                        step_result["summary"] = "筛选 2000 高变基因"
+
+                    elif tool_id == "local_scale":
+                        sc.pp.scale(adata, max_value=10)
+                        step_result["summary"] = "数据缩放完成"
+
+                    elif tool_id == "local_pca":
+                        svd_solver = params.get('svd_solver', 'arpack')
+                        sc.tl.pca(adata, svd_solver=svd_solver, n_comps=int(params.get('n_comps', 50)))
+                        step_result["variant"] = svd_solver
+                        sc.pl.pca_variance_ratio(adata, log=True, show=False)
+                        step_result["plot"] = self._save_plot("pca_variance")
+                        step_result["summary"] = "PCA 降维完成"
+
+                    elif tool_id == "local_batch_correct":
+                        method = self._correct_batches(adata)
+                        step_result["variant"] = method
+                        step_result["summary"] = f"批次校正完成 ({method}, {adata.obs[BATCH_KEY].nunique()} 个样本)"
+
+                    elif tool_id == "local_neighbors":
+                        n_pcs = min(int(params.get('n_pcs', 40)), adata.obsm['X_pca'].shape[1])
+                        sc.pp.neighbors(adata, n_neighbors=int(params.get('n_neighbors', 10)), n_pcs=n_pcs,
+                                        use_rep=self._pca_rep(adata))
+                        step_result["summary"] = "邻接图构建完成"
+
+                    elif tool_id == "local_cluster":
+                        resolution = float(params.get('resolution', 0.5))
+                        sc.tl.leiden(adata, resolution=resolution)
+                        n_clusters = len(adata.obs['leiden'].unique())
+                        step_result["summary"] = f"Leiden 聚类 (Res={resolution}): {n_clusters} 簇"
+
+                    elif tool_id == "local_umap":
+                        sc.tl.umap(adata)
+                        step_result["embedding"] = self._export_embedding(adata, "umap")
+                        if str(params.get('render_png', 'true')).lower() != 'false':
+                            fig, ax = plt.subplots(figsize=(8, 6))
+                            sc.pl.umap(adata, color=['leiden'], ax=ax, show=False, title="UMAP", legend_loc='on data', frameon=False)
+                            umap_path = self._save_plot("final_umap")
+                            step_result["plot"] = umap_path
+                            report["final_plot"] = umap_path
+                            if samples:
+                                # 按样本着色，用来检查批次校正后各样本是否混合均匀
+                                fig, ax = plt.subplots(figsize=(8, 6))
+                                sc.pl.umap(adata, color=[BATCH_KEY], ax=ax, show=False, title="UMAP (sample)", frameon=False)
+                                step_result["batch_plot"] = self._save_plot("umap_batch")
+                        step_result["summary"] = "UMAP 生成完毕"
+
+                    elif tool_id == "local_tsne":
+                        # auto: 保持原行为 (5k 细胞以下全量，否则跳过)；sketch: 均匀抽样子集跑 t-SNE
+                        mode = params.get('tsne_mode', 'auto')
+                        if mode == 'auto':
+                            mode = 'full' if adata.n_obs < 5000 else 'skip'
+                        sketch_size = int(params.get('tsne_sketch_size', 20000))
+                        if mode == 'sketch' and adata.n_obs <= sketch_size:
+                            mode = 'full'
+                        step_result["variant"] = mode
+
+                        if mode in ('full', 'sketch'):
+                            rows = None
+                            tsne_data = adata
+                            if mode == 'sketch':
+                                rows = np.sort(np.random.default_rng(0).choice(adata.n_obs, sketch_size, replace=False))
+                                tsne_data = adata[rows].copy()
+                            sc.tl.tsne(tsne_data, use_rep=self._pca_rep(tsne_data))
+                            step_result["embedding"] = self._export_embedding(tsne_data, "tsne", rows)
+                            if str(params.get('render_png', 'true')).lower() != 'false':
+                                fig, ax = plt.subplots(figsize=(8, 6))
+                                sc.pl.tsne(tsne_data, color=['leiden'], ax=ax, show=False, title="t-SNE", frameon=False)
+                                step_result["plot"] = self._save_plot("final_tsne")
+                            if mode == 'sketch':
+                                step_result["summary"] = f"t-SNE 生成完毕 (抽样 {sketch_size}/{adata.n_obs} 细胞)"
+                            else:
+                                step_result["summary"] = "t-SNE 生成完毕"
+                        else:
+                            step_result["summary"] = "细胞数过多，跳过 t-SNE"
+
+                    elif tool_id == "local_markers":
+                        sc.tl.rank_genes_groups(adata, 'leiden', method='t-test')
+                        result = adata.uns['rank_genes_groups']
+                        groups = result['names'].dtype.names
+                        markers_df = pd.DataFrame(
+                            {group + '_' + key: result[key][group]
+                            for group in groups for key in ['names', 'pvals']}
+                        ).head(5)
+                        step_result["details"] = markers_df.to_html(classes="table table-sm", index=False)
+                        step_result["summary"] = "Marker 基因鉴定完成"
+
+                    step_span.set_attributes({"variant": step_result.get("variant"), "peak_mb": round(mon.peak_mb, 1),
+                                              "n_obs": int(adata.n_obs), "n_vars": int(adata.n_vars)})
+
+                # 落盘耗时不计入步骤耗时 (规划器按步骤耗时拟合计算代价)
+                step_result["elapsed"] = round(mon.elapsed - step_result.get("io_seconds", 0), 3)
+                step_result["peak_mb"] = round(mon.peak_mb, 1)
+                step_result["shape"] = [int(adata.n_obs), int(adata.n_vars)]
                 report["steps_details"].append(step_result)
 
             report["diagnosis"] = f"""
@@ -174,13 +620,218 @@ class LocalSingleCellPipeline:
             - **可视化**: 已生成 UMAP 和 t-SNE (如适用) 图表。
             """
             
+            # 保存最终状态，后续查询 (基因表达、簇 Marker) 无需重跑
+            t_persist = time.perf_counter()
+            if self.run_dir:
+                try:
+                    with span("persist_run_state"):
+                        persist_run_state(self.run_dir, adata)
+                    report["state_url"] = self.run_url
+                except Exception as e:
+                    print(f"⚠️ 保存分析状态失败: {e}")
+                # 参考映射模型 + ANN 索引：之后的新样本可以直接投影到这个 run 上
+                try:
+                    with span("persist_reference"):
+                        reference = persist_reference(self.run_dir, adata)
+                    if reference:
+                        report["reference"] = reference
+                except Exception as e:
+                    print(f"⚠️ 保存参考索引失败: {e}")
+            report["timings"]["persist"] = round(time.perf_counter() - t_persist + staged_seconds, 3)
+
             report["status"] = "success"
             return report
 
+        except guard.Interrupted as e:
+            if self.run_dir:
+                discard_staged(self.run_dir)
+            return self._interrupted_report(report, e, guard)
+
         except Exception as e:
+            if self.run_dir:
+                discard_staged(self.run_dir)
             print(f"❌ Pipeline Error: {e}")
             import traceback
             traceback.print_exc()
             report["status"] = "failed"
             report["error"] = str(e)
             return report
+
+    @staticmethod
+    def _looks_lognormalized(adata, sample: int = 100000):
+        # 原始计数为整数且最大值通常远大于 20；log1p(CPM/1e4) 之后为小数且 < 20
+        X = adata.X
+        values = X.data if hasattr(X, "data") and not isinstance(X, np.ndarray) else np.asarray(X).ravel()
+        values = values[:sample]
+        if values.size == 0:
+            return False
+        return bool(values.max() < 20 and np.any(values != np.round(values)))
+
+    def _plot_mapping(self, reference, umap, labels, max_ref_points: int = 50000):
+        fig, ax = plt.subplots(figsize=(8, 6))
+        ref_umap = reference.umap
+        if len(ref_umap) > max_ref_points:
+            ref_umap = ref_umap[np.random.default_rng(0).choice(len(ref_umap), max_ref_points, replace=False)]
+        ax.scatter(ref_umap[:, 0], ref_umap[:, 1], s=1, c="#d1d5db", linewidths=0, label="reference")
+        cmap = plt.get_cmap("tab20")
+        for code, name in enumerate(reference.meta["categories"]):
+            mask = labels == code
+            if mask.any():
+                ax.scatter(umap[mask, 0], umap[mask, 1], s=3, color=cmap(code % 20), linewidths=0, label=name)
+        ax.set_title("Query mapped onto reference UMAP")
+        ax.set_xticks([]); ax.set_yticks([])
+        ax.legend(markerscale=4, fontsize=7, loc="center left", bbox_to_anchor=(1, 0.5), frameon=False)
+        return self._save_plot("reference_mapping")
+
+    def map_to_reference(self, data_input, reference, params=None, guard=None, on_progress=None):
+        """
+        参考映射：新数据集 QC + LogNormalize 后投影到参考 run 的 PCA 空间，
+        用 ANN 索引 kNN 迁移聚类标签与 UMAP 位置 (不重新聚类，耗时与参考规模基本无关)
+        reference: reference_index.ReferenceIndex
+        """
+        params = params or {}
+        guard = guard or RunGuard()
+        report = {
+            "status": "running",
+            "steps_details": [],
+            "final_plot": None,
+            "qc_metrics": {},
+            "diagnosis": "",
+            "error": None
+        }
+        state = {}
+
+        def run_step(tool_id, fn):
+            if on_progress:
+                on_progress(report["steps_details"] + [{"name": tool_id, "status": "running"}])
+            step_result = {"name": tool_id, "status": "success", "plot": None, "details": ""}
+            with guard.step(tool_id), RssMonitor() as mon, span(f"step.{tool_id}") as step_span:
+                step_result["summary"] = fn(step_result)
+                step_span.set_attributes({"variant": step_result.get("variant"), "peak_mb": round(mon.peak_mb, 1)})
+            step_result["elapsed"] = round(mon.elapsed, 3)
+            step_result["peak_mb"] = round(mon.peak_mb, 1)
+            report["steps_details"].append(step_result)
+
+        def load(step_result):
+            if isinstance(data_input, (list, tuple)):
+                parts = [self.load_data(path) for _, path in data_input]
+                adata = ad.concat(parts, join="inner", label=BATCH_KEY,
+                                  keys=[name for name, _ in data_input], index_unique="-")
+            else:
+                adata = self.load_data(data_input)
+            adata.uns.pop(PREFETCH_MARK, None)
+            state["adata"] = adata
+            report["qc_metrics"]["raw_cells"] = adata.n_obs
+            report["qc_metrics"]["raw_genes"] = adata.n_vars
+            return f"读取 {adata.n_obs} 细胞 × {adata.n_vars} 基因"
+
+        def qc(step_result):
+            adata = state["adata"]
+            min_genes = int(params.get('min_genes', 200))
+            max_mt = float(params.get('max_mt', 20))
+            filtered = None
+            if self.fused and fused_available(adata) and not self._looks_lognormalized(adata):
+                # QC 过滤与 LogNormalize 一次扫描完成
+                filtered = self._run_fused(adata, min_genes=min_genes, max_mt=max_mt,
+                                           target_sum=reference.meta["target_sum"])
+            if filtered is not None:
+                step_result["fused"] = True
+                adata = filtered
+                state["normalized"] = True
+            else:
+                self._annotate_qc(adata)
+                sc.pp.filter_cells(adata, min_genes=min_genes)
+                adata = adata[adata.obs.pct_counts_mt < max_mt, :].copy()
+            state["adata"] = adata
+            report["qc_metrics"]["filtered_cells"] = adata.n_obs
+            return f"剩余 {adata.n_obs} 细胞"
+
+        def normalize(step_result):
+            adata = state["adata"]
+            if state.get("normalized"):
+                step_result["fused"] = True
+                return "LogNormalize 完成 (与参考一致)"
+            if self._looks_lognormalized(adata):
+                step_result["variant"] = "skip"
+                return "输入已是 log-normalized 数据，跳过"
+            sc.pp.normalize_total(adata, target_sum=reference.meta["target_sum"])
+            sc.pp.log1p(adata)
+            return "LogNormalize 完成 (与参考一致)"
+
+        def project(step_result):
+            adata = state["adata"]
+            pcs, overlap = reference.project(adata)
+            adata.obsm["X_pca"] = pcs.astype(np.float32)
+            report["qc_metrics"]["gene_overlap"] = round(overlap, 4)
+            if overlap < 0.5:
+                step_result["details"] = f"⚠️ 参考 HVG 中只有 {overlap:.0%} 在新数据中出现，映射结果可能不可靠"
+            return f"投影到参考 PCA 空间 ({pcs.shape[1]} PCs，HVG 覆盖 {overlap:.0%})"
+
+        def transfer(step_result):
+            adata = state["adata"]
+            k = int(params.get('n_neighbors', 15))
+            result = reference.transfer(adata.obsm["X_pca"], k=k)
+            categories = reference.meta["categories"]
+            adata.obs["leiden"] = pd.Categorical.from_codes(result["labels"], categories=categories)
+            adata.obs["mapping_confidence"] = result["confidence"].astype(np.float32)
+            if "umap" in result:
+                adata.obsm["X_umap"] = result["umap"]
+                step_result["embedding"] = self._export_embedding(adata, "umap")
+                if str(params.get('render_png', 'true')).lower() != 'false':
+                    step_result["plot"] = self._plot_mapping(reference, result["umap"], result["labels"])
+                    report["final_plot"] = step_result["plot"]
+
+            confidence = result["confidence"]
+            composition = (adata.obs.groupby("leiden", observed=False)["mapping_confidence"]
+                           .agg(["size", "mean"]).reset_index())
+            composition.columns = ["cluster", "n_cells", "mean_confidence"]
+            composition["fraction"] = (composition["n_cells"] / max(adata.n_obs, 1)).round(4)
+            composition["mean_confidence"] = composition["mean_confidence"].fillna(0).round(3)
+            step_result["details"] = composition.to_html(classes="table table-sm", index=False)
+            report["mapping"] = {
+                "reference_run": params.get("reference_run"),
+                "n_cells": int(adata.n_obs),
+                "k": k,
+                "index": reference.meta["index"],
+                "mean_confidence": round(float(confidence.mean()), 4) if len(confidence) else 0.0,
+                "low_confidence_fraction": round(float((confidence < 0.5).mean()), 4) if len(confidence) else 0.0,
+                "composition": {row.cluster: int(row.n_cells) for row in composition.itertuples()},
+            }
+            return f"kNN (k={k}) 迁移 {len(categories)} 个簇的标签与 UMAP 位置"
+
+        try:
+            print(f"📂 Mapping {data_input} onto reference")
+            run_step("load_data", load)
+            run_step("local_qc", qc)
+            run_step("local_normalize", normalize)
+            run_step("local_project", project)
+            run_step("local_map_reference", transfer)
+
+            mapping = report["mapping"]
+            report["diagnosis"] = f"""
+            ### ✅ 参考映射完成
+            - **参考 run**: {mapping['reference_run']}
+            - **映射细胞**: {mapping['n_cells']} (原始 {report['qc_metrics'].get('raw_cells', 0)})
+            - **平均置信度**: {mapping['mean_confidence']:.2f}，低置信度 (<0.5) 细胞占比 {mapping['low_confidence_fraction']:.1%}
+            - **HVG 覆盖率**: {report['qc_metrics'].get('gene_overlap', 0):.0%}
+            """
+            if self.run_dir:
+                try:
+                    with span("persist_run_state"):
+                        persist_run_state(self.run_dir, state["adata"])
+                    report["state_url"] = self.run_url
+                except Exception as e:
+                    print(f"⚠️ 保存分析状态失败: {e}")
+            report["status"] = "success"
+            return report
+
+        except guard.Interrupted as e:
+            return self._interrupted_report(report, e, guard)
+
+        except Exception as e:
+            print(f"❌ Mapping Error: {e}")
+            import traceback
+            traceback.print_exc()
+            report["status"] = "failed"
+            report["error"] = str(e)
+            return report
@@ -0,0 +1,163 @@
+import json
+import time
+import uuid
+from typing import Optional, List, Dict
+
+import redis.asyncio as aioredis
+from redis.exceptions import WatchError
+
+from .context_builder import ContextBuilder
+
+_KEY_PREFIX = "chat:session:"
+_INDEX_KEY = "chat:sessions"  # ZSET: session_id -> 最近访问时间，用于总量上限淘汰
+
+
+class SessionStore:
+    """
+    服务端对话会话 (Redis)
+    客户端只需发送 session_id + 新消息，历史、已挂载数据集和 token 计数都保存在服务端：
+    {
+        "id": ..., "created": ..., "updated": ...,
+        "summary": "更早轮次的滚动摘要",
+        "turns": [{"role": "user", "content": "...", "tokens": 12}, ...],
+        "files": [{"id": "...", "name": "..."}],
+        "history_tokens": 123
+    }
+    - 每个会话按 TTL 过期 (每次访问续期)
+    - 单会话超过 token/字节上限时，最早的轮次折叠进摘要
+    - 会话总数超过上限时，淘汰最久未访问的会话
+    """
+
+    def __init__(self, redis_url: str, builder: ContextBuilder, ttl: int = 86400,
+                 max_history_tokens: int = 6000, max_bytes: int = 64 * 1024, max_sessions: int = 10000):
+        self.redis = aioredis.from_url(redis_url, decode_responses=True)
+        self.builder = builder
+        self.ttl = ttl
+        self.max_history_tokens = max_history_tokens
+        self.max_bytes = max_bytes
+        self.max_sessions = max_sessions
+
+    def _key(self, session_id: str) -> str:
+        return f"{_KEY_PREFIX}{session_id}"
+
+    async def create(self, files: Optional[List[Dict]] = None) -> dict:
+        now = time.time()
+        session = {"id": uuid.uuid4().hex, "created": now, "updated": now, "summary": "",
+                   "turns": [], "files": [], "history_tokens": 0}
+        self.attach_files(session, files)
+        await self.save(session)
+        await self._enforce_cap()
+        return session
+
+    async def load(self, session_id: str) -> Optional[dict]:
+        raw = await self.redis.get(self._key(session_id))
+        if raw is None:
+            return None
+        return json.loads(raw)
+
+    async def save(self, session: dict):
+        pipe = self.redis.pipeline()
+        self._queue_write(pipe, session)
+        await pipe.execute()
+
+    def _queue_write(self, pipe, session: dict):
+        session["updated"] = time.time()
+        payload = json.dumps(session, ensure_ascii=False, separators=(",", ":"))
+        pipe.set(self._key(session["id"]), payload, ex=self.ttl)
+        pipe.zadd(_INDEX_KEY, {session["id"]: session["updated"]})
+
+    async def _update(self, session_id: str, mutate) -> Optional[dict]:
+        """
+        读-改-写一个会话 (WATCH/MULTI 乐观锁)：读取之后有其他写入时事务失败，重新读取后再应用 mutate，
+        同一会话并发的多个流不会互相覆盖；会话不存在时返回 None
+        """
+        key = self._key(session_id)
+        async with self.redis.pipeline(transaction=True) as pipe:
+            while True:
+                try:
+                    await pipe.watch(key)
+                    raw = await pipe.get(key)
+                    if raw is None:
+                        return None
+                    session = json.loads(raw)
+                    mutate(session)
+                    pipe.multi()
+                    self._queue_write(pipe, session)
+                    await pipe.execute()
+                    return session
+                except WatchError:
+                    continue
+
+    async def delete(self, session_id: str):
+        pipe = self.redis.pipeline()
+        pipe.delete(self._key(session_id))
+        pipe.zrem(_INDEX_KEY, session_id)
+        await pipe.execute()
+
+    def attach_files(self, session: dict, files: Optional[List[Dict]]):
+        """按 id 去重合并数据集引用"""
+        known = {f["id"] for f in session["files"]}
+        for f in files or []:
+            if f.get("id") and f["id"] not in known:
+                session["files"].append({"id": f["id"], "name": f.get("name", f["id"])})
+                known.add(f["id"])
+
+    async def attach(self, session_id: str, files: Optional[List[Dict]]) -> Optional[dict]:
+        """把数据集挂载到已保存的会话上，返回更新后的会话"""
+        return await self._update(session_id, lambda session: self.attach_files(session, files))
+
+    async def append_turn(self, session_id: str, user_text: str, assistant_text: str):
+        """对话完成后写回一轮 (乐观锁读-改-写，不会覆盖并发写入的轮次与文件挂载)"""
+        turns = [self.builder.compact_turn(role, text)
+                 for role, text in (("user", user_text), ("assistant", assistant_text)) if text]
+
+        def add_turns(session):
+            for turn in turns:
+                session["turns"].append(turn)
+                session["history_tokens"] += turn["tokens"]
+            self._compact(session)
+
+        await self._update(session_id, add_turns)
+
+    def _compact(self, session: dict):
+        # 超出上限时把最早的轮次折叠进滚动摘要 (至少保留最近一轮问答)
+        while len(session["turns"]) > 2 and (
+            session["history_tokens"] > self.max_history_tokens
+            or len(json.dumps(session, ensure_ascii=False)) > self.max_bytes
+        ):
+            oldest = session["turns"].pop(0)
+            session["history_tokens"] -= oldest.get("tokens", 0)
+            session["summary"] = self.builder.extend_summary(session["summary"], oldest)
+
+    async def _enforce_cap(self):
+        # 清理已过期会话的索引，并淘汰超出总量上限的最旧会话
+        await self.redis.zremrangebyscore(_INDEX_KEY, 0, time.time() - self.ttl)
+        overflow = await self.redis.zcard(_INDEX_KEY) - self.max_sessions
+        if overflow > 0:
+            stale = await self.redis.zrange(_INDEX_KEY, 0, overflow - 1)
+            if stale:
+                pipe = self.redis.pipeline()
+                pipe.delete(*[self._key(sid) for sid in stale])
+                pipe.zrem(_INDEX_KEY, *stale)
+                await pipe.execute()
+
+    @staticmethod
+    def public_view(session: dict) -> dict:
+        """返回给前端的会话概要 (不含完整历史)"""
+        return {
+            "session_id": session["id"],
+            "files": session["files"],
+            "turns": len(session["turns"]),
+            "history_tokens": session["history_tokens"],
+            "has_summary": bool(session["summary"]),
+            "updated": session["updated"],
+        }
+
+
+async def recording_stream(stream, store: SessionStore, session_id: str, user_text: str):
+    """透传流式输出，完整结束后把回答写回会话 (客户端中途断开时不写回半截回答)"""
+    parts = []
+    async for chunk in stream:
+        parts.append(chunk)
+        yield chunk
+    await store.append_turn(session_id, user_text, "".join(parts))
@@ -2,6 +2,7 @@ import os
 import importlib.util
 import glob
 import sys
+from . import tracing
 
 class SkillManager:
     def __init__(self, skills_dir="skills"):
@@ -33,6 +34,10 @@ class SkillManager:
         if self.skills_dir not in sys.path:
             sys.path.append(self.skills_dir)
 
+        # 技能以顶层模块名导入 scrna_analysis，其中 `from tracing import span` 会再导入一份未配置、ContextVar 独立的
+        # tracing，流水线 span 全部变成空操作；让顶层名指向同一个模块，步骤 span 才能挂到 Worker 的根 span 下
+        sys.modules["tracing"] = tracing
+
         for file_path in glob.glob(os.path.join(self.skills_dir, "*.py")):
             module_name = os.path.basename(file_path)[:-3]
             if module_name == "__init__":
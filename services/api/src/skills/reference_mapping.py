@@ -0,0 +1,46 @@
+import sys
+import os
+
+# 修复导入路径
+current_dir = os.path.dirname(os.path.abspath(__file__))
+src_dir = os.path.dirname(current_dir)
+if src_dir not in sys.path:
+    sys.path.append(src_dir)
+
+try:
+    from scrna_analysis import LocalSingleCellPipeline
+    from reference_index import ReferenceCache
+except ImportError:
+    # Docker 环境下的备用导入
+    from src.scrna_analysis import LocalSingleCellPipeline
+    from src.reference_index import ReferenceCache
+
+META = {
+    "id": "reference_mapping",
+    "name": "Reference Mapping (kNN)",
+    "description": "Project a new dataset onto a finished run and transfer clusters / UMAP positions",
+    "template": {
+        "name": "Map to Reference",
+        "steps": [
+            {"name": "Map to Reference", "tool_id": "local_map_reference",
+             "params": {"reference_run": "", "n_neighbors": "15", "min_genes": "200", "max_mt": "20"}}
+        ]
+    }
+}
+
+# 同一 Worker 进程连续映射到同一参考时复用已加载的索引
+_references = ReferenceCache()
+
+
+def execute(file_path, params, output_dir, run_dir=None, run_url=None, cache_dir=None,
+            guard=None, on_progress=None, sample_workers=4, fused=True):
+    """params 需包含 reference_dir (参考 run 的目录，由调用方校验 reference_run 后填入)"""
+    print(f"🚀 [Reference Mapping] Mapping {file_path} onto {params.get('reference_run')}")
+
+    results_dir = os.path.join(output_dir, "results")
+    os.makedirs(results_dir, exist_ok=True)
+
+    reference = _references.get(params["reference_dir"])
+    pipeline = LocalSingleCellPipeline(output_dir=results_dir, run_dir=run_dir, run_url=run_url, cache_dir=cache_dir,
+                                       fused=fused)
+    return pipeline.map_to_reference(file_path, reference, params, guard=guard, on_progress=on_progress)
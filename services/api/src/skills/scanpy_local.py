@@ -1,5 +1,6 @@
 import sys
 import os
+import copy
 
 # 修复导入路径
 current_dir = os.path.dirname(os.path.abspath(__file__))
@@ -24,27 +25,30 @@ META = {
             {"name": "Normalization", "tool_id": "local_normalize", "params": {}},
             {"name": "Find Variable Genes", "tool_id": "local_hvg", "params": {}},
             {"name": "Scale Data", "tool_id": "local_scale", "params": {}},
-            {"name": "PCA", "tool_id": "local_pca", "params": {}},
-            {"name": "Compute Neighbors", "tool_id": "local_neighbors", "params": {}},
+            {"name": "PCA", "tool_id": "local_pca", "params": {"svd_solver": "arpack", "n_comps": "50"}},
+            {"name": "Compute Neighbors", "tool_id": "local_neighbors", "params": {"n_pcs": "40", "n_neighbors": "10"}},
             {"name": "Clustering", "tool_id": "local_cluster", "params": {"resolution": "0.5"}},
-            {"name": "UMAP Visualization", "tool_id": "local_umap", "params": {}},
-            {"name": "t-SNE Visualization", "tool_id": "local_tsne", "params": {}},
+            {"name": "UMAP Visualization", "tool_id": "local_umap", "params": {"render_png": "true"}},
+            {"name": "t-SNE Visualization", "tool_id": "local_tsne", "params": {"render_png": "true", "tsne_mode": "auto", "tsne_sketch_size": "20000"}},
             {"name": "Find Markers", "tool_id": "local_markers", "params": {}}
         ]
     }
 }
 
-def execute(file_path, params, output_dir):
+def execute(file_path, params, output_dir, run_dir=None, run_url=None, cache_dir=None,
+            guard=None, on_progress=None, sample_workers=4, fused=True):
+    """file_path: 单个数据集路径，或多样本模式下的 [(样本名, 路径), ...]"""
     print(f"🚀 [Scanpy Skill] Starting analysis on: {file_path}")
     
     # 确保结果目录存在
     results_dir = os.path.join(output_dir, "results")
     os.makedirs(results_dir, exist_ok=True)
     
-    pipeline = LocalSingleCellPipeline(output_dir=results_dir)
+    pipeline = LocalSingleCellPipeline(output_dir=results_dir, run_dir=run_dir, run_url=run_url, cache_dir=cache_dir,
+                                       sample_workers=sample_workers, fused=fused)
     
-    # 使用 META 中的模板作为基准
-    steps_config = META['template']['steps']
+    # 使用 META 中的模板作为基准 (深拷贝：上一次任务注入的参数不能残留到下一次)
+    steps_config = copy.deepcopy(META['template']['steps'])
     
     # 注入用户参数
     for step in steps_config:
@@ -53,4 +57,9 @@ def execute(file_path, params, output_dir):
             if key in params:
                 step['params'][key] = params[key]
 
-    return pipeline.run_pipeline(file_path, steps_config)
+    return pipeline.run_pipeline(file_path, steps_config, guard=guard, on_progress=on_progress)
+
+def prefetch(file_path, output_dir, cache_dir, should_stop=None, max_cache_bytes=None):
+    """预热：只解析数据并计算 QC 指标，写入 checkpoint (不出图、不产生 run 产物)"""
+    pipeline = LocalSingleCellPipeline(output_dir=os.path.join(output_dir, "results"), cache_dir=cache_dir)
+    return pipeline.prefetch(file_path, should_stop=should_stop, max_cache_bytes=max_cache_bytes)
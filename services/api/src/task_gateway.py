@@ -0,0 +1,213 @@
+import os
+import time
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+from typing import List, Dict, Any
+
+from .config import settings
+from .celery_app import (celery_app, run_bioinformatics_task, prefetch_dataset,
+                         PREFETCH_QUEUE, PREFETCH_TASK_KEY, PREFETCH_CANCEL_KEY, RUN_CANCEL_KEY)
+from .result_store import result_store
+from .datasets import resolve_input, dataset_key, checkpoint_path
+from .tracing import inject
+
+# Celery 的 broker / result backend 客户端都是同步的。
+# 所有 Redis 往返都放进一个有界线程池执行，避免阻塞同时承载流式对话的事件循环；
+# 线程池大小与 Redis 连接池上限对齐 (见 celery_app 的 broker_pool_limit / redis_max_connections)。
+_executor = ThreadPoolExecutor(max_workers=settings.TASK_IO_THREADS, thread_name_prefix="celery-io")
+
+
+async def _run_io(fn, *args, **kwargs):
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(_executor, lambda: fn(*args, **kwargs))
+
+
+def _prefetch_key(files: list):
+    data_input = resolve_input(files, settings.UPLOAD_DIR)
+    if not data_input or not os.path.exists(data_input):
+        return None
+    return dataset_key(data_input)
+
+
+def _schedule_prefetch(files: list):
+    key = _prefetch_key(files)
+    if key is None or os.path.exists(checkpoint_path(settings.PREFETCH_CACHE_DIR, key)):
+        return None
+    client = celery_app.backend.client
+    # 同一数据集只投递一次 (多轮对话会反复携带同一批文件)
+    if not client.set(PREFETCH_TASK_KEY + key, "pending", nx=True, ex=settings.PREFETCH_TTL):
+        return None
+    client.delete(PREFETCH_CANCEL_KEY + key)
+    # 过期未执行的预热消息直接丢弃 (用户早已离开或已经跑完正式任务)
+    task = prefetch_dataset.apply_async(kwargs={"files": files}, queue=PREFETCH_QUEUE,
+                                        expires=settings.PREFETCH_TTL)
+    client.set(PREFETCH_TASK_KEY + key, task.id, ex=settings.PREFETCH_TTL)
+    return task.id
+
+
+def _cancel_prefetch(files: list):
+    key = _prefetch_key(files)
+    if key is None:
+        return
+    client = celery_app.backend.client
+    task_id = client.get(PREFETCH_TASK_KEY + key)
+    # 运行中的预热在下一个阶段边界看到标记后退出；还没开始的直接撤销
+    client.set(PREFETCH_CANCEL_KEY + key, "1", ex=settings.PREFETCH_TTL)
+    if task_id and task_id != b"pending":
+        celery_app.control.revoke(task_id.decode())
+
+
+async def schedule_prefetch(files: list):
+    """挂载文件后投机预热数据集；失败不影响对话"""
+    if not settings.PREFETCH_ENABLED or not files:
+        return None
+    try:
+        return await _run_io(_schedule_prefetch, files)
+    except Exception as e:
+        print(f"⚠️ 预热投递失败: {e}")
+        return None
+
+
+async def cancel_prefetch(files: list):
+    if not settings.PREFETCH_ENABLED or not files:
+        return
+    try:
+        await _run_io(_cancel_prefetch, files)
+    except Exception as e:
+        print(f"⚠️ 取消预热失败: {e}")
+
+
+async def submit_workflow(workflow_data: dict, files: list) -> str:
+    """异步投递工作流任务，返回 run_id"""
+    # traceparent 与入队时间随消息头传给 Worker (Worker 据此补出排队 span)；
+    # 线程池里拿不到当前协程的追踪上下文，必须在这里先取出
+    headers = inject({"enqueued_ns": time.time_ns()})
+    task = await _run_io(run_bioinformatics_task.apply_async,
+                         kwargs={"workflow_data": workflow_data, "files": files}, headers=headers)
+    return task.id
+
+
+def _cancel_run(run_id: str) -> Dict[str, Any]:
+    meta = celery_app.backend.get_task_meta(run_id)
+    state = meta.get("status", "PENDING")
+    if state in ("SUCCESS", "FAILURE", "REVOKED"):
+        return {"run_id": run_id, "status": "finished", "state": state}
+    # 运行中的任务在下一个检查点 (最长约 1 秒) 退出并返回部分结果；
+    # 排队中的任务直接撤销，Worker 取到后丢弃，不占用执行槽
+    celery_app.backend.client.set(RUN_CANCEL_KEY + run_id, "1",
+                                  ex=int(settings.WORKFLOW_MAX_RUNTIME or 86400) + 3600)
+    if state == "PENDING":
+        celery_app.control.revoke(run_id)
+    return {"run_id": run_id, "status": "cancelling", "state": state}
+
+
+async def cancel_run(run_id: str) -> Dict[str, Any]:
+    """请求取消工作流"""
+    return await _run_io(_cancel_run, run_id)
+
+
+def build_status(state: str, result: Any) -> Dict[str, Any]:
+    """把 Celery 任务状态转换成前端进度条需要的结构"""
+    response = {
+        "status": "running",
+        "completed": False,
+        "steps_status": [],
+        "error": None
+    }
+
+    if state == 'PENDING':
+        response["status"] = "running"
+
+    elif state == 'SUCCESS':
+        response["status"] = "success"
+        response["completed"] = True
+
+        result_data = result
+        if isinstance(result_data, dict) and result_data.get("status") in ("cancelled", "timeout", "failed"):
+            # 任务本身正常返回，但流程被取消 / 超时 / 出错 (cancelled / timeout 附带部分结果)
+            response["status"] = result_data["status"]
+            response["error"] = result_data.get("error")
+            response["partial"] = bool(result_data.get("partial"))
+        if isinstance(result_data, dict) and result_data.get("started_at"):
+            response["started_at"] = result_data["started_at"]
+            response["finished_at"] = result_data.get("finished_at")
+        if result_data:
+            # 🔥🔥🔥 核心修复：将 Worker 的结果（包含图片路径）透传给前端
+            # (大结果已卸载到结果存储，这里只有 manifest，完整报告走 /api/workflow/result)
+            response["report_data"] = result_data
+
+            # 兼容进度条显示
+            if "steps_details" in result_data:
+                response["steps_status"] = result_data["steps_details"]
+            elif "steps" in result_data:
+                response["steps_status"] = result_data["steps"]
+
+    elif state == 'REVOKED':
+        # 排队阶段被取消，没有任何结果
+        response["status"] = "cancelled"
+        response["completed"] = True
+
+    elif state == 'FAILURE':
+        response["status"] = "failed"
+        response["completed"] = True
+        response["error"] = str(result)
+
+    elif state == 'PROGRESS':
+        info = result
+        if isinstance(info, dict):
+            response["steps_status"] = info.get("steps", [])
+            response["started_at"] = info.get("started_at")
+
+    return response
+
+
+def _fetch_status(run_id: str) -> Dict[str, Any]:
+    # 只读一次 meta，避免 AsyncResult.state / .result 各触发一次 Redis 往返
+    meta = celery_app.backend.get_task_meta(run_id)
+    return build_status(meta.get("status", "PENDING"), meta.get("result"))
+
+
+def _fetch_statuses(run_ids: List[str]) -> Dict[str, Dict[str, Any]]:
+    backend = celery_app.backend
+    if not hasattr(backend, "mget"):
+        return {run_id: _fetch_status(run_id) for run_id in run_ids}
+
+    # Redis 结果后端：一次 MGET 取回所有任务的 meta
+    keys = [backend.get_key_for_task(run_id) for run_id in run_ids]
+    statuses = {}
+    for run_id, raw in zip(run_ids, backend.mget(keys)):
+        if raw is None:
+            statuses[run_id] = build_status("PENDING", None)
+            continue
+        meta = backend.decode_result(raw)
+        statuses[run_id] = build_status(meta.get("status", "PENDING"), meta.get("result"))
+    return statuses
+
+
+async def fetch_status(run_id: str) -> Dict[str, Any]:
+    return await _run_io(_fetch_status, run_id)
+
+
+async def fetch_statuses(run_ids: List[str]) -> Dict[str, Dict[str, Any]]:
+    """批量查询：N 个 run_id 只产生一次 Redis 往返"""
+    # 去重但保持顺序
+    unique = list(dict.fromkeys(run_ids))
+    if not unique:
+        return {}
+    return await _run_io(_fetch_statuses, unique)
+
+
+def _load_report(run_id: str):
+    meta = celery_app.backend.get_task_meta(run_id)
+    if meta.get("status") != "SUCCESS":
+        return None, None
+    manifest = meta.get("result") or {}
+    if not manifest.get("report_ref"):
+        # 旧格式 / 未卸载的结果：本身就是完整报告
+        return manifest, None
+    return result_store.load_report(run_id, manifest)
+
+
+async def load_report(run_id: str):
+    """读取完整报告，返回 (report, digest)；任务未完成时 report 为 None"""
+    return await _run_io(_load_report, run_id)
@@ -0,0 +1,371 @@
+import os
+import json
+import time
+import uuid
+import threading
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+# 端到端链路追踪 (无第三方依赖)
+#
+# - trace id 在 API 入口 (chat_endpoint) 生成，以 W3C traceparent 格式透传：
+#     API → Celery 消息头 → Worker 任务 → run_pipeline 各步骤 → vLLM 请求头
+# - span 以 OTLP/JSON 格式逐行写入 {TRACE_DIR}/{trace_id}.jsonl (每行一个 ExportTraceServiceRequest，
+#   与 OpenTelemetry Collector 的 file exporter / otlpjsonfile receiver 兼容)，API 与 Worker 追加写同一文件
+# - {TRACE_DIR}/runs/{run_id} 记录 run 对应的 trace id，可按 run_id 查询
+# - 当前 span 保存在 ContextVar 里：没有活动 trace 时 (离线基准、单元调用) span() 为空操作
+
+_TRACEPARENT_VERSION = "00"
+_current: ContextVar = ContextVar("gibh_trace_span", default=None)
+
+# OTLP SpanKind / StatusCode
+KIND_INTERNAL, KIND_SERVER, KIND_CLIENT, KIND_PRODUCER, KIND_CONSUMER = 1, 2, 3, 4, 5
+_STATUS_OK, _STATUS_ERROR = 1, 2
+
+
+def parse_traceparent(value):
+    """'00-{trace_id}-{span_id}-{flags}' -> (trace_id, span_id)；格式不对时返回 None"""
+    parts = (value or "").strip().split("-")
+    if len(parts) != 4 or len(parts[1]) != 32 or len(parts[2]) != 16:
+        return None
+    try:
+        int(parts[1], 16), int(parts[2], 16)
+    except ValueError:
+        return None
+    return parts[1], parts[2]
+
+
+def _otlp_value(value):
+    if isinstance(value, bool):
+        return {"boolValue": value}
+    if isinstance(value, int):
+        return {"intValue": str(value)}
+    if isinstance(value, float):
+        return {"doubleValue": value}
+    return {"stringValue": str(value)}
+
+
+def _otlp_attributes(attrs: dict) -> list:
+    return [{"key": k, "value": _otlp_value(v)} for k, v in attrs.items() if v is not None]
+
+
+def _plain_value(value: dict):
+    if "intValue" in value:
+        return int(value["intValue"])
+    return next(iter(value.values()), None)
+
+
+class Span:
+    recording = True
+
+    def __init__(self, tracer, name, trace_id, parent_id=None, attributes=None, kind=KIND_INTERNAL, start_ns=None):
+        self.tracer = tracer
+        self.name = name
+        self.trace_id = trace_id
+        self.span_id = uuid.uuid4().hex[:16]
+        self.parent_id = parent_id
+        self.kind = kind
+        self.attributes = dict(attributes or {})
+        self.events = []
+        self.status = (_STATUS_OK, "")
+        self.start_ns = start_ns or time.time_ns()
+        self.end_ns = None
+
+    @property
+    def traceparent(self) -> str:
+        return f"{_TRACEPARENT_VERSION}-{self.trace_id}-{self.span_id}-01"
+
+    def set_attribute(self, key, value):
+        self.attributes[key] = value
+
+    def set_attributes(self, attrs: dict):
+        self.attributes.update(attrs)
+
+    def add_event(self, name, attributes=None):
+        self.events.append((time.time_ns(), name, attributes or {}))
+
+    def record_exception(self, e: BaseException):
+        self.add_event("exception", {"exception.type": type(e).__name__, "exception.message": str(e)})
+        self.status = (_STATUS_ERROR, str(e))
+
+    def end(self, end_ns=None):
+        if self.end_ns is None:
+            self.end_ns = end_ns or time.time_ns()
+            self.tracer.export(self)
+
+    def to_otlp(self) -> dict:
+        span = {
+            "traceId": self.trace_id,
+            "spanId": self.span_id,
+            "name": self.name,
+            "kind": self.kind,
+            "startTimeUnixNano": str(self.start_ns),
+            "endTimeUnixNano": str(self.end_ns),
+            "attributes": _otlp_attributes(self.attributes),
+            "status": {"code": self.status[0], "message": self.status[1]},
+        }
+        if self.parent_id:
+            span["parentSpanId"] = self.parent_id
+        if self.events:
+            span["events"] = [{"timeUnixNano": str(t), "name": n, "attributes": _otlp_attributes(a)}
+                              for t, n, a in self.events]
+        return span
+
+
+class _NoopSpan:
+    """没有活动 trace 时的占位 span：接口与 Span 相同，不记录任何内容"""
+    recording = False
+    trace_id = None
+    span_id = None
+    traceparent = None
+
+    def set_attribute(self, key, value):
+        pass
+
+    def set_attributes(self, attrs):
+        pass
+
+    def add_event(self, name, attributes=None):
+        pass
+
+    def record_exception(self, e):
+        pass
+
+    def end(self, end_ns=None):
+        pass
+
+
+NOOP_SPAN = _NoopSpan()
+
+
+class Tracer:
+    def __init__(self):
+        self.directory = None
+        self.service = "gibh-agent"
+        self.retention = 7 * 86400
+        self._lock = threading.Lock()
+        self._exports = 0
+
+    def configure(self, directory, service: str, retention_seconds: float = 7 * 86400, enabled: bool = True):
+        """directory 为 None 或 enabled=False 时关闭追踪 (所有 span 变成空操作)"""
+        self.directory = directory if enabled else None
+        self.service = service
+        self.retention = retention_seconds
+        if self.directory:
+            os.makedirs(os.path.join(self.directory, "runs"), exist_ok=True)
+
+    @property
+    def enabled(self) -> bool:
+        return self.directory is not None
+
+    # ---------- 创建 span ----------
+    def start_span(self, name, attributes=None, *, parent=None, traceparent=None, root=False,
+                   kind=KIND_INTERNAL, start_ns=None):
+        """
+        父 span 的确定顺序：显式 parent → traceparent 字符串 → 当前上下文；
+        都没有时 root=True 开启新 trace，否则返回空操作 span
+        """
+        if not self.enabled:
+            return NOOP_SPAN
+        if parent is None and traceparent:
+            parsed = parse_traceparent(traceparent)
+            if parsed:
+                return Span(self, name, parsed[0], parsed[1], attributes, kind, start_ns)
+        if parent is None:
+            parent = _current.get()
+        if parent is not None and parent.recording:
+            return Span(self, name, parent.trace_id, parent.span_id, attributes, kind, start_ns)
+        if root:
+            return Span(self, name, uuid.uuid4().hex, None, attributes, kind, start_ns)
+        return NOOP_SPAN
+
+    @contextmanager
+    def span(self, name, attributes=None, **kwargs):
+        """with tracer.span("step.local_pca") as s: ...  异常会记录到 span 上并继续抛出"""
+        s = self.start_span(name, attributes, **kwargs)
+        token = _current.set(s) if s.recording else None
+        try:
+            yield s
+        except BaseException as e:
+            s.record_exception(e)
+            raise
+        finally:
+            if token is not None:
+                _current.reset(token)
+            s.end()
+
+    @contextmanager
+    def use_span(self, s):
+        """把已有 span 设为当前上下文 (不负责结束)"""
+        token = _current.set(s) if s.recording else None
+        try:
+            yield s
+        finally:
+            if token is not None:
+                _current.reset(token)
+
+    # ---------- 写出 ----------
+    def _trace_path(self, trace_id: str) -> str:
+        return os.path.join(self.directory, f"{trace_id}.jsonl")
+
+    def export(self, span: Span):
+        if not self.enabled:
+            return
+        record = {"resourceSpans": [{
+            "resource": {"attributes": _otlp_attributes({"service.name": self.service})},
+            "scopeSpans": [{"scope": {"name": "gibh"}, "spans": [span.to_otlp()]}],
+        }]}
+        line = json.dumps(record, ensure_ascii=False, default=str) + "\n"
+        try:
+            # O_APPEND + 单次 write：API 与 Worker 进程并发追加同一文件时行不会交错
+            fd = os.open(self._trace_path(span.trace_id), os.O_WRONLY | os.O_CREAT | os.O_APPEND, 0o644)
+            try:
+                os.write(fd, line.encode("utf-8"))
+            finally:
+                os.close(fd)
+        except OSError as e:
+            print(f"⚠️ 写入 trace 失败: {e}")
+            return
+        with self._lock:
+            self._exports += 1
+            due = self._exports % 1000 == 0
+        if due:
+            self.prune()
+
+    def link_run(self, run_id: str, trace_id: str):
+        if not self.enabled or not trace_id:
+            return
+        try:
+            with open(os.path.join(self.directory, "runs", run_id), "w", encoding="utf-8") as f:
+                f.write(trace_id)
+        except OSError as e:
+            print(f"⚠️ 记录 run trace 失败: {e}")
+
+    def prune(self):
+        """删除超过保留期的 trace 文件与 run 索引"""
+        if not self.enabled:
+            return
+        cutoff = time.time() - self.retention
+        for folder in (self.directory, os.path.join(self.directory, "runs")):
+            try:
+                entries = list(os.scandir(folder))
+            except OSError:
+                continue
+            for entry in entries:
+                try:
+                    if entry.is_file() and entry.stat().st_mtime < cutoff:
+                        os.remove(entry.path)
+                except OSError:
+                    pass
+
+    # ---------- 查询 ----------
+    def trace_for_run(self, run_id: str):
+        if not self.enabled:
+            return None
+        try:
+            with open(os.path.join(self.directory, "runs", run_id), encoding="utf-8") as f:
+                return f.read().strip() or None
+        except OSError:
+            return None
+
+    def load_trace(self, trace_id: str):
+        """读取一个 trace 的全部 span (按开始时间排序的扁平结构)；不存在时返回 None"""
+        if not self.enabled or parse_traceparent(f"00-{trace_id}-{'0' * 16}-01") is None:
+            return None
+        path = self._trace_path(trace_id)
+        if not os.path.exists(path):
+            return None
+        spans = []
+        with open(path, encoding="utf-8") as f:
+            for line in f:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    continue
+                for rs in record.get("resourceSpans", []):
+                    service = next((_plain_value(a["value"]) for a in rs.get("resource", {}).get("attributes", [])
+                                    if a["key"] == "service.name"), None)
+                    for ss in rs.get("scopeSpans", []):
+                        for s in ss.get("spans", []):
+                            start, end = int(s["startTimeUnixNano"]), int(s["endTimeUnixNano"])
+                            spans.append({
+                                "name": s["name"],
+                                "span_id": s["spanId"],
+                                "parent_id": s.get("parentSpanId"),
+                                "service": service,
+                                "start": start / 1e9,
+                                "duration_ms": round((end - start) / 1e6, 3),
+                                "attributes": {a["key"]: _plain_value(a["value"]) for a in s.get("attributes", [])},
+                                "status": "error" if s.get("status", {}).get("code") == _STATUS_ERROR else "ok",
+                                "error": s.get("status", {}).get("message") or None,
+                                "events": [{"name": e["name"], "time": int(e["timeUnixNano"]) / 1e9,
+                                            "attributes": {a["key"]: _plain_value(a["value"]) for a in e.get("attributes", [])}}
+                                           for e in s.get("events", [])],
+                            })
+        spans.sort(key=lambda s: s["start"])
+        return spans
+
+
+tracer = Tracer()
+
+
+def span(name, attributes=None, **kwargs):
+    return tracer.span(name, attributes, **kwargs)
+
+
+def current_span():
+    return _current.get() or NOOP_SPAN
+
+
+def inject(headers: dict = None) -> dict:
+    """把当前 span 写成 traceparent 头 (没有活动 trace 时原样返回)"""
+    headers = dict(headers or {})
+    s = current_span()
+    if s.recording:
+        headers["traceparent"] = s.traceparent
+    return headers
+
+
+async def traced_stream(stream, root):
+    """
+    包装流式对话：记录 llm.ttft (开始迭代 → 首个 chunk) 与 llm.generate (首个 chunk → 结束) 两个 span，
+    结束 (含客户端断开) 时关闭根 span；根 span 上的 ttft_ms 从请求进入 API 起算 (用户感知的首字延迟)
+    """
+    if not root.recording:
+        async for chunk in stream:
+            yield chunk
+        return
+    started = time.time_ns()
+    first = None
+    chunks = chars = 0
+    try:
+        async for chunk in stream:
+            if first is None:
+                first = time.time_ns()
+                tracer.start_span("llm.ttft", parent=root, start_ns=started).end(first)
+            chunks += 1
+            chars += len(chunk)
+            yield chunk
+    except GeneratorExit:
+        root.set_attribute("client_disconnected", True)
+        raise
+    except BaseException as e:
+        root.record_exception(e)
+        raise
+    finally:
+        end = time.time_ns()
+        if first is not None:
+            tracer.start_span("llm.generate", {"chunks": chunks, "chars": chars}, parent=root, start_ns=first).end(end)
+            root.set_attributes({"ttft_ms": round((first - root.start_ns) / 1e6, 3), "chunks": chunks,
+                                 "chunks_per_s": round(chunks / max((end - first) / 1e9, 1e-9), 2)})
+        root.end(end)
+
+
+def summarize(spans: list) -> dict:
+    """按 span 名称汇总耗时 (同名 span 累加)，便于一眼看出时间花在哪个阶段"""
+    totals = {}
+    for s in spans:
+        entry = totals.setdefault(s["name"], {"count": 0, "total_ms": 0.0})
+        entry["count"] += 1
+        entry["total_ms"] = round(entry["total_ms"] + s["duration_ms"], 3)
+    return dict(sorted(totals.items(), key=lambda kv: -kv[1]["total_ms"]))
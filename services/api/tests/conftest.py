@@ -0,0 +1,9 @@
+import os
+import sys
+import tempfile
+
+# 与 Docker 镜像内一致：以 services/api 为根，按 src.xxx 导入
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+# 导入 src.config 时会创建 UPLOAD_DIR 及其派生目录，测试里指向临时目录
+os.environ.setdefault("UPLOAD_DIR", tempfile.mkdtemp(prefix="gibh-test-"))
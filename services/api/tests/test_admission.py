@@ -0,0 +1,70 @@
+import asyncio
+import gc
+
+import pytest
+
+from src.admission import AdmissionController, AdmissionRejected, guarded_stream
+
+
+def _controller(**kwargs):
+    options = dict(max_active=1, max_queue=4, per_client=5, rate_per_sec=0.0, burst=5, max_wait=100)
+    options.update(kwargs)
+    return AdmissionController(**options)
+
+
+def test_timeout_does_not_leak_slot():
+    async def run():
+        controller = _controller(max_wait=0.05)
+        controller._ewma_service = 0.01  # 让预估等待低于 max_wait，真正进入排队
+        ticket = await controller.acquire("a")
+        with pytest.raises(AdmissionRejected) as e:
+            await controller.acquire("b")
+        assert e.value.reason == "timeout"
+        ticket.release()
+        assert controller._slots._value == 1 and controller.snapshot()["active"] == 0
+    asyncio.run(run())
+
+
+def test_never_started_stream_releases_on_collect():
+    async def run():
+        controller = _controller()
+        ticket = await controller.acquire("a")
+
+        async def chunks():
+            yield "x"
+
+        stream = guarded_stream(chunks(), ticket)
+        del ticket, stream
+        gc.collect()
+        assert controller._slots._value == 1
+        assert controller.snapshot()["active"] == 0 and controller.snapshot()["clients"] == 0
+    asyncio.run(run())
+
+
+def test_rejection_does_not_consume_rate_token():
+    async def run():
+        controller = _controller(max_active=5, per_client=1, burst=2)
+        ticket = await controller.acquire("z")
+        for _ in range(3):
+            with pytest.raises(AdmissionRejected) as e:
+                await controller.acquire("z")
+            assert e.value.reason == "client"
+        ticket.release()
+        (await controller.acquire("z")).release()  # 第二个令牌还在
+    asyncio.run(run())
+
+
+def test_cancel_while_queued_keeps_counts():
+    async def run():
+        controller = _controller(rate_per_sec=1.0)
+        ticket = await controller.acquire("a")
+        waiter = asyncio.ensure_future(controller.acquire("b"))
+        await asyncio.sleep(0.01)
+        waiter.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await waiter
+        ticket.release()
+        await asyncio.sleep(0)
+        assert controller._slots._value == 1
+        assert controller.snapshot()["queue_depth"] == 0 and controller.snapshot()["clients"] == 0
+    asyncio.run(run())
@@ -0,0 +1,93 @@
+import numpy as np
+import pytest
+
+from src.embedding_export import write_embedding, read_header, read_embedding
+
+
+def _points(n, n_categories, seed=0):
+    rng = np.random.default_rng(seed)
+    coords = rng.normal(size=(n, 2)).astype(np.float32)
+    codes = rng.integers(0, n_categories, size=n)
+    return coords, codes, [f"c{i}" for i in range(n_categories)]
+
+
+def test_round_trip_full_level(tmp_path):
+    coords, codes, categories = _points(5000, 12)
+    path = str(tmp_path / "umap.gemb")
+    header = write_embedding(path, coords, codes, categories, basis="umap", min_points=300)
+
+    assert read_header(path)["sections"] == header["sections"]
+    read, coords_out, codes_out, index = read_embedding(path)
+    assert read["n_points"] == 5000 and read["categories"] == categories
+    assert read["code_dtype"] == "<u1"
+    # 打乱后的每个点通过 index 对回原始行
+    np.testing.assert_array_equal(coords_out, coords[index])
+    np.testing.assert_array_equal(codes_out, codes[index])
+    assert sorted(index.tolist()) == list(range(5000))
+    assert header["file_bytes"] == (tmp_path / "umap.gemb").stat().st_size
+
+
+def test_lod_levels_are_prefixes(tmp_path):
+    coords, codes, categories = _points(5000, 3)
+    path = str(tmp_path / "umap.gemb")
+    header = write_embedding(path, coords, codes, categories, min_points=300, lod_factor=4)
+    sizes = [level["n"] for level in header["levels"]]
+    assert sizes == sorted(sizes) and sizes[-1] == 5000 and sizes[0] >= 300
+
+    _, full_coords, full_codes, full_index = read_embedding(path)
+    raw = (tmp_path / "umap.gemb").read_bytes()
+    for k, level in enumerate(header["levels"]):
+        _, c, q, i = read_embedding(path, level=k)
+        assert len(c) == level["n"]
+        np.testing.assert_array_equal(c, full_coords[:level["n"]])
+        np.testing.assert_array_equal(q, full_codes[:level["n"]])
+        np.testing.assert_array_equal(i, full_index[:level["n"]])
+        # header 给出的字节区间可直接作为 Range 请求
+        start, end = level["coords"]
+        np.testing.assert_array_equal(np.frombuffer(raw[start:end], dtype="<f4").reshape(-1, 2), c)
+
+
+def test_sketch_rows_and_wide_codes(tmp_path):
+    coords, codes, categories = _points(400, 300)
+    rows = np.arange(400) * 7  # embedding 只在抽样子集上计算
+    path = str(tmp_path / "tsne.gemb")
+    write_embedding(path, coords, codes, categories, basis="tsne", rows=rows, min_points=100)
+    header, coords_out, codes_out, index = read_embedding(path)
+    assert header["basis"] == "tsne" and header["code_dtype"] == "<u2"
+    np.testing.assert_array_equal(coords_out, coords[index // 7])
+    np.testing.assert_array_equal(codes_out, codes[index // 7])
+
+
+def test_unassigned_codes_use_sentinel(tmp_path):
+    # pandas 把未分配类别 (NaN) 编码为 -1：不能回绕成 255 冒充一个真实类别
+    coords, codes, categories = _points(1000, 255)
+    codes[::10] = -1
+    path = str(tmp_path / "umap.gemb")
+    write_embedding(path, coords, codes, categories, min_points=100)
+    header, _, codes_out, index = read_embedding(path)
+    assert header["code_dtype"] == "<u2" and header["missing_code"] == 65535
+    expected = codes[index]
+    np.testing.assert_array_equal(codes_out[expected >= 0], expected[expected >= 0])
+    assert (codes_out[expected < 0] == header["missing_code"]).all()
+
+    small = str(tmp_path / "small.gemb")
+    write_embedding(small, coords[:10], np.array([-1, 0, 1] * 3 + [2]), ["a", "b", "c"], min_points=1)
+    header, _, codes_out, _ = read_embedding(small)
+    assert header["code_dtype"] == "<u1" and header["missing_code"] == 255
+    assert sorted(set(codes_out.tolist())) == [0, 1, 2, 255]
+
+
+@pytest.mark.parametrize("codes", [[0, 3], [-2, 0]])
+def test_out_of_range_codes_rejected(tmp_path, codes):
+    coords, _, _ = _points(2, 1)
+    with pytest.raises(ValueError):
+        write_embedding(str(tmp_path / "x.gemb"), coords, np.array(codes), ["a", "b", "c"], min_points=1)
+
+
+def test_without_codes(tmp_path):
+    coords, _, _ = _points(100, 1)
+    path = str(tmp_path / "x.gemb")
+    write_embedding(path, coords, min_points=10)
+    header, coords_out, codes_out, index = read_embedding(path)
+    assert codes_out is None and "codes" not in header["sections"]
+    np.testing.assert_array_equal(coords_out, coords[index])
@@ -0,0 +1,35 @@
+import pytest
+
+pytest.importorskip("scanpy")
+from starlette.requests import Request
+
+from src.main import _etag_matches, _conditional_json
+
+
+def _request(if_none_match=None):
+    headers = [(b"if-none-match", if_none_match.encode())] if if_none_match is not None else []
+    return Request({"type": "http", "method": "GET", "path": "/", "headers": headers})
+
+
+@pytest.mark.parametrize("header, matches", [
+    ('"abc123"', True),
+    ('W/"abc123"', True),
+    ('"zzz", W/"abc123"', True),
+    ("*", True),
+    (None, False),
+    ("", False),
+    ('"abc"', False),          # 部分 ETag 不能命中
+    ('"abc1234"', False),
+    ("abc123", False),         # 缺少引号不是同一个实体标签
+    ('"x"abc123"-v2"', False),  # 只是包含 ETag 的其他标签
+])
+def test_if_none_match_compares_whole_tags(header, matches):
+    assert _etag_matches(_request(header), '"abc123"') is matches
+
+
+def test_conditional_json_only_exact_tag_gets_304():
+    payload = {"status": "done"}
+    etag = _conditional_json(_request(), payload).headers["etag"]
+    assert _conditional_json(_request(etag), payload).status_code == 304
+    assert _conditional_json(_request(etag + "-gzip"), payload).status_code == 200
+    assert _conditional_json(_request(f'"{etag[1:8]}"'), payload).status_code == 200
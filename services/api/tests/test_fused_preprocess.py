@@ -0,0 +1,80 @@
+import numpy as np
+import pandas as pd
+import pytest
+import scipy.sparse as sp
+
+sc = pytest.importorskip("scanpy")
+pytest.importorskip("numba")
+import anndata as ad
+
+from src.fused_preprocess import fused_preprocess, available, PERCENT_TOP
+
+
+def _synthetic(n_obs=600, n_vars=800, seed=0):
+    """负二项计数 + 少量大计数 / 线粒体基因，覆盖直方图与 "others" 两条 top-N 路径"""
+    rng = np.random.default_rng(seed)
+    means = rng.gamma(0.3, 2.0, size=n_vars)
+    depth = rng.lognormal(0, 0.6, size=(n_obs, 1))
+    counts = rng.poisson(means * depth).astype(np.float32)
+    counts[rng.random(counts.shape) < 0.002] = 400  # 超出直方图范围的计数
+    X = sp.csr_matrix(counts)
+    var_names = [f"MT-{i}" if i < 13 else f"G{i}" for i in range(n_vars)]
+    obs_names = [f"c{i}" for i in range(n_obs)]
+    return ad.AnnData(X, obs=pd.DataFrame(index=obs_names), var=pd.DataFrame(index=var_names))
+
+
+def _reference(adata, min_genes, max_mt):
+    adata.var["mt"] = adata.var_names.str.startswith(("MT-", "mt-"))
+    sc.pp.calculate_qc_metrics(adata, qc_vars=["mt"], percent_top=PERCENT_TOP, inplace=True)
+    qc_obs, qc_var = adata.obs.copy(), adata.var.copy()
+    sc.pp.filter_cells(adata, min_genes=min_genes)
+    adata = adata[adata.obs.pct_counts_mt < max_mt, :].copy()
+    sc.pp.normalize_total(adata, target_sum=1e4)
+    sc.pp.log1p(adata)
+    sc.pp.highly_variable_genes(adata, n_top_genes=200, flavor="seurat")
+    return adata, qc_obs, qc_var
+
+
+def test_matches_scanpy_sequence():
+    raw = _synthetic()
+    expected, qc_obs, qc_var = _reference(raw.copy(), min_genes=150, max_mt=8)
+
+    adata = raw.copy()
+    assert available(adata)
+    out = fused_preprocess(adata, min_genes=150, max_mt=8, target_sum=1e4, n_top_genes=200)
+
+    # QC 指标 (全部细胞) 写回输入对象
+    for col in qc_obs.columns:
+        np.testing.assert_allclose(adata.obs[col].to_numpy(np.float64), qc_obs[col].to_numpy(np.float64),
+                                   rtol=1e-5, err_msg=col)
+    for col in ("n_cells_by_counts", "mean_counts", "pct_dropout_by_counts", "total_counts"):
+        np.testing.assert_allclose(adata.var[col].to_numpy(np.float64), qc_var[col].to_numpy(np.float64),
+                                   rtol=1e-5, err_msg=col)
+
+    # 过滤后的细胞、LogNormalize 后的矩阵与 HVG 集合
+    assert list(out.obs_names) == list(expected.obs_names)
+    assert 0 < out.n_obs < raw.n_obs
+    np.testing.assert_allclose(out.X.toarray(), expected.X.toarray(), atol=1e-5)
+    assert out.uns["log1p"] == {"base": None}
+    np.testing.assert_array_equal(out.var["highly_variable"].to_numpy(), expected.var["highly_variable"].to_numpy())
+    np.testing.assert_allclose(out.var["dispersions_norm"].to_numpy(), expected.var["dispersions_norm"].to_numpy(),
+                               rtol=1e-3, atol=1e-4)
+
+
+def test_float64_input_is_not_mutated():
+    raw = _synthetic(n_obs=200, n_vars=300, seed=1)
+    adata = raw.copy()
+    adata.X = adata.X.astype(np.float64)
+    data = adata.X.data
+    before = data.copy()
+    out = fused_preprocess(adata, min_genes=50, max_mt=20, target_sum=1e4)
+    assert out.X.dtype == np.float32
+    np.testing.assert_array_equal(data, before)
+
+
+def test_rejects_non_csr():
+    adata = _synthetic(n_obs=50, n_vars=60)
+    adata.X = adata.X.tocsc()
+    assert not available(adata)
+    with pytest.raises(ValueError):
+        fused_preprocess(adata)
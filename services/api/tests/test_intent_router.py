@@ -0,0 +1,83 @@
+import pytest
+
+from src.intent_router import IntentRouter, CHAT, MAPPING, WORKFLOW
+from src.skill_manager import SkillManager
+
+RUN_ID = "3f2a9c1e-7b4d-4e2f-9a1b-0c5d6e7f8a9b"
+
+
+@pytest.fixture(scope="module")
+def router():
+    # 与 API 进程相同：词表来自实际加载的技能 META
+    skills = SkillManager().skills
+    return IntentRouter([skill.META for skill in skills.values()])
+
+
+@pytest.mark.parametrize("query, action, params", [
+    ("把分辨率改成 0.8 再跑一次", "set_params", {"local_cluster": {"resolution": "0.8"}}),
+    ("set resolution to 1.5 and rerun", "set_params", {"local_cluster": {"resolution": "1.5"}}),
+    ("分辨率从0.5改成1.0", "set_params", {"local_cluster": {"resolution": "1.0"}}),
+    ("线粒体比例调到 10%，最少基因数 300", "set_params", {"local_qc": {"max_mt": "10", "min_genes": "300"}}),
+    ("t-SNE 跳过，再跑一次", "set_params", {"local_tsne": {"tsne_mode": "skip"}}),
+    ("PCA 用 randomized", "set_params", {"local_pca": {"svd_solver": "randomized"}}),
+    ("重新画 UMAP", "redraw", {}),
+    ("重新跑一下聚类", "rerun", {}),
+])
+def test_commands_route_locally(router, query, action, params):
+    decision = router.route(query)
+    assert decision.method == "classifier"
+    assert decision.intent == WORKFLOW
+    assert decision.action == action
+    assert decision.params == params
+
+
+def test_mapping_with_run_id(router):
+    decision = router.route(f"把新样本投影到 {RUN_ID} 上")
+    assert decision.local and decision.intent == MAPPING
+    assert decision.params == {"local_map_reference": {"reference_run": RUN_ID}}
+
+
+@pytest.mark.parametrize("query", [
+    # 问答
+    "什么是 UMAP?", "UMAP 是什么", "分辨率设为 1.2 合适吗", "为什么要把分辨率调到0.8", "你好", "CD3E 是什么基因",
+    # 流程不支持的分析：即使带着动词 / 步骤名也不能生成 scanpy 卡片
+    "画一个火山图", "帮我画一张热图展示 CD3E 的表达", "画小提琴图", "执行差异分析",
+    "run gsea on cluster 3", "analyze cluster 5 vs 3", "对聚类结果做富集分析",
+    # 没有步骤 / 参数，不知道要跑什么
+    "再跑一次", "帮我分析这个数据",
+])
+def test_chat_and_unsupported_fall_back(router, query):
+    decision = router.route(query)
+    assert not decision.local
+    assert decision.method == "fallback"
+
+
+@pytest.mark.parametrize("query", ["resolution 50", "线粒体比例改成 150", "分辨率改成 abc", "邻居数改成 0.5"])
+def test_out_of_bounds_values_fall_back(router, query):
+    decision = router.route(query)
+    assert not decision.local
+    assert decision.reason == "invalid_value"
+
+
+def test_legacy_keyword_rules(router):
+    assert router.route("规划一下流程").method == "rule"
+    mapping = router.route(f"参考 {RUN_ID} 注释")
+    assert mapping.method == "rule" and mapping.intent == MAPPING
+
+
+def test_disabled_keeps_rules_only():
+    skills = SkillManager().skills
+    router = IntentRouter([skill.META for skill in skills.values()], enabled=False)
+    assert router.route("规划流程").method == "rule"
+    decision = router.route("把分辨率改成 0.8 再跑一次")
+    assert decision.reason == "disabled"
+
+
+def test_snapshot_counts(router):
+    router.route("重新画 UMAP")
+    router.route("什么是 UMAP?")
+    snap = router.snapshot()
+    assert snap["routed"] >= 2
+    assert snap["llm_calls_saved"] == snap["classifier"]
+    assert snap["fallback_reasons"].get(CHAT, 0) >= 1
+    assert snap["latency_us"]["p50"] < 1000
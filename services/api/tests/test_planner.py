@@ -0,0 +1,39 @@
+from src.planner import WorkflowPlanner
+
+PREPROCESS = ["local_qc", "local_normalize", "local_hvg"]
+
+
+def _fused_run(n_obs):
+    # 流水线开启融合预处理时的步骤记录：整段扫描计在 QC 步，后两步只剩出图与筛选
+    return [
+        {"name": "local_qc", "status": "success", "elapsed": 2.0 * n_obs / 1e4, "peak_mb": 500, "fused": True},
+        {"name": "local_normalize", "status": "success", "elapsed": 0.0, "peak_mb": 500, "fused": True},
+        {"name": "local_hvg", "status": "success", "elapsed": 0.5, "peak_mb": 600, "fused": True},
+    ]
+
+
+def test_fused_steps_are_fitted_under_their_own_key(tmp_path):
+    planner = WorkflowPlanner(str(tmp_path / "cost_history.jsonl"), fused=True)
+    for n_obs in (1000, 3000, 5000, 8000, 12000, 20000):
+        planner.record_run({"n_obs": n_obs, "nnz": n_obs * 1000}, {}, _fused_run(n_obs))
+
+    meta = {"n_obs": 10000, "nnz": 10000 * 1000}
+    estimates = planner.estimate(meta, WorkflowPlanner.choose(meta, fused=True), PREPROCESS)
+    assert [estimates[t]["variant"] for t in PREPROCESS] == ["local_qc:fused", "local_normalize:fused", "local_hvg:fused"]
+    assert all(e["source"] == "fitted" for e in estimates.values())
+    assert abs(estimates["local_qc"]["seconds"] - 2.0) < 0.1
+
+    # 未开启融合预处理时仍按标准步骤估算 (没有历史，使用默认系数)
+    standard = planner.estimate(meta, WorkflowPlanner.choose(meta), PREPROCESS)
+    assert [standard[t]["variant"] for t in PREPROCESS] == PREPROCESS
+    assert all(e["source"] == "default" for e in standard.values())
+
+
+def test_fallback_run_is_recorded_as_standard(tmp_path):
+    # 融合预处理失败退回 scanpy 时，步骤不带 fused 标记，记到标准变体下
+    planner = WorkflowPlanner(str(tmp_path / "cost_history.jsonl"), fused=True)
+    steps = [{"name": "local_qc", "status": "success", "elapsed": 1.0, "peak_mb": 400}]
+    for _ in range(5):
+        planner.record_run({"n_obs": 5000, "nnz": 5_000_000}, {}, steps)
+    fitted = planner.model._load_fitted()
+    assert "local_qc" in fitted and "local_qc:fused" not in fitted
@@ -0,0 +1,22 @@
+import time
+
+import pytest
+
+pytest.importorskip("scanpy")
+
+from src.scrna_analysis import LocalSingleCellPipeline
+
+
+def test_prefetch_load_is_interrupted_when_work_arrives(tmp_path, monkeypatch):
+    # 读取大文件期间有正式任务排队：不能等读取结束，应在轮询周期内让出 Worker
+    data = tmp_path / "big.h5ad"
+    data.write_bytes(b"")
+    pipeline = LocalSingleCellPipeline(output_dir=str(tmp_path / "results"), cache_dir=str(tmp_path / "cache"))
+    monkeypatch.setattr(pipeline, "_read_input", lambda path: time.sleep(30))
+
+    t0 = time.monotonic()
+    queued_at = t0 + 0.3
+    result = pipeline.prefetch(str(data), should_stop=lambda: time.monotonic() > queued_at)
+
+    assert result["status"] == "cancelled" and result["stage"] == "load"
+    assert time.monotonic() - t0 < 5
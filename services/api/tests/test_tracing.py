@@ -0,0 +1,50 @@
+import numpy as np
+import pandas as pd
+import pytest
+import scipy.sparse as sp
+
+pytest.importorskip("scanpy")
+pytest.importorskip("celery")
+import anndata as ad
+
+from src.tracing import tracer, span, KIND_CONSUMER
+
+
+def _write_dataset(path, n_obs=300, n_vars=800, seed=0):
+    rng = np.random.default_rng(seed)
+    counts = rng.poisson(rng.gamma(0.5, 2.0, size=n_vars), size=(n_obs, n_vars)).astype(np.float32)
+    var_names = [f"MT-{i}" if i < 5 else f"G{i}" for i in range(n_vars)]
+    adata = ad.AnnData(sp.csr_matrix(counts), obs=pd.DataFrame(index=[f"c{i}" for i in range(n_obs)]),
+                       var=pd.DataFrame(index=var_names))
+    adata.write_h5ad(path)
+
+
+def test_pipeline_spans_join_worker_root(tmp_path):
+    # Worker 里技能以顶层模块名导入 scrna_analysis；步骤 span 必须挂到 celery 任务的根 span 下
+    from src.celery_app import _get_skill
+
+    data = tmp_path / "pbmc.h5ad"
+    _write_dataset(data)
+    tracer.configure(str(tmp_path / "traces"), service="gibh-worker")
+    try:
+        skill = _get_skill("scanpy_local")
+        params = {"min_genes": "50", "max_mt": "50", "n_comps": "10", "n_pcs": "10",
+                  "render_png": "false", "tsne_mode": "skip"}
+        with span("celery.run_workflow", root=True, kind=KIND_CONSUMER) as root:
+            result = skill.execute(str(data), params, str(tmp_path), run_dir=str(tmp_path / "run"),
+                                   sample_workers=1, fused=False)
+        assert result["status"] == "success"
+        spans = tracer.load_trace(root.trace_id)
+    finally:
+        tracer.configure(None, service="gibh-worker")
+
+    by_id = {s["span_id"]: s for s in spans}
+    steps = [s for s in spans if s["name"].startswith("step.")]
+    assert {"step.local_qc", "step.local_pca", "step.local_cluster"} <= {s["name"] for s in steps}
+    for s in steps:
+        # 沿父链能回到根 span
+        parent = s["parent_id"]
+        while parent and parent != root.span_id:
+            parent = by_id[parent]["parent_id"]
+        assert parent == root.span_id
+    assert any(s["name"] == "persist_run_state" for s in spans)